@@ -0,0 +1,148 @@
+"""Checks that the attention implementations agree on a randomly initialized model.
+
+For each mask (causal, sliding `attention_window`, and sliding with `global_attention_every`),
+computes the loss and the gradient of every weight on the first training batch with
+`attention="blockwise"` and `attention="block_sparse"`, and compares them against
+`attention="dense"`. Unless the config sets them, `attention_block_size` is a quarter of the
+sequence length and `attention_window` is one and a half blocks, so that windows end mid-tile.
+Queries and unembeddings are initialized randomly even if the config zeroes them, since every
+attention weight would otherwise get the same gradient under every implementation.
+
+Loss errors are absolute, in nats per token. Gradient errors are relative to the largest dense
+value of each weight's gradient. Attention runs in bf16, so the implementations agree only up
+to bf16 rounding: the check fails if either error exceeds its tolerance below.
+
+Needs jax 0.4.35 or later, as pinned in requirements-cpu.txt: under jax 0.4.26's CPU backend,
+the dense reference's gradients are miscompiled, and the check fails with errors of about 70.
+
+Command to run on your CPU:
+  XLA_FLAGS=--xla_force_host_platform_device_count=8 python -m attention_equivalence --config-name=local_test_synthetic
+"""
+
+from dataclasses import replace
+from functools import partial
+from typing import Tuple
+
+import hydra
+import jax
+import numpy as np
+
+import jax_extra
+import shardlib.shardtypes as shardtypes
+import training_io
+from input_loader import TokenBatch, get_loader
+from shardlib.shardtypes import f32
+from train import AnyModel, Config, Hparams, get_model_type, make_mesh
+
+ATTENTIONS = ["dense", "blockwise", "block_sparse"]
+
+# Largest gradient error, relative to each weight's largest gradient, that counts as a match.
+TOLERANCE = 0.05
+# Largest absolute loss error, in nats per token, that counts as a match. bf16 rounding of the
+# attention output perturbs the loss by about 1e-4 on `local_test_synthetic`.
+LOSS_TOLERANCE = 1e-3
+
+
+@partial(jax.jit, static_argnums=(1,))
+@shardtypes.scope
+def loss_and_grad(
+    weights: AnyModel, h: Hparams, batch: TokenBatch
+) -> Tuple[f32[b""], AnyModel]:
+    ModelType = get_model_type(h)
+
+    @partial(shardtypes.typed_shard_map, check_rep=False)
+    def sharded(weights: ModelType, batch: TokenBatch) -> Tuple[f32[b""], ModelType]:
+        loss, grad = jax.value_and_grad(lambda weights: weights.loss(h, batch))(weights)
+        return jax.lax.psum(loss, ("p", "d", "s", "t")), grad
+
+    return sharded(weights, batch)
+
+
+def grad_errors(grad: AnyModel, reference: AnyModel) -> dict:
+    """Each weight's largest gradient error, relative to its largest reference gradient."""
+    errors = {}
+    for (path, g), r in zip(
+        jax.tree_util.tree_leaves_with_path(grad), jax.tree.leaves(reference)
+    ):
+        g, r = np.asarray(g, np.float32), np.asarray(r, np.float32)
+        scale = np.abs(r).max()
+        errors[jax.tree_util.keystr(path)] = np.abs(g - r).max() / (scale or 1.0)
+    return errors
+
+
+def main_contained(config: Config):
+    jax.config.update("jax_threefry_partitionable", True)
+    seq_len = config.training.tokens.len
+    block_size = config.model.attention_block_size or seq_len // 4
+    window = config.model.attention_window or 3 * block_size // 2
+    base = replace(
+        config.model,
+        zero_queries=False,
+        zero_unembed=False,
+        attention_block_size=block_size,
+        attention_window=None,
+        global_attention_every=None,
+    )
+    masks = {
+        "causal": base,
+        f"window {window}": replace(base, attention_window=window),
+        f"window {window}, global every 2": replace(
+            base, attention_window=window, global_attention_every=2
+        ),
+    }
+
+    with make_mesh(config.mesh):
+        weights = jax.jit(partial(get_model_type(base).init, base))(
+            jax.random.PRNGKey(config.training.seed)
+        )
+        loader = get_loader("train", config.training_data, config.training.tokens)
+        batch = loader.load(0)
+        if hasattr(loader, "close"):
+            loader.close()
+
+        worst = 0.0
+        worst_loss = 0.0
+        for mask, h in masks.items():
+            results = {
+                attention: loss_and_grad(
+                    weights, replace(h, attention=attention), batch
+                )
+                for attention in ATTENTIONS
+            }
+            reference_loss, reference_grad = results["dense"]
+            for attention in ATTENTIONS[1:]:
+                loss, grad = results[attention]
+                errors = grad_errors(grad, reference_grad)
+                worst_weight = max(errors, key=errors.get)
+                worst = max(worst, errors[worst_weight])
+                worst_loss = max(worst_loss, abs(float(loss) - float(reference_loss)))
+                if training_io.is_device_0():
+                    print(
+                        f"{mask}, {attention} vs dense (block size {block_size}): "
+                        f"loss {float(loss):.6f} vs {float(reference_loss):.6f}, "
+                        f"largest gradient error {errors[worst_weight]:.2e} "
+                        f"in {worst_weight}"
+                    )
+                    for path, error in errors.items():
+                        print(f"  {path}: {error:.2e}")
+
+    if worst_loss > LOSS_TOLERANCE:
+        raise ValueError(
+            f"Attention implementations disagree: loss error {worst_loss:.2e} exceeds "
+            f"{LOSS_TOLERANCE}."
+        )
+    if worst > TOLERANCE:
+        raise ValueError(
+            f"Attention implementations disagree: gradient error {worst:.2e} exceeds "
+            f"{TOLERANCE}."
+        )
+
+
+@hydra.main(config_path="configs", version_base=None)
+def main(config):
+    config = jax_extra.make_dataclass_from_dict(Config, config)
+    main_contained(config)
+
+
+if __name__ == "__main__":
+    main()
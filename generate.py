@@ -0,0 +1,195 @@
+"""Autoregressive generation from a training checkpoint, using a KV cache.
+
+Loads the latest checkpoint of a model trained by `train.py` (with the same config), prefills
+prompts taken from the validation split, then decodes one token at a time. Reports prefill time,
+per-step decode latency, and KV cache bytes per token.
+
+Command to run on your CPU, after training with `local_test_synthetic`:
+  XLA_FLAGS=--xla_force_host_platform_device_count=8 python -m generate --config-name=local_test_synthetic +paths.model_name=synthetic_000 +generate.max_new_tokens=32
+"""
+
+import os
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional, Tuple
+
+import hydra
+import jax
+import jax.numpy as jnp
+import numpy as np
+
+import jax_extra
+import shardlib.shardtypes as shardtypes
+import training_io
+from input_loader import get_loader
+from shardlib.shardtypes import f32, make_shardings, pytree_dataclass, u32
+from train import AnyKVCache, Config, Hparams, Model, get_kv_cache_type, make_mesh
+
+
+@dataclass(frozen=True)
+class GenerateConfig:
+    # Number of prompt tokens per sequence. Defaults to half of `training.tokens.len`.
+    prompt_len: Optional[int] = None
+    max_new_tokens: Optional[int] = None
+    # Number of sequences decoded in parallel. Defaults to `training.tokens.batch`.
+    batch: Optional[int] = None
+    # Greedy decoding if unset or zero.
+    temperature: Optional[float] = None
+    seed: Optional[int] = None
+
+
+@pytree_dataclass
+class Weights:
+    """The weights-only subset of `train.State`, so checkpoint keys match `State`'s."""
+
+    weights: Model
+
+
+@partial(jax.jit, static_argnums=(1, 3))
+@shardtypes.scope
+def prefill(
+    weights: Model, h: Hparams, ids: u32[b"batch/d len"], max_len: int
+) -> Tuple[f32[b"batch/d vocab/t"], AnyKVCache]:
+    Cache = get_kv_cache_type(h)
+
+    @partial(shardtypes.typed_shard_map, check_rep=False)
+    def sharded_prefill(
+        weights: Model, ids: u32[b"batch/d len"]
+    ) -> Tuple[f32[b"batch/d vocab/t"], Cache]:
+        return weights.prefill(h, ids, max_len)
+
+    return sharded_prefill(weights, ids)
+
+
+@partial(jax.jit, static_argnums=(1,), donate_argnums=(2,))
+@shardtypes.scope
+def decode_step(
+    weights: Model, h: Hparams, cache: AnyKVCache, ids: u32[b"batch/d"]
+) -> Tuple[f32[b"batch/d vocab/t"], AnyKVCache]:
+    Cache = get_kv_cache_type(h)
+
+    @partial(shardtypes.typed_shard_map, check_rep=False)
+    def sharded_decode_step(
+        weights: Model, cache: Cache, ids: u32[b"batch/d"]
+    ) -> Tuple[f32[b"batch/d vocab/t"], Cache]:
+        return weights.decode_step(h, cache, ids)
+
+    return sharded_decode_step(weights, cache, ids)
+
+
+@partial(jax.jit, static_argnums=(1,))
+def sample(logits: jax.Array, temperature: float, rng: jax.Array) -> jax.Array:
+    if temperature:
+        ids = jax.random.categorical(rng, logits / temperature, axis=-1)
+    else:
+        ids = jnp.argmax(logits, axis=-1)
+    return jnp.uint32(ids)
+
+
+def load_weights(model_dir: str, h: Hparams, io: training_io.IOConfig) -> Model:
+    """Loads the weights of the latest checkpoint in `model_dir`, without materializing
+    initial weights or optimizer state."""
+    shapes = jax.eval_shape(partial(Model.init, h), jax.random.PRNGKey(0))
+    abstract = jax.tree.map(
+        lambda s, sharding: jax.ShapeDtypeStruct(s.shape, s.dtype, sharding=sharding),
+        shapes,
+        make_shardings(Model),
+    )
+    state, step = training_io.load_checkpoint_if_it_exists(
+        model_dir, Weights(weights=abstract), io
+    )
+    if step == 0:
+        raise ValueError(f"No checkpoint to generate from in {model_dir}.")
+    return state.weights
+
+
+def load_prompts(config: Config, batch_size: int, prompt_len: int) -> jax.Array:
+    """Prompts from the validation split, as the model saw inputs in training: targets
+    shifted right by one, starting from token 0."""
+    loader = get_loader(
+        "validation",
+        config.training_data,
+        config.training.tokens,
+        config.io.max_io_threads,
+    )
+    targets = np.asarray(loader.load(0).targets)[:batch_size]
+    if hasattr(loader, "close"):
+        loader.close()
+    assert targets.shape[0] == batch_size and targets.shape[1] >= prompt_len
+    ids = np.pad(targets[:, : prompt_len - 1], ((0, 0), (1, 0)))
+    return jax.device_put(ids, make_shardings(u32[b"batch/d len"]))
+
+
+def kv_cache_bytes(cache: AnyKVCache) -> int:
+    return sum(e.nbytes for e in cache.entries())
+
+
+def main_contained(config: Config, gen: GenerateConfig):
+    jax.config.update("jax_threefry_partitionable", True)
+    h = config.model
+    if h.moe_experts:
+        raise ValueError("Mixture-of-experts models only support training.")
+    batch_size = gen.batch or config.training.tokens.batch
+    prompt_len = gen.prompt_len or config.training.tokens.len // 2
+    max_new_tokens = gen.max_new_tokens or config.training.tokens.len - prompt_len
+    max_len = prompt_len + max_new_tokens
+
+    with make_mesh(config.mesh):
+        model_dir = os.path.join(config.paths.root_working_dir, config.paths.model_name)
+        weights = load_weights(model_dir, h, config.io)
+
+        ids = load_prompts(config, batch_size, prompt_len)
+
+        rng = jax.random.PRNGKey(gen.seed or 0)
+        start = time.time()
+        logits, cache = prefill(weights, h, ids, max_len)
+        jax.block_until_ready(cache)
+        prefill_time = time.time() - start
+        next_ids = sample(logits, gen.temperature or 0.0, rng)
+
+        # Compile ahead of time so that the first step's latency isn't mostly compilation.
+        c_decode_step = decode_step.lower(weights, h, cache, next_ids).compile()
+
+        generated = [next_ids]
+        start = time.time()
+        for i in range(max_new_tokens - 1):
+            logits, cache = c_decode_step(weights, cache, next_ids)
+            next_ids = sample(
+                logits, gen.temperature or 0.0, jax.random.fold_in(rng, i)
+            )
+            generated.append(next_ids)
+        jax.block_until_ready(next_ids)
+        decode_time = time.time() - start
+        decode_steps = max(max_new_tokens - 1, 1)
+
+        cache_bytes = kv_cache_bytes(cache)
+        if training_io.is_device_0():
+            generated = np.stack([np.asarray(g) for g in generated], axis=1)
+            print(f"Attention: {h.attention or 'dense'}")
+            print(f"KV cache dtype: {h.kv_cache_dtype or 'bfloat16'}")
+            print(f"Batch {batch_size}, prompt {prompt_len}, max_len {max_len}")
+            print(f"Prefill (including compilation): {prefill_time:.3f}s")
+            print(
+                f"Decode latency: {1e3 * decode_time / decode_steps:.3f} ms/step, "
+                f"{batch_size * decode_steps / decode_time:.1f} tokens/s"
+            )
+            print(f"KV cache: {cache_bytes:_} bytes total")
+            print(f"KV cache: {cache_bytes / (batch_size * max_len):.1f} bytes/token")
+            print(f"Prompt[0]: {np.asarray(ids)[0].tolist()}")
+            print(f"Generated[0]: {generated[0].tolist()}")
+
+
+@hydra.main(config_path="configs", version_base=None)
+def main(config):
+    gen = jax_extra.make_dataclass_from_dict(
+        GenerateConfig, config.get("generate") or {}
+    )
+    config = jax_extra.make_dataclass_from_dict(Config, config)
+    if not config.paths.model_name:
+        raise ValueError("Set paths.model_name to the model to generate from.")
+    main_contained(config, gen)
+
+
+if __name__ == "__main__":
+    main()
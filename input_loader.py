@@ -17,24 +17,30 @@ than Huggingface Datasets, which allows for more thorough shuffling, taking adva
 of the fact that a single sequence of tokens uses very little memory compared to e.g.
 a single image.
 
-Mosaic's StreamingDatasets library uses a similar algorithm as us, which they call py1b: 
+Mosaic's StreamingDatasets library uses a similar algorithm as us, which they call py1b:
 https://docs.mosaicml.com/projects/streaming/en/stable/fundamentals/shuffling.html.
 """
 
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import collections
+import fcntl
 import functools
+import hashlib
 from typing import Tuple, Union, Optional, List
 import time
 import random
 import os
+import threading
 
 from typeguard import typechecked
 from shardlib.shardtypes import bool_, pytree_dataclass, u32
 import shardlib.shardtypes as shardtypes
 import zarr
+from numcodecs.compat import ensure_ndarray
 from dataclasses import dataclass
 import jax
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from jax.sharding import PartitionSpec as P
 import datetime
 from jax import numpy as jnp
@@ -59,8 +65,8 @@ class TokenBatchParams:
 class TokenBatch:
     """A batch of tokens, which are typically the input to training."""
 
-    targets: u32["batch/d len"]
-    is_seq_start: bool_["batch/d len"]
+    targets: u32["batch/d len/s"]
+    is_seq_start: bool_["batch/d len/s"]
 
 
 @dataclass(frozen=True)
@@ -89,21 +95,198 @@ class FlatTokensParams:
     )
     seed: int
     sequence_packing: bool
+    # Number of shuffle buffers each stream may hold in memory. With more than 1, the next
+    # minipochs' buffers are loaded and shuffled in the background while the current one serves
+    # batches, instead of stalling training at each minipoch boundary. Defaults to 1.
+    shuffle_buffers_per_stream: Optional[int] = None
+    # If set, chunks read from `filespec` are cached in this local directory, e.g. on SSD, so that
+    # restarts and later runs on the same data don't fetch them again. All processes on the host
+    # may share the directory.
+    local_cache_dir: Optional[str] = None
+    # Approximate bound on the bytes in `local_cache_dir`, beyond which the least recently used
+    # chunks are evicted. Defaults to no bound.
+    local_cache_bytes: Optional[int] = None
+
+
+# Marks a metadata key that the cached store doesn't have, e.g. a group's `.zarray`, which zarr
+# looks for when opening it.
+_ABSENT_SUFFIX = ".absent"
+_METADATA_KEYS = (".zarray", ".zgroup", ".zattrs", ".zmetadata")
+
+
+def _is_metadata_key(key: str) -> bool:
+    return key.rsplit("/", 1)[-1] in _METADATA_KEYS
+
+
+class LocalChunkCache(zarr.storage.BaseStore):
+    """Read-only zarr store that caches the keys, i.e. chunks and metadata, of the store at
+    `filespec` as files under `cache_dir`.
+
+    Several processes may share `cache_dir`: files are written atomically, and a file evicted
+    while being read is fetched again. Reading a file marks it as recently used by updating its
+    modification time. Once this process estimates that the whole of `cache_dir` exceeds
+    `max_bytes`, it rescans the directory under a lock and evicts the least recently used files
+    down to 7/8 of `max_bytes`, so that rescans are rare. The datasets are assumed immutable, so
+    metadata keys that the store doesn't have are cached as absent too. Chunks never are: stores
+    such as zarr's `FSStore` leave out of `getitems` the keys whose reads failed, e.g. on a
+    transient network error, so a chunk missing once may well be there on the next read.
+    """
+
+    def __init__(self, filespec: str, cache_dir: str, max_bytes: Optional[int] = None):
+        self.store = zarr.storage.normalize_store_arg(filespec, mode="r")
+        self.cache_dir = cache_dir
+        # Different datasets share `cache_dir` and its byte budget.
+        digest = hashlib.sha256(filespec.encode()).hexdigest()[:16]
+        self.root = os.path.join(
+            cache_dir, f"{os.path.basename(filespec.rstrip('/'))}-{digest}"
+        )
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._bytes = 0
+        self._evict()
+
+    def __getitem__(self, key: str):
+        value = self._read_cached(key)
+        if value is None:
+            try:
+                value = self.store[key]
+            except KeyError:
+                if _is_metadata_key(key):
+                    self._write_cached(key + _ABSENT_SUFFIX, b"")
+                raise
+            self._write_cached(key, value)
+        return value
+
+    def getitems(self, keys, *, contexts):
+        results = {}
+        missing = []
+        for key in keys:
+            try:
+                value = self._read_cached(key)
+            except KeyError:
+                continue
+            if value is None:
+                missing.append(key)
+            else:
+                results[key] = value
+        if missing:
+            fetched = self.store.getitems(missing, contexts=contexts)
+            for key in missing:
+                if key in fetched:
+                    self._write_cached(key, fetched[key])
+                elif _is_metadata_key(key):
+                    self._write_cached(key + _ABSENT_SUFFIX, b"")
+            results.update(fetched)
+        return results
+
+    def __contains__(self, key: str) -> bool:
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __setitem__(self, key: str, value):
+        raise zarr.errors.ReadOnlyError()
+
+    def __delitem__(self, key: str):
+        raise zarr.errors.ReadOnlyError()
+
+    def __iter__(self):
+        return iter(self.store)
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split("/"))
+
+    def _read_cached(self, key: str) -> Optional[bytes]:
+        """Returns None if `key` isn't cached, and raises KeyError if it's cached as absent."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            if os.path.exists(path + _ABSENT_SUFFIX):
+                raise KeyError(key)
+            return None
+        return value
+
+    def _write_cached(self, key: str, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = f"{path}.{os.getpid()}.{threading.get_ident()}.partial"
+        with open(partial_path, "wb") as f:
+            f.write(value)
+        os.replace(partial_path, path)
+        with self._lock:
+            self._bytes += len(value)
+            over_budget = self.max_bytes is not None and self._bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+
+    def _evict(self):
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            files = []
+            for dirpath, _, filenames in os.walk(self.cache_dir):
+                for filename in filenames:
+                    if dirpath == self.cache_dir or filename.endswith(".partial"):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            if self.max_bytes is not None and total > self.max_bytes:
+                files.sort()
+                for _, size, path in files:
+                    if total <= self.max_bytes * 7 // 8:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+            with self._lock:
+                self._bytes = total
 
 
 @dataclass
 class _ShuffleBuffer:
+    """A shuffle buffer, shuffled lazily: its sequence `i` is row `permutation[i]` of the
+    concatenation of `read_blocks`, which are kept as loaded."""
+
     minipoch: int
-    buffer: u32["Buflen len"]
+    read_blocks: List[u32["Seqs len"]]
+    permutation: u32["Buflen"]
+
+    def __getitem__(self, i: int) -> u32["len"]:
+        block, row = divmod(int(self.permutation[i]), len(self.read_blocks[0]))
+        return self.read_blocks[block][row]
 
 
 class ShufflingLoader:
     def __init__(
-        self, split: str, params: FlatTokensParams, token_batch_params: TokenBatchParams
+        self,
+        split: str,
+        params: FlatTokensParams,
+        token_batch_params: TokenBatchParams,
+        max_io_threads: int = 1024,
     ):
         self.params = params
         self.token_batch_params = token_batch_params
-        self.root = zarr.open_group(params.filespec, mode="r")
+        store = params.filespec
+        if params.local_cache_dir:
+            store = LocalChunkCache(
+                params.filespec, params.local_cache_dir, params.local_cache_bytes
+            )
+        self.root = zarr.open_group(store, mode="r")
         assert split in ["train", "validation"], "Invalid split"
         self.encoded_tokens = self.root[split]["encoded_tokens"]
         self.seq_starts = self.root[split]["seq_starts"]
@@ -156,6 +339,17 @@ class ShufflingLoader:
         self.shuffle_buffers_by_stream = {
             stream_index: None for stream_index in streams
         }
+        self.shuffle_buffers_per_stream = params.shuffle_buffers_per_stream or 1
+        # (minipoch, future) of the shuffle buffers being loaded in the background, in order.
+        self.pending_shuffle_buffers_by_stream = {
+            stream_index: collections.deque() for stream_index in streams
+        }
+        self.refill_executor = ThreadPoolExecutor(max_workers=1)
+        # Fetching chunks is IO-bound, so as for checkpoints, we allow many more threads than
+        # CPUs. Decompressing them is CPU-bound, so that gets one thread per CPU.
+        self.max_io_threads = max_io_threads
+        self.io_executor = ThreadPoolExecutor(max_workers=max_io_threads)
+        self.cpu_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
         self.batch_indices = sorted(batch_indices)
         # Shuffle read blocks
         assert (
@@ -204,96 +398,228 @@ class ShufflingLoader:
         encoded_tokens = jax.make_array_from_callback(shape, self.sharding, get_shard)
         return _decode(encoded_tokens)
 
+    def close(self):
+        """Shuts down the loader's thread pools. The loader can't be used afterwards."""
+        for pending in self.pending_shuffle_buffers_by_stream.values():
+            _discard_pending_shuffle_buffers(pending)
+        self.refill_executor.shutdown()
+        self.io_executor.shutdown()
+        self.cpu_executor.shutdown()
+
     def _get_shuffle_buffer(self, stream: int, minipoch: int) -> _ShuffleBuffer:
         if (
             self.shuffle_buffers_by_stream[stream] is None
             or self.shuffle_buffers_by_stream[stream].minipoch != minipoch
         ):
             self.shuffle_buffers_by_stream[stream] = None  # Free the underlying memory
-            blocks_in_shuffle_buffer = self.params.read_blocks_per_shuffle_buffer
-            if minipoch == self.minipoch_count - 1:
-                blocks_in_shuffle_buffer = (
-                    self.read_block_count // self.params.streams
-                ) - self.params.read_blocks_per_shuffle_buffer * minipoch
-            # We form a mapping:
-            #   (stream, minipoch, read_block_in_minipoch) -> sequential_read_block
-            # then we map
-            #   sequential_read_block -> shuffled_read_block
-            # using self.shuffled_read_blocks.
-            shuffled_read_block_indices = []
-            for read_block_in_minipoch in range(blocks_in_shuffle_buffer):
-                sequential_read_block = (
-                    minipoch * self.params.read_blocks_per_shuffle_buffer
-                    + read_block_in_minipoch
-                ) * self.params.streams + stream
-                shuffled_read_block = self.read_block_ordering[sequential_read_block]
-                shuffled_read_block_indices.append(shuffled_read_block)
-
-            # Now load all of the read blocks in parallel.
-            def load_read_block(read_block_index: int) -> u32["Buflen len"]:
-                start_seq = read_block_index * self.params.sequences_per_read_block
-                end_seq = start_seq + self.params.sequences_per_read_block
-                block_shape = (
-                    self.params.sequences_per_read_block,
-                    self.token_batch_params.len,
-                )
-                if self.params.sequence_packing:
-                    flat_tokens = self.encoded_tokens[
-                        start_seq
-                        * self.token_batch_params.len : end_seq
-                        * self.token_batch_params.len
-                    ]
-                    return flat_tokens.reshape(block_shape)
-                else:
-                    seq_starts = self.seq_starts[start_seq : end_seq + 1]
-                    flat_tokens = self.encoded_tokens[seq_starts[0] : seq_starts[-1]]
-                    # Read the ragged array into a (padded) dense array.
-                    #
-                    # We pad with 1s, which decode to (0, new_sequence=true).
-                    result = np.ones(block_shape, dtype=np.uint32)
-                    for i in range(self.params.sequences_per_read_block):
-                        start = seq_starts[i]
-                        end = seq_starts[i + 1]
-                        result[i, : end - start] = flat_tokens[start:end]
-                    return result
-
-            print(f"[{datetime.datetime.now()}] Loading shuffle buffer")
-            # Loading a read block is IO-dominated work, with very little CPU time involved, so we can afford
-            # to run a huge number of these in parallel with little concern about thrashing the CPU by having
-            # excessively many threads doing CPU-intensive work. At the recommended read block sizing of 1MiB,
-            # the memory footprint of a read block is typically bigger than the memory footprint of a CPU thread,
-            # so we're also unlikely to waste a significant fraction of memory by having too many threads. In
-            # net, allow a lot of threads, potentially way more than we have CPUs! Other overheads will
-            # bite us before thread overheads do.
-            with ThreadPoolExecutor(
-                max_workers=len(shuffled_read_block_indices)
-            ) as executor:
-                shuffled_read_blocks = list(
-                    executor.map(load_read_block, shuffled_read_block_indices)
+            pending = self.pending_shuffle_buffers_by_stream[stream]
+            if pending and pending[0][0] == minipoch:
+                _, future = pending.popleft()
+                shuffle_buffer = future.result()
+            else:
+                # Not the minipoch we prefetched, e.g. after a jump to another step.
+                _discard_pending_shuffle_buffers(pending)
+                shuffle_buffer = self._load_shuffle_buffer(stream, minipoch)
+            self.shuffle_buffers_by_stream[stream] = shuffle_buffer
+
+            # Load the next minipochs' shuffle buffers while this one serves batches.
+            next_minipoch = minipoch + 1 + len(pending)
+            while (
+                len(pending) + 1 < self.shuffle_buffers_per_stream
+                and next_minipoch < self.minipoch_count
+            ):
+                future = self.refill_executor.submit(
+                    self._load_shuffle_buffer, stream, next_minipoch
                 )
-            shuffle_buffer = np.concatenate(shuffled_read_blocks, axis=0)
-            print(
-                f"[{datetime.datetime.now()}] Finished loading shuffle buffer, {shuffle_buffer.size * 4:_} bytes"
-            )
-
-            # Actually shuffle it.
-            sequences_in_shuffle_buffer = (
-                blocks_in_shuffle_buffer * self.params.sequences_per_read_block
-            )
-            assert shuffle_buffer.shape == (
-                sequences_in_shuffle_buffer,
-                self.token_batch_params.len,
+                pending.append((next_minipoch, future))
+                next_minipoch += 1
+
+        return self.shuffle_buffers_by_stream[stream]
+
+    def _load_shuffle_buffer(self, stream: int, minipoch: int) -> _ShuffleBuffer:
+        blocks_in_shuffle_buffer = self.params.read_blocks_per_shuffle_buffer
+        if minipoch == self.minipoch_count - 1:
+            blocks_in_shuffle_buffer = (
+                self.read_block_count // self.params.streams
+            ) - self.params.read_blocks_per_shuffle_buffer * minipoch
+        # We form a mapping:
+        #   (stream, minipoch, read_block_in_minipoch) -> sequential_read_block
+        # then we map
+        #   sequential_read_block -> shuffled_read_block
+        # using self.shuffled_read_blocks.
+        shuffled_read_block_indices = []
+        for read_block_in_minipoch in range(blocks_in_shuffle_buffer):
+            sequential_read_block = (
+                minipoch * self.params.read_blocks_per_shuffle_buffer
+                + read_block_in_minipoch
+            ) * self.params.streams + stream
+            shuffled_read_block = self.read_block_ordering[sequential_read_block]
+            shuffled_read_block_indices.append(shuffled_read_block)
+
+        sequences_in_shuffle_buffer = (
+            blocks_in_shuffle_buffer * self.params.sequences_per_read_block
+        )
+        shuffle_seed = self.params.seed + 1 + minipoch * self.params.streams + stream
+        permutation = _random_permutation(shuffle_seed, sequences_in_shuffle_buffer)
+
+        # Now load all of the read blocks, sharing the fetch of any chunk they have in common.
+        print(f"[{datetime.datetime.now()}] Loading shuffle buffer")
+        start_time = time.time()
+        seq_len = self.token_batch_params.len
+        seq_ranges = [
+            (
+                read_block_index * self.params.sequences_per_read_block,
+                (read_block_index + 1) * self.params.sequences_per_read_block,
             )
-            shuffle_seed = (
-                self.params.seed + 1 + minipoch * self.params.streams + stream
+            for read_block_index in shuffled_read_block_indices
+        ]
+        if self.params.sequence_packing:
+            token_ranges = [
+                (start * seq_len, end * seq_len) for start, end in seq_ranges
+            ]
+            shuffled_read_blocks = [
+                flat_tokens.reshape(-1, seq_len)
+                for flat_tokens in self._read_ranges(self.encoded_tokens, token_ranges)
+            ]
+        else:
+            seq_starts_by_block = self._read_ranges(
+                self.seq_starts, [(start, end + 1) for start, end in seq_ranges]
             )
-            permutation = _random_permutation(shuffle_seed, sequences_in_shuffle_buffer)
-            shuffle_buffer = shuffle_buffer[permutation, :]
-            self.shuffle_buffers_by_stream[stream] = _ShuffleBuffer(
-                minipoch, shuffle_buffer
+            token_ranges = [
+                (int(seq_starts[0]), int(seq_starts[-1]))
+                for seq_starts in seq_starts_by_block
+            ]
+            flat_tokens_by_block = self._read_ranges(self.encoded_tokens, token_ranges)
+            shuffled_read_blocks = list(
+                self.cpu_executor.map(
+                    lambda flat_tokens, seq_starts: _ragged_to_dense(
+                        flat_tokens, seq_starts - seq_starts[0], seq_len
+                    ),
+                    flat_tokens_by_block,
+                    seq_starts_by_block,
+                )
             )
+        print(
+            f"[{datetime.datetime.now()}] Finished loading shuffle buffer, {sum(block.size for block in shuffled_read_blocks) * 4:_} bytes in {time.time() - start_time:.2f}s"
+        )
+        return _ShuffleBuffer(minipoch, shuffled_read_blocks, permutation)
+
+    def _read_ranges(
+        self, array: zarr.Array, ranges: List[Tuple[int, int]]
+    ) -> List[np.ndarray]:
+        """Reads `array[start:end]` for each `(start, end)` in `ranges`, from a 1D zarr array.
+
+        Unlike slicing the array once per range, this fetches and decompresses each chunk once,
+        however many of the ranges overlap it. The chunks are fetched in `_GETITEMS_PER_READ`
+        batches (fewer with fewer chunks or `max_io_threads`), each a single `getitems` call on
+        the store, which fsspec stores turn into many concurrent requests. Each chunk is
+        decompressed on the CPU pool as soon as its batch arrives, directly into the results.
+        """
+        (chunk_len,) = array.chunks
+        ranges_by_chunk = collections.defaultdict(list)
+        for range_index, (start, end) in enumerate(ranges):
+            for chunk_index in range(start // chunk_len, _div_up(end, chunk_len)):
+                ranges_by_chunk[chunk_index].append(range_index)
+        results = [np.empty(end - start, dtype=array.dtype) for start, end in ranges]
+
+        def fetch(chunk_indices: List[int]) -> List[Tuple[int, bytes]]:
+            keys = [_chunk_key(array, chunk_index) for chunk_index in chunk_indices]
+            cdatas = array.chunk_store.getitems(keys, contexts={})
+            # `getitems` leaves out the keys it failed to read, whether they're missing or hit
+            # e.g. a network error. Flat-tokens datasets have no missing chunks, so read each of
+            # those keys again on its own, which raises the error.
+            return [
+                (i, cdatas[key] if key in cdatas else array.chunk_store[key])
+                for i, key in zip(chunk_indices, keys)
+            ]
 
-        return self.shuffle_buffers_by_stream[stream].buffer
+        def decode(chunk_index: int, cdata: bytes):
+            chunk = _decode_chunk(array, cdata)
+            chunk_start = chunk_index * chunk_len
+            for range_index in ranges_by_chunk[chunk_index]:
+                start, end = ranges[range_index]
+                lo = max(start, chunk_start)
+                hi = min(end, chunk_start + chunk_len)
+                results[range_index][lo - start : hi - start] = chunk[
+                    lo - chunk_start : hi - chunk_start
+                ]
+
+        chunk_indices = sorted(ranges_by_chunk)
+        batch_size = max(
+            _div_up(len(chunk_indices), min(_GETITEMS_PER_READ, self.max_io_threads)),
+            1,
+        )
+        fetches = [
+            self.io_executor.submit(fetch, chunk_indices[i : i + batch_size])
+            for i in range(0, len(chunk_indices), batch_size)
+        ]
+        decodes = [
+            self.cpu_executor.submit(decode, chunk_index, cdata)
+            for fetched in as_completed(fetches)
+            for chunk_index, cdata in fetched.result()
+        ]
+        for decoded in decodes:
+            decoded.result()
+        return results
+
+
+# Number of `getitems` calls `ShufflingLoader._read_ranges` splits its chunks into. fsspec only
+# issues a call's keys as concurrent requests, so each call should get many keys; a few calls
+# still let chunks be decompressed while others are being fetched.
+_GETITEMS_PER_READ = 8
+
+
+def _discard_pending_shuffle_buffers(pending: collections.deque):
+    """Cancels the shuffle buffers being loaded in the background, waiting for any that have
+    started, so that their memory is freed before another buffer is loaded in their place.
+    """
+    while pending:
+        _, future = pending.popleft()
+        if not future.cancel():
+            future.exception()
+
+
+def _chunk_key(array: zarr.Array, chunk_index: int) -> str:
+    """Store key of chunk `chunk_index` of a 1D zarr array, per the zarr v2 spec."""
+    return f"{array.path}/{chunk_index}" if array.path else str(chunk_index)
+
+
+def _decode_chunk(array: zarr.Array, cdata: bytes) -> np.ndarray:
+    """Decompresses and unfilters a chunk of a 1D zarr array, per the zarr v2 spec."""
+    chunk = cdata if array.compressor is None else array.compressor.decode(cdata)
+    for codec in reversed(array.filters or []):
+        chunk = codec.decode(chunk)
+    return ensure_ndarray(chunk).view(array.dtype)
+
+
+def _ragged_to_dense(
+    flat_tokens: u32["Tokens"], offsets: np.ndarray, seq_len: int
+) -> u32["Seqs len"]:
+    """Reads the ragged array, with sequence `i` at `flat_tokens[offsets[i]:offsets[i + 1]]`,
+    into a dense array, truncating sequences to `seq_len`.
+
+    We pad with 1s, which decode to (0, new_sequence=true).
+    """
+    starts = offsets[:-1].astype(np.int64)
+    lengths = np.minimum(np.diff(offsets).astype(np.int64), seq_len)
+    if len(flat_tokens) < seq_len:
+        flat_tokens = np.concatenate(
+            [flat_tokens, np.ones(seq_len - len(flat_tokens), dtype=np.uint32)]
+        )
+    # Copy a full `seq_len` window for every sequence in one gather, then overwrite whatever
+    # follows the end of each sequence. The windows of the last few sequences would run past
+    # the end of `flat_tokens`, so those are copied one at a time instead.
+    last_window = len(flat_tokens) - seq_len
+    result = sliding_window_view(flat_tokens, seq_len)[np.minimum(starts, last_window)]
+    for i in np.flatnonzero(starts > last_window).tolist():
+        result[i, : lengths[i]] = flat_tokens[starts[i] : starts[i] + lengths[i]]
+    # Row `i` of the padding mask is `arange(seq_len) >= lengths[i]`, which is a window of
+    # `seq_len` zeros followed by `seq_len` ones. Gathering the rows is much cheaper than
+    # comparing every element.
+    steps = np.arange(2 * seq_len) >= seq_len
+    padding = sliding_window_view(steps, seq_len)[seq_len - lengths]
+    np.copyto(result, np.uint32(1), where=padding)
+    return result
 
 
 def _div_up(a: int, b: int) -> int:
@@ -308,7 +634,7 @@ def _div_exact(a: int, b: int) -> int:
 @functools.partial(jax.jit, donate_argnums=(0,))
 @typechecked
 @shardtypes.scope
-def _decode(encoded_tokens: u32[b"batch/d len"]) -> TokenBatch:
+def _decode(encoded_tokens: u32[b"batch/d len/s"]) -> TokenBatch:
     # encoded_tokens encoding:
     #  2*id+1 for the first token in a sequence
     #  2*id for other tokens in the sequence
@@ -324,21 +650,72 @@ def _random_permutation(seed: int, n: int) -> u32["N"]:
     # We do a Fisher-Yates shuffle using the Philox BitGenerator. Unlike the rest of np.random,
     # which is documented as potentially changing between numpy versions or even platforms on
     # the same version, the Philox BitGenerator is documented as stable. Likewise, we also promise
-    # not to change the following implementation of the Fisher-Yates shuffle.
+    # not to change the results of the following implementation of the Fisher-Yates shuffle:
+    #
+    #   result = np.arange(n)
+    #   for i in reversed(range(n)):
+    #       j = randoms[i]
+    #       result[i], result[j] = result[j], result[i]
     #
     # We calculate the random numbers using `random_uint64() % n` rather than using rejection
     # sampling to generate numbers in range `[0, n)`. (Rejection sampling is more complicated,
     # because we don't know up front how many random numbers we'll need.) Our approach
     # introduces some bias, but it's small: since n<2^32, the bias is at most 2^-32 for each
     # random number generated. We're fine with this.
-    randoms = np.random.Philox(seed).random_raw(n) % (np.arange(n, dtype=np.uint64) + 1)
-    result = np.arange(n, dtype=np.uint32)
-    for i in reversed(range(n)):
-        j = randoms[i]
-        tmp = result[i]
-        result[i] = result[j]
-        result[j] = tmp
-    return result
+    randoms = np.empty(n, dtype=np.uint32)
+    bit_generator = np.random.Philox(seed)
+    for start in range(0, n, _PERMUTATION_CHUNK):
+        stop = min(n, start + _PERMUTATION_CHUNK)
+        randoms[start:stop] = bit_generator.random_raw(stop - start) % np.arange(
+            start + 1, stop + 1, dtype=np.uint64
+        )
+    if n == 0:
+        return randoms
+
+    # The loop is sequential, so instead of running it we compute its result with whole-array
+    # operations. Swap `i` is the last to touch position `i`, so `result[i]` is what position
+    # `randoms[i]` holds just before swap `i`. Consider the swaps targeting a position `p`, in
+    # the loop's order `k_1 > k_2 > ...`. Swap `k_1` moves the original `p` to `k_1`, and each
+    # later swap `k_s` receives what `k_{s-1}` brought: the value position `k_{s-1}` held just
+    # before swap `k_{s-1}`. Call that `held[k]`. By the same argument, `held[k]` is `k` if no
+    # swap after it targets `k`, and otherwise `held` of the last such swap.
+    #
+    # Group the swaps by target, in increasing order within each group. Sorting keys that pack
+    # (target, swap) into a uint64 is much faster than a stable argsort.
+    indices = np.arange(n, dtype=np.uint32)
+    keys = randoms.astype(np.uint64) << np.uint64(32)
+    keys |= indices
+    keys.sort()
+    order = (keys & np.uint64(0xFFFFFFFF)).astype(np.uint32)
+    targets = (keys >> np.uint64(32)).astype(np.uint32)
+    del keys
+    same_target = targets[1:] == targets[:-1]
+    # `prev_swap[k]`: the swap with the same target that the loop runs just before `k`, or `n`.
+    prev_swap = np.full(n, n, dtype=np.uint32)
+    prev_swap[order[:-1][same_target]] = order[1:][same_target]
+    # `last_swap[p]`: of the swaps targeting `p`, other than `p`'s own, the one the loop runs
+    # last, or `n`.
+    is_first = np.concatenate([[True], ~same_target])
+    last_swap = np.full(n, n, dtype=np.uint32)
+    last_swap[targets[is_first]] = order[is_first]
+    del order, targets, same_target, is_first
+    last_swap = np.where(randoms == indices, prev_swap, last_swap)
+
+    # `held[k] = held[last_swap[k]]`, along chains of increasing `k`: follow them by pointer
+    # jumping, doubling the distance covered each round, for the chains not yet at their end.
+    held = np.where(last_swap < n, last_swap, indices)
+    del last_swap
+    active = np.flatnonzero(held[held] != held)
+    while active.size:
+        held[active] = held[held[active]]
+        active = active[held[held[active]] != held[active]]
+    has_prev = prev_swap < n
+    return np.where(has_prev, held[np.where(has_prev, prev_swap, 0)], randoms)
+
+
+# Random numbers for `_random_permutation` are drawn in chunks of this many, to bound the
+# memory of their uint64 intermediates.
+_PERMUTATION_CHUNK = 1 << 24
 
 
 @dataclass(frozen=True)
@@ -589,12 +966,83 @@ def get_loader(
     split: str,
     config: Union[FlatTokensParams, HuggingFaceDataParams, LongCrawl64Params],
     token_batch_params: TokenBatchParams,
+    max_io_threads: int = 1024,
 ):
     if isinstance(config, FlatTokensParams):
-        return ShufflingLoader(split, config, token_batch_params)
+        return ShufflingLoader(split, config, token_batch_params, max_io_threads)
     elif isinstance(config, HuggingFaceDataParams):
         return HuggingFaceDataLoader(split, config, token_batch_params)
     elif isinstance(config, LongCrawl64Params):
         return LongCrawl64Dataloader(split, config, token_batch_params)
     else:
         raise ValueError(f"Unknown config type {type(config)}")
+
+
+class PrefetchingLoader:
+    """Wraps a loader from `get_loader`, loading the batches of the next `prefetch` steps on a
+    background thread, so that training doesn't wait for host-side work or the transfer to
+    devices.
+
+    Batches are loaded in order of increasing step from the requested step, so each step gets
+    the same batch as from the wrapped loader. Requesting a step out of order, including the
+    last step again, discards the prefetched batches and restarts from it, so callers should
+    load each step once. With `prefetch=0`, batches are loaded synchronously.
+
+    `blocked_seconds` accumulates the time `load` spends waiting for data.
+    """
+
+    def __init__(self, loader, prefetch: int):
+        self.loader = loader
+        self.max_token_id = loader.max_token_id
+        self.prefetch = prefetch
+        self.blocked_seconds = 0.0
+        # The worker thread needs the mesh context that loaders build their shardings in.
+        self._mesh = jax._src.mesh.thread_resources.env.physical_mesh
+        self._executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        self._pending = collections.deque()  # (step, future), in order of step
+        self._next_step = None
+
+    def load(self, step: int) -> TokenBatch:
+        start = time.time()
+        if not self.prefetch:
+            batch = self.loader.load(step)
+        else:
+            if not self._pending or self._pending[0][0] != step:
+                self._discard_pending()
+                self._next_step = step
+                self._fill()
+            _, future = self._pending.popleft()
+            self._fill()
+            batch = future.result()
+        self.blocked_seconds += time.time() - start
+        return batch
+
+    def pop_blocked_seconds(self) -> float:
+        """Returns `blocked_seconds` and resets it to 0."""
+        blocked_seconds, self.blocked_seconds = self.blocked_seconds, 0.0
+        return blocked_seconds
+
+    def close(self):
+        """Stops prefetching, and closes the wrapped loader if it has a `close` method."""
+        self._discard_pending()
+        if self._executor is not None:
+            self._executor.shutdown()
+        if hasattr(self.loader, "close"):
+            self.loader.close()
+
+    def _fill(self):
+        while len(self._pending) < self.prefetch:
+            future = self._executor.submit(self._load_ready, self._next_step)
+            self._pending.append((self._next_step, future))
+            self._next_step += 1
+
+    def _load_ready(self, step: int) -> TokenBatch:
+        with self._mesh:
+            return jax.block_until_ready(self.loader.load(step))
+
+    def _discard_pending(self):
+        while self._pending:
+            _, future = self._pending.popleft()
+            if not future.cancel():
+                # Let it finish, so that the wrapped loader only runs one load at a time.
+                future.exception()
@@ -0,0 +1,249 @@
+"""Benchmarks the host-side work of `input_loader`.
+
+Times `_random_permutation` for sizes up to `2**max_log2_n`, and checks it against the
+sequential Fisher-Yates loop whose results it promises to keep, for sizes up to
+`2**reference_max_log2_n` (the loop takes about a microsecond per element). At the recommended
+settings, shuffle buffers permute millions of sequences.
+
+Also times `_ragged_to_dense`, which decodes the read blocks of a shuffle buffer without
+sequence packing, against a per-sequence loop, on `read_blocks` blocks of random-length
+sequences. At the recommended settings, a shuffle buffer has 1024 blocks of 1024 sequences.
+
+With `--filespec`, also times loading the first shuffle buffer of that flat-tokens dataset, e.g. a
+`gs://` bucket, against the previous approach of slicing the zarr array once per read block, each
+on its own thread. Each is timed twice, in both orders. Without `--sequence_packing`, also times
+the refill with `_ragged_to_dense` replaced by the per-sequence loop. For a local dataset, its
+files are first dropped from the OS page cache, so that neither gets the other's reads for free.
+
+Command to run on your CPU (`--max_log2_n=30` needs tens of GiB of memory):
+  python -m input_loader_benchmark --max_log2_n=24
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import unittest.mock
+
+import fsspec
+
+import jax
+from jax.sharding import Mesh
+import numpy as np
+
+import input_loader
+from input_loader import (
+    FlatTokensParams,
+    ShufflingLoader,
+    TokenBatchParams,
+    _ragged_to_dense,
+    _random_permutation,
+)
+
+
+def reference_random_permutation(seed: int, n: int) -> np.ndarray:
+    """The Fisher-Yates loop that `_random_permutation` must match."""
+    randoms = np.random.Philox(seed).random_raw(n) % (np.arange(n, dtype=np.uint64) + 1)
+    result = np.arange(n, dtype=np.uint32)
+    for i in reversed(range(n)):
+        j = randoms[i]
+        tmp = result[i]
+        result[i] = result[j]
+        result[j] = tmp
+    return result
+
+
+def reference_ragged_to_dense(
+    flat_tokens: np.ndarray, offsets: np.ndarray, seq_len: int
+) -> np.ndarray:
+    """`_ragged_to_dense`, one sequence at a time."""
+    result = np.ones((len(offsets) - 1, seq_len), dtype=np.uint32)
+    for i in range(len(offsets) - 1):
+        start = int(offsets[i])
+        end = min(int(offsets[i + 1]), start + seq_len)
+        result[i, : end - start] = flat_tokens[start:end]
+    return result
+
+
+def reference_load_read_blocks(loader: ShufflingLoader, read_block_indices):
+    """`ShufflingLoader` before it batched chunk fetches: slices the zarr arrays once per read
+    block, each on its own thread."""
+    sequences = loader.params.sequences_per_read_block
+    seq_len = loader.token_batch_params.len
+
+    def load_read_block(read_block_index):
+        start_seq = read_block_index * sequences
+        end_seq = start_seq + sequences
+        if loader.params.sequence_packing:
+            flat_tokens = loader.encoded_tokens[start_seq * seq_len : end_seq * seq_len]
+            return flat_tokens.reshape(sequences, seq_len)
+        seq_starts = loader.seq_starts[start_seq : end_seq + 1]
+        flat_tokens = loader.encoded_tokens[seq_starts[0] : seq_starts[-1]]
+        return _ragged_to_dense(flat_tokens, seq_starts - seq_starts[0], seq_len)
+
+    with ThreadPoolExecutor(max_workers=len(read_block_indices)) as executor:
+        return list(executor.map(load_read_block, read_block_indices))
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+def benchmark_random_permutation(max_log2_n: int, reference_max_log2_n: int):
+    for seed, n in [(seed, n) for seed in range(3) for n in range(100)]:
+        assert np.array_equal(
+            _random_permutation(seed, n), reference_random_permutation(seed, n)
+        ), f"Mismatch at seed {seed}, n {n}"
+    for log2_n in range(10, max_log2_n + 1, 2):
+        n = 1 << log2_n
+        seed = log2_n
+        result, seconds = timed(_random_permutation, seed, n)
+        line = f"_random_permutation n=2^{log2_n}: {seconds:.3f}s"
+        if log2_n <= reference_max_log2_n:
+            expected, reference_seconds = timed(reference_random_permutation, seed, n)
+            assert np.array_equal(result, expected), f"Mismatch at n=2^{log2_n}"
+            line += (
+                f", loop {reference_seconds:.3f}s ({reference_seconds / seconds:.1f}x)"
+            )
+        print(line)
+
+
+def benchmark_ragged_to_dense(
+    sequences_per_read_block: int, seq_len: int, read_blocks: int
+):
+    rng = np.random.default_rng(0)
+    blocks = []
+    for _ in range(read_blocks):
+        # Lengths from 1 to 2 * seq_len, so that about half of the sequences are truncated.
+        lengths = rng.integers(1, 2 * seq_len + 1, sequences_per_read_block)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.uint64)
+        flat_tokens = rng.integers(0, 1 << 32, int(offsets[-1]), dtype=np.uint32)
+        blocks.append((flat_tokens, offsets))
+    seconds = reference_seconds = 0.0
+    for flat_tokens, offsets in blocks:
+        result, block_seconds = timed(_ragged_to_dense, flat_tokens, offsets, seq_len)
+        expected, block_reference_seconds = timed(
+            reference_ragged_to_dense, flat_tokens, offsets, seq_len
+        )
+        assert np.array_equal(result, expected), "Mismatch in _ragged_to_dense"
+        seconds += block_seconds
+        reference_seconds += block_reference_seconds
+    print(
+        f"_ragged_to_dense {read_blocks} blocks of {sequences_per_read_block}x{seq_len}: "
+        f"{seconds:.3f}s, loop {reference_seconds:.3f}s ({reference_seconds / seconds:.1f}x)"
+    )
+
+
+def benchmark_shuffle_buffer(
+    filespec: str,
+    sequence_packing: bool,
+    seq_len: int,
+    sequences_per_read_block: int,
+    read_blocks_per_shuffle_buffer: int,
+    max_io_threads: int,
+):
+    params = FlatTokensParams(
+        filespec=filespec,
+        streams=1,
+        read_blocks_per_shuffle_buffer=read_blocks_per_shuffle_buffer,
+        sequences_per_read_block=sequences_per_read_block,
+        seed=0,
+        sequence_packing=sequence_packing,
+    )
+    devices = np.array(jax.devices()).reshape(1, -1, 1, 1)
+    with Mesh(devices, ("p", "d", "s", "t")):
+        loader = ShufflingLoader(
+            "train",
+            params,
+            TokenBatchParams(batch=devices.size, len=seq_len),
+            max_io_threads,
+        )
+    read_block_indices = loader.read_block_ordering[
+        : min(read_blocks_per_shuffle_buffer, loader.read_block_count)
+    ]
+
+    def load():
+        return loader._load_shuffle_buffer(0, 0).read_blocks
+
+    def reference_load():
+        return reference_load_read_blocks(loader, read_block_indices)
+
+    for first, second in [(reference_load, load), (load, reference_load)]:
+        seconds = {}
+        for f in [first, second]:
+            drop_page_cache(filespec)
+            blocks, seconds[f] = timed(f)
+            if f is reference_load:
+                expected = blocks
+            else:
+                shuffle_buffer = blocks
+        assert all(
+            np.array_equal(block, expected_block)
+            for block, expected_block in zip(shuffle_buffer, expected)
+        ), "Mismatch in shuffle buffer"
+        print(
+            f"Shuffle buffer of {len(read_block_indices)} read blocks from {filespec}, "
+            f"{'one slice per read block' if first is reference_load else 'batched'} first: "
+            f"batched {seconds[load]:.3f}s, one slice per read block "
+            f"{seconds[reference_load]:.3f}s ({seconds[reference_load] / seconds[load]:.1f}x)"
+        )
+    if not sequence_packing:
+        # The same refill, decoding its read blocks one sequence at a time.
+        for _ in range(2):
+            drop_page_cache(filespec)
+            _, seconds = timed(load)
+            drop_page_cache(filespec)
+            with unittest.mock.patch.object(
+                input_loader, "_ragged_to_dense", reference_ragged_to_dense
+            ):
+                _, loop_seconds = timed(load)
+            print(
+                f"Shuffle buffer refill: {seconds:.3f}s, decoding with the per-sequence loop "
+                f"{loop_seconds:.3f}s ({loop_seconds / seconds:.2f}x)"
+            )
+    loader.close()
+
+
+def drop_page_cache(filespec: str):
+    """Asks the OS to drop its cached pages of a local dataset's files. No-op for remote ones."""
+    fs, path = fsspec.core.url_to_fs(filespec)
+    if fs.protocol[0] != "file":
+        return
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            fd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--max_log2_n", type=int, default=24)
+    parser.add_argument("--reference_max_log2_n", type=int, default=20)
+    parser.add_argument("--sequences_per_read_block", type=int, default=1024)
+    parser.add_argument("--len", type=int, default=1024)
+    parser.add_argument("--read_blocks", type=int, default=16)
+    parser.add_argument("--filespec", type=str, default=None)
+    parser.add_argument("--sequence_packing", action="store_true")
+    parser.add_argument("--read_blocks_per_shuffle_buffer", type=int, default=1024)
+    parser.add_argument("--max_io_threads", type=int, default=1024)
+    args = parser.parse_args()
+    benchmark_random_permutation(args.max_log2_n, args.reference_max_log2_n)
+    benchmark_ragged_to_dense(args.sequences_per_read_block, args.len, args.read_blocks)
+    if args.filespec is not None:
+        benchmark_shuffle_buffer(
+            args.filespec,
+            args.sequence_packing,
+            args.len,
+            args.sequences_per_read_block,
+            args.read_blocks_per_shuffle_buffer,
+            args.max_io_threads,
+        )
+
+
+if __name__ == "__main__":
+    main()
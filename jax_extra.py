@@ -65,7 +65,45 @@ def make_dataclass_from_dict(cls, data):
     return cls(**field_data)
 
 
-def explicit_activation_checkpointing(f):
+_SAVE_FOR_BACKWARD = "seqax_save_for_backward"
+
+# Remat policies for `explicit_activation_checkpointing`:
+# * "tagged": save every value passed to `save_for_backward()`.
+# * "nothing": save nothing; recompute the whole function in the backwards pass.
+# * "qkv": save only values passed as `save_for_backward(x, "q" | "k" | "v")`.
+# * "everything": save every intermediate, i.e. no rematerialization.
+# * "offload": like "tagged", but the saved values live in host memory until the backwards pass.
+REMAT_POLICIES = ("tagged", "nothing", "qkv", "everything", "offload")
+
+
+def _save_name(kind=None) -> str:
+    return _SAVE_FOR_BACKWARD if kind is None else f"{_SAVE_FOR_BACKWARD}_{kind}"
+
+
+def remat_policy(name: str):
+    """Returns the `jax.checkpoint` policy for one of `REMAT_POLICIES`."""
+    policies = jax.checkpoint_policies
+    qkv = [_save_name(kind) for kind in ("q", "k", "v")]
+    if name == "tagged":
+        # We save everything that is named.
+        return policies.save_any_names_but_these()
+    elif name == "nothing":
+        return policies.nothing_saveable
+    elif name == "qkv":
+        return policies.save_only_these_names(*qkv)
+    elif name == "everything":
+        return policies.everything_saveable
+    elif name == "offload":
+        return policies.save_and_offload_only_these_names(
+            names_which_can_be_saved=[],
+            names_which_can_be_offloaded=[_save_name()] + qkv,
+            offload_src="device",
+            offload_dst="pinned_host",
+        )
+    raise ValueError(f"Unknown remat policy {name}; expected one of {REMAT_POLICIES}.")
+
+
+def explicit_activation_checkpointing(f, policy: str = "tagged"):
     """Annotates a function f to be used with save_for_backward().
 
     Example:
@@ -78,16 +116,36 @@ def explicit_activation_checkpointing(f):
       x = W3 @ x
     ```
 
-    This causes the pre-ReLU activations to be saved for the backwards pass.
+    This causes the pre-ReLU activations to be saved for the backwards pass. Pass `policy`
+    (see `REMAT_POLICIES`) to save more or less than that.
     """
-    # We save everything that is named.
-    return jax.ad_checkpoint.checkpoint(
-        f, policy=jax.checkpoint_policies.save_any_names_but_these()
-    )
+    return jax.ad_checkpoint.checkpoint(f, policy=remat_policy(policy))
+
 
+def save_for_backward(x, kind=None):
+    """Saves a value for the backwards pass in a function annotated with explicit_activation_checkpointing().
 
-def save_for_backward(x):
-    """Saves a value for the backwards pass in a function annotated with explicit_activation_checkpointing()."""
+    `kind` optionally names the value, for remat policies that save only some kinds.
+    """
     # The actual name isn't important, just the fact that it _is_ named, so that
     # the save_any_names_but_these() policy causes it to be saved.
-    return jax.ad_checkpoint.checkpoint_name(x, name="seqax_save_for_backward")
+    return jax.ad_checkpoint.checkpoint_name(x, name=_save_name(kind))
+
+
+def hoist_closure(f, *args):
+    """Like `jax.closure_convert`, but hoists every traced value `f` closes over rather than
+    only the floating-point ones.
+
+    Returns `(converted, consts)`, where `converted(*args, *consts)` computes `f(*args)`, so
+    that `f` can be used in a `jax.custom_vjp` that is itself traced inside, e.g., a scan.
+    """
+    closed, out_shape = jax.make_jaxpr(f, return_shape=True)(*args)
+    out_tree = jax.tree.structure(out_shape)
+    num_args = len(args)
+
+    def converted(*args_and_consts):
+        args, consts = args_and_consts[:num_args], args_and_consts[num_args:]
+        outs = jax.core.eval_jaxpr(closed.jaxpr, consts, *jax.tree.leaves(args))
+        return jax.tree.unflatten(out_tree, outs)
+
+    return converted, closed.consts
@@ -0,0 +1,93 @@
+"""Compares KV cache storage formats on a training checkpoint.
+
+For each `model.kv_cache_dtype`, prefills the same validation prompts and then decodes the
+following validation tokens (teacher-forced, so every format sees identical inputs). Reports
+KV cache bytes per token and the error of the next-token logits against the bf16 cache.
+
+Command to run on your CPU, after training with `local_test_synthetic`:
+  XLA_FLAGS=--xla_force_host_platform_device_count=8 python -m kv_cache_benchmark --config-name=local_test_synthetic +paths.model_name=synthetic_000
+"""
+
+import os
+from dataclasses import replace
+from typing import Tuple
+
+import hydra
+import jax
+import numpy as np
+
+import jax_extra
+import training_io
+from generate import (
+    GenerateConfig,
+    decode_step,
+    kv_cache_bytes,
+    load_prompts,
+    load_weights,
+    prefill,
+)
+from train import Config, make_mesh
+
+KV_CACHE_DTYPES = ["bfloat16", "int8"]
+
+
+def decode_logits(weights, h, ids, prompt_len: int) -> Tuple[np.ndarray, int]:
+    """Decodes teacher-forced, returning the logits after each position in
+    `[prompt_len - 1, len)` and the KV cache's size in bytes."""
+    max_len = ids.shape[1]
+    logits, cache = prefill(weights, h, ids[:, :prompt_len], max_len)
+    all_logits = [np.asarray(logits)]
+    for i in range(prompt_len, max_len):
+        logits, cache = decode_step(weights, h, cache, ids[:, i])
+        all_logits.append(np.asarray(logits))
+    return np.stack(all_logits, axis=1), kv_cache_bytes(cache)
+
+
+def main_contained(config: Config, gen: GenerateConfig):
+    jax.config.update("jax_threefry_partitionable", True)
+    batch_size = gen.batch or config.training.tokens.batch
+    prompt_len = gen.prompt_len or config.training.tokens.len // 2
+    max_len = prompt_len + (
+        gen.max_new_tokens or config.training.tokens.len - prompt_len
+    )
+
+    with make_mesh(config.mesh):
+        model_dir = os.path.join(config.paths.root_working_dir, config.paths.model_name)
+        weights = load_weights(model_dir, config.model, config.io)
+        ids = load_prompts(config, batch_size, max_len)
+
+        results = {}
+        for kv_cache_dtype in KV_CACHE_DTYPES:
+            h = replace(config.model, kv_cache_dtype=kv_cache_dtype)
+            results[kv_cache_dtype] = decode_logits(weights, h, ids, prompt_len)
+
+        if training_io.is_device_0():
+            reference, reference_bytes = results["bfloat16"]
+            print(f"Batch {batch_size}, prompt {prompt_len}, max_len {max_len}")
+            for kv_cache_dtype, (logits, cache_bytes) in results.items():
+                error = np.abs(logits - reference)
+                top1 = np.mean(
+                    np.argmax(logits, axis=-1) == np.argmax(reference, axis=-1)
+                )
+                print(
+                    f"{kv_cache_dtype:>9}: "
+                    f"{cache_bytes / (batch_size * max_len):.1f} bytes/token "
+                    f"({cache_bytes / reference_bytes:.3f}x bf16), "
+                    f"logit error max {error.max():.4f} mean {error.mean():.5f}, "
+                    f"top-1 agreement {top1:.4f}"
+                )
+
+
+@hydra.main(config_path="configs", version_base=None)
+def main(config):
+    gen = jax_extra.make_dataclass_from_dict(
+        GenerateConfig, config.get("generate") or {}
+    )
+    config = jax_extra.make_dataclass_from_dict(Config, config)
+    if not config.paths.model_name:
+        raise ValueError("Set paths.model_name to the model to benchmark.")
+    main_contained(config, gen)
+
+
+if __name__ == "__main__":
+    main()
@@ -56,6 +56,44 @@ def psum_scatter(spec: str, x):
     return x
 
 
+def all_to_all(spec: str, x):
+    """String-specified all-to-all operation, which moves sharding from one dimension to
+    another.
+
+    For example:
+      all_to_all('A B/x C -> A/x B C', x)
+
+    Each chip splits its `A` into pieces, sends the i-th piece to the i-th chip along `x`,
+    and concatenates the pieces it receives along `B`.
+    """
+    before, after = spec.split("->")
+    before = shardtypes.ShapeSpec.parse(before)
+    after = shardtypes.ShapeSpec.parse(after)
+    shardtypes.check(x.dtype, before, x)
+    split_axis, concat_axis = None, None
+    for i, (before_dim, after_dim) in enumerate(zip(before.dims, after.dims)):
+        before_n, after_n = len(before_dim.sharding), len(after_dim.sharding)
+        if before_dim.shape != after_dim.shape:
+            raise ValueError(f"Cannot all-to-all {before_dim} into {after_dim}")
+        if before_dim.sharding == after_dim.sharding:
+            continue
+        if split_axis is None and after_dim.sharding[:before_n] == before_dim.sharding:
+            split_axis, split_axes = i, after_dim.sharding[before_n:]
+        elif (
+            concat_axis is None and before_dim.sharding[:after_n] == after_dim.sharding
+        ):
+            concat_axis, concat_axes = i, before_dim.sharding[after_n:]
+        else:
+            raise ValueError(f"Cannot all-to-all {before_dim} into {after_dim}")
+    if split_axis is None or concat_axis is None or split_axes != concat_axes:
+        raise ValueError(f"Cannot all-to-all {before} into {after}")
+    x = lax.all_to_all(
+        x, tuple(split_axes), split_axis=split_axis, concat_axis=concat_axis, tiled=True
+    )
+    shardtypes.check(x.dtype, after, x)
+    return x
+
+
 def einsum_unreduced(spec: str, x, y, **kwargs):
     """Ordinary chip-local einsum, but with sharding-aware typechecking.
 
@@ -219,3 +257,18 @@ def pmean_across_replicas(pspec: jax.sharding.PartitionSpec, x):
 def axis_size(name: str) -> int:
     """Return the size of the axis with the given name."""
     return jax.lax.psum(1, name)
+
+
+def shift(axis: str, x, offset: int = 1, wrap: bool = False):
+    """Sends `x` from the chip at index `i` along mesh `axis` to the chip at `i + offset`.
+
+    Chips with no sender, e.g. the first `offset` chips for positive `offset`, receive zeros.
+    This is the point-to-point transfer between neighbouring pipeline stages. With `wrap`,
+    indices are taken modulo the axis size instead, so that the chips form a ring.
+    """
+    n = axis_size(axis)
+    if wrap:
+        perm = [(i, (i + offset) % n) for i in range(n)]
+    else:
+        perm = [(i, i + offset) for i in range(n) if 0 <= i + offset < n]
+    return lax.ppermute(x, axis, perm)
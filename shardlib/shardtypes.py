@@ -348,6 +348,29 @@ class Array:
             return GenericAlias(number_type, extended_shape)
 
 
+def map_array_types(f, cls):
+    """Rebuilds the `pytree_dataclass` `cls`, replacing each array type by
+    `f(name, number_type, shape_spec)`, where `name` is the name of the field holding it.
+    Nested dataclasses are rebuilt recursively.
+
+    For example, `map_array_types(lambda name, t, shape: bf16[str(shape)], cls)` is `cls`
+    with every array stored as bf16.
+    """
+    if dataclasses.is_dataclass(cls):
+        mapped_fields = []
+        for fld in dataclasses.fields(cls):
+            if dataclasses.is_dataclass(fld.type):
+                mapped_type = map_array_types(f, fld.type)
+            else:
+                number_type, shape = get_origin(fld.type), get_args(fld.type)
+                mapped_type = f(fld.name, number_type, ShapeSpec.parse(shape[0]))
+            mapped_fields.append((fld.name, mapped_type))
+        mapped_cls = make_dataclass(cls.__name__, mapped_fields)
+        pytree_dataclass(mapped_cls)
+        return mapped_cls
+    raise ValueError(f"Unsupported type {cls} is not a dataclass type")
+
+
 def make_partition_specs(cls):
     """Instantiates a pytree dataclass with a PartitionSpec at array type."""
     # Check for a tuple type:
@@ -371,6 +394,14 @@ def make_partition_specs(cls):
     raise ValueError(f"Unsupported type {cls} is not a array, dataclass, or tuple type")
 
 
+def make_shape_specs(cls):
+    """Instantiates a pytree dataclass with its parsed `ShapeSpec` at array type."""
+    if dataclasses.is_dataclass(cls):
+        return cls(*(make_shape_specs(field.type) for field in dataclasses.fields(cls)))
+    args = typing.get_args(cls)
+    return ShapeSpec.parse(args[0])
+
+
 def make_shardings(cls):
     """Instantiates a pytree dataclass with NamedSharding at array type."""
     mesh = jax._src.mesh.thread_resources.env.physical_mesh
@@ -16,11 +16,11 @@ shardtypes.register_with_typeguard()
 import gcsfs  # Needed for clearml setup
 
 import datetime
-from functools import cached_property, partial
+from functools import cache, cached_property, partial
 from typing import Any, Optional, Tuple, Union
 import hydra
 from typeguard import typechecked
-from dataclasses import dataclass, replace
+from dataclasses import dataclass, make_dataclass, replace
 import jax
 from jax import lax
 from jax.sharding import PartitionSpec
@@ -30,6 +30,7 @@ from input_loader import (
     FlatTokensParams,
     HuggingFaceDataParams,
     LongCrawl64Params,
+    PrefetchingLoader,
     TokenBatch,
     TokenBatchParams,
     get_loader,
@@ -38,6 +39,8 @@ from shardlib.shardtypes import (
     bf16,
     bool_,
     f32,
+    i8,
+    i32,
     pytree_dataclass,
     u32,
     make_shardings,
@@ -48,7 +51,12 @@ import shardlib.shardops as shardops
 P = PartitionSpec
 import einops
 import jax_extra
-from jax_extra import fold_in_str, explicit_activation_checkpointing, save_for_backward
+from jax_extra import (
+    fold_in_str,
+    explicit_activation_checkpointing,
+    hoist_closure,
+    save_for_backward,
+)
 import os
 import training_io
 from clearml import Task
@@ -96,6 +104,166 @@ class Hparams:
     gamma_hidden: float
     gamma_unembed: float
 
+    # Attention implementation. "dense" (the default) materializes the full
+    # B x L x L x Q x K logits tensor. "blockwise" tiles over query/key blocks of
+    # `attention_block_size` tokens with an online softmax, so peak attention
+    # memory is O(L * attention_block_size) rather than O(L^2). "block_sparse" is
+    # "blockwise", but skips tiles that are entirely above the causal diagonal or
+    # that pair different packed documents.
+    attention: Optional[str] = None
+    attention_block_size: Optional[int] = None
+
+    # If set, `Model.loss` computes the output projection and cross-entropy in chunks of
+    # this many tokens along the sequence, rematerializing each chunk's logits in the
+    # backward pass, so the full `B L V` f32 logits tensor is never live. Must be a
+    # multiple of the `t` mesh size.
+    loss_chunk_size: Optional[int] = None
+
+    # If set, attention only sees the `attention_window` most recent positions (including the
+    # current one). The blockwise implementations then only visit the band of tiles near the
+    # diagonal, so cost is O(L * attention_window). If `global_attention_every` is also set,
+    # every `global_attention_every`-th layer (counting from 1) keeps full causal attention.
+    # When every layer is windowed, the decode-time KV cache holds only `attention_window`
+    # positions.
+    attention_window: Optional[int] = None
+    global_attention_every: Optional[int] = None
+
+    # Which activations of each transformer block are kept for the backward pass, rather
+    # than recomputed: one of `jax_extra.REMAT_POLICIES`. Defaults to "tagged", which keeps
+    # everything passed to `save_for_backward`.
+    remat_policy: Optional[str] = None
+
+    # If true, the transformer-block scan all-gathers layer i+1's weights while layer i
+    # computes, carrying them in the scan carry, so the FSDP all_gathers aren't exposed
+    # behind the compute that needs them. Costs memory: one extra layer of gathered weights
+    # is live. The backward pass keeps only each block's input, re-gathers the block's
+    # weights and recomputes it, as with `remat_policy: nothing`, which is the only policy
+    # it supports.
+    prefetch_weights: Optional[bool] = None
+
+    # With a pipeline-parallel mesh (`mesh.p > 1`), the number of microbatches each chip's
+    # batch shard is split into for the GPipe schedule. Defaults to `mesh.p`. More
+    # microbatches shrink the pipeline bubble, at the cost of smaller per-stage matmuls.
+    pipeline_microbatches: Optional[int] = None
+
+    # If set, every FFN is a mixture of this many SwiGLU experts, sharded over the `d` mesh
+    # axis (which must divide it). Each token is routed to its `moe_top_k` (default 2)
+    # highest-scoring experts, each `d_ff / moe_top_k` wide, so per-token FLOPs match the
+    # dense FFN while FFN parameters grow `moe_experts / moe_top_k`-fold. Each expert takes at
+    # most `moe_capacity_factor` (default 1.25) times its even share of each chip's tokens;
+    # the rest skip the FFN. `moe_aux_loss_weight` (default 0.01) weights the load-balancing
+    # loss added to the training loss. Training only; not with pipeline parallelism.
+    moe_experts: Optional[int] = None
+    moe_top_k: Optional[int] = None
+    moe_capacity_factor: Optional[float] = None
+    moe_aux_loss_weight: Optional[float] = None
+
+    # Storage for the decode-time KV cache: "bfloat16" (the default) or "int8", which stores
+    # keys and values as int8 with a bf16 scale per (position, kv head).
+    kv_cache_dtype: Optional[str] = None
+
+
+def get_attention_block_size(h: Hparams, L: int) -> int:
+    block_size = min(h.attention_block_size or 512, L)
+    assert (
+        L % block_size == 0
+    ), f"Sequence length {L} must be a multiple of attention_block_size {block_size}."
+    return block_size
+
+
+def is_global_attention_layer(h: Hparams, layer_index):
+    """Whether a (possibly traced) layer index uses full causal attention."""
+    if h.attention_window is None:
+        return True
+    if h.global_attention_every is None:
+        return False
+    return (layer_index + 1) % h.global_attention_every == 0
+
+
+def get_remat_policy(h: Hparams) -> str:
+    """The remat policy the transformer blocks run with: `remat_policy`, which with
+    `prefetch_weights` can only be "nothing", and with "offload" needs devices with pinned
+    host memory."""
+    if not h.prefetch_weights:
+        policy = h.remat_policy or "tagged"
+        if policy == "offload":
+            kinds = {m.kind for m in jax.devices()[0].addressable_memories()}
+            if "pinned_host" not in kinds:
+                # Otherwise XLA silently keeps the offloaded values on the device, as with
+                # "tagged".
+                raise ValueError(
+                    f"remat_policy 'offload' needs devices with 'pinned_host' memory, but "
+                    f"{jax.devices()[0].platform} devices only have {sorted(kinds)}."
+                )
+        return policy
+    if (h.remat_policy or "nothing") != "nothing":
+        raise ValueError(
+            f"prefetch_weights recomputes each block in the backward pass, so it only "
+            f"supports remat_policy 'nothing', not {h.remat_policy!r}."
+        )
+    return "nothing"
+
+
+def get_pipeline_stages(h: Hparams, transformer) -> int:
+    """Number of pipeline stages, from the per-chip number of layers in `transformer`."""
+    return h.layers // transformer.ln1.shape[0]
+
+
+def pipeline_bubble_fraction(n_stages: int, microbatches: int) -> float:
+    """Fraction of a GPipe schedule's ticks that each stage spends idle."""
+    return (n_stages - 1) / (microbatches + n_stages - 1)
+
+
+def get_moe_d_expert(h: Hparams) -> int:
+    """Hidden width of each mixture-of-experts FFN expert."""
+    top_k = h.moe_top_k or 2
+    assert (
+        h.d_ff % top_k == 0
+    ), f"d_ff {h.d_ff} must be a multiple of moe_top_k {top_k}."
+    return h.d_ff // top_k
+
+
+def get_moe_capacity(h: Hparams, tokens: int) -> int:
+    """Slots per expert for the `tokens` tokens routed from one chip."""
+    top_k = h.moe_top_k or 2
+    capacity_factor = h.moe_capacity_factor or 1.25
+    return math.ceil(capacity_factor * tokens * top_k / h.moe_experts)
+
+
+@typechecked
+def sequence_positions(
+    is_seq_start: bool_[b"B/d L/s"],
+) -> Tuple[i32[b"B/d L/s"], i32[b"B/d L/s"]]:
+    """Document ids and positions of this chip's tokens, counted from the start of the
+    whole sequence rather than of this chip's `s` shard of it."""
+    L = is_seq_start.shape[1]
+    shard = lax.axis_index("s")
+    segment_ids = jnp.cumsum(is_seq_start, axis=1)
+    if shardops.axis_size("s") > 1:
+        # Offset by the number of documents started on earlier shards.
+        counts = lax.all_gather(segment_ids[:, -1], "s")
+        is_earlier = jnp.arange(counts.shape[0]) < shard
+        segment_ids += jnp.sum(
+            jnp.where(is_earlier[:, jnp.newaxis], counts, 0), axis=0
+        )[:, jnp.newaxis]
+    positions = jnp.broadcast_to(
+        shard * L + jnp.arange(L, dtype=jnp.int32)[jnp.newaxis, :], is_seq_start.shape
+    )
+    return segment_ids, positions
+
+
+def get_kv_cache_len(h: Hparams, max_len: int) -> int:
+    """Decode-time KV cache positions needed for sequences of up to `max_len` tokens."""
+    if h.attention_window is not None and h.global_attention_every is None:
+        return min(max_len, h.attention_window)
+    return max_len
+
+
+def get_attention_logit_scale(h: Hparams) -> float:
+    if h.parameterization.lower() == "mup":
+        return h.a_attn * math.sqrt(h.base.d_head) / h.d_head
+    return 1.0 / math.sqrt(h.d_head)
+
 
 def get_parameterization(style: str, fully_aligned: bool = True):
     Parameterization = namedtuple(
@@ -220,29 +388,413 @@ def get_parameterization(style: str, fully_aligned: bool = True):
 
 @pytree_dataclass
 class TransformerLayer:
-    ln1: f32["d_model/t/d"]
-    ln2: f32["d_model/t/d"]
-    w_q: f32["d_model/d n_q_per_kv n_kv/t d_head"]
-    w_kv: f32["2 d_model/d n_kv/t d_head"]
-    w_o: f32["d_model/d n_q_per_kv n_kv/t d_head"]
-    w_gate: f32["d_model/d d_ff/t"]
-    w_up: f32["d_model/d d_ff/t"]
-    w_down: f32["d_model/d d_ff/t"]
+    ln1: f32["d_model/t/d/s"]
+    ln2: f32["d_model/t/d/s"]
+    w_q: f32["d_model/d/s n_q_per_kv n_kv/t d_head"]
+    w_kv: f32["2 d_model/d/s n_kv/t d_head"]
+    w_o: f32["d_model/d/s n_q_per_kv n_kv/t d_head"]
+    w_gate: f32["d_model/d/s d_ff/t"]
+    w_up: f32["d_model/d/s d_ff/t"]
+    w_down: f32["d_model/d/s d_ff/t"]
+
+    @typechecked
+    def gather(self) -> "GatheredLayer":
+        """All-gathers this layer's weights over `d` and `s` (the FSDP axes), cast for compute."""
+        return GatheredLayer(
+            ln1=shardops.all_gather("M/t/d/s -> M", jnp.float32(self.ln1)),
+            ln2=shardops.all_gather("M/t/d/s -> M", jnp.float32(self.ln2)),
+            w_q=shardops.all_gather(
+                "M/d/s Q K/t D -> M Q K/t D", jnp.bfloat16(self.w_q)
+            ),
+            w_kv=shardops.all_gather(
+                "2 M/d/s K/t D -> 2 M K/t D", jnp.bfloat16(self.w_kv)
+            ),
+            w_o=shardops.all_gather(
+                "M/d/s Q K/t D -> M Q K/t D", jnp.bfloat16(self.w_o)
+            ),
+            w_gate=shardops.all_gather("M/d/s F/t -> M F/t", jnp.bfloat16(self.w_gate)),
+            w_up=shardops.all_gather("M/d/s F/t -> M F/t", jnp.bfloat16(self.w_up)),
+            w_down=shardops.all_gather("M/d/s F/t -> M F/t", jnp.bfloat16(self.w_down)),
+        )
+
+
+@pytree_dataclass
+class GatheredLayer:
+    """A `TransformerLayer`'s weights after `TransformerLayer.gather`: replicated over `d`,
+    still sharded over `t`."""
+
+    ln1: f32["d_model"]
+    ln2: f32["d_model"]
+    w_q: bf16["d_model n_q_per_kv n_kv/t d_head"]
+    w_kv: bf16["2 d_model n_kv/t d_head"]
+    w_o: bf16["d_model n_q_per_kv n_kv/t d_head"]
+    w_gate: bf16["d_model d_ff/t"]
+    w_up: bf16["d_model d_ff/t"]
+    w_down: bf16["d_model d_ff/t"]
+
+    @typechecked
+    def attention_qkv(
+        self, h: Hparams, x: bf16[b"B/d L/s M/t"], rope_table: "RopeTable"
+    ) -> Tuple[f32[b"B/d L/s Q K/t D"], f32[b"B/d L/s K/t D"], bf16[b"B/d L/s K/t D"]]:
+        """Pre-attention RMSNorm and the Q/K/V projections, with RoPE applied to Q and K."""
+        p = get_parameterization(h.parameterization)
+        hidden_mult = (h.d_model / h.base.d_model) ** -p.hidden_param_mult
+
+        # Pre-attention RMSNorm
+        gx = shardops.all_gather("B/d L/s M/t -> B/d L/s M", x)
+        nx = jnp.bfloat16(rms_norm(gx) * self.ln1)
+
+        # Attention, using Grouped Query Attention and RoPE position embeddings.
+        q = save_for_backward(
+            hidden_mult
+            * shardops.einsum_unreduced(
+                "B/d L/s M, M Q K/t D -> B/d L/s Q K/t D", nx, self.w_q
+            ),
+            "q",
+        )
+        q = rope_table.apply("L D -> 1 L 1 1 D", q)
+        k, v = hidden_mult * shardops.einsum_unreduced(
+            "B/d L/s M, k_v M K/t D -> k_v B/d L/s K/t D", nx, self.w_kv
+        )
+        k = save_for_backward(k, "k")
+        v = save_for_backward(v, "v")
+        k = rope_table.apply("L d -> 1 L 1 d", k)
+        return q, k, v
+
+    @typechecked
+    def attention_output_and_ffn(
+        self, h: Hparams, x: bf16[b"B/d L/s M/t"], heads: bf16[b"B/d L/s Q K/t D"]
+    ) -> bf16[b"B/d L/s M/t"]:
+        """Output projection of the attention heads, then the FFN, each with a residual connection."""
+        return self.ffn(h, self.attention_output(h, x, heads))
+
+    @typechecked
+    def attention_output(
+        self, h: Hparams, x: bf16[b"B/d L/s M/t"], heads: bf16[b"B/d L/s Q K/t D"]
+    ) -> bf16[b"B/d L/s M/t"]:
+        """Output projection of the attention heads, with a residual connection."""
+        p = get_parameterization(h.parameterization)
+        hidden_mult = (h.d_model / h.base.d_model) ** -p.hidden_param_mult
+
+        attn_out = hidden_mult * shardops.einsum_unreduced(
+            "B/d L/s Q K/t D, M Q K/t D -> B/d L/s M", heads, self.w_o
+        )
+        attn_out = shardops.psum_scatter("B/d L/s M -> B/d L/s M/t", attn_out)
+        return save_for_backward(x + attn_out)
+
+    @typechecked
+    def ffn(self, h: Hparams, x: bf16[b"B/d L/s M/t"]) -> bf16[b"B/d L/s M/t"]:
+        """The FFN, with a residual connection."""
+        p = get_parameterization(h.parameterization)
+        hidden_mult = (h.d_model / h.base.d_model) ** -p.hidden_param_mult
+
+        # Pre-FFN RMSNorm
+        ln2 = save_for_backward(self.ln2)
+        gx = shardops.all_gather("B/d L/s M/t -> B/d L/s M", x)
+        nx = jnp.bfloat16(rms_norm(gx) * ln2)
+
+        # FFN, using SwiGLU
+        gate_proj = save_for_backward(
+            hidden_mult
+            * shardops.einsum_unreduced(
+                "B/d L/s M, M F/t -> B/d L/s F/t", nx, self.w_gate
+            )
+        )
+        up_proj = save_for_backward(
+            hidden_mult
+            * shardops.einsum_unreduced(
+                "B/d L/s M, M F/t -> B/d L/s F/t", nx, self.w_up
+            )
+        )
+        y = jax.nn.swish(gate_proj) * up_proj
+
+        ffn_out_mult = (h.d_ff / h.base.d_ff) ** -p.hidden_param_mult
+        ffn_out = ffn_out_mult * shardops.einsum_unreduced(
+            "B/d L/s F/t, M F/t -> B/d L/s M", y, self.w_down
+        )
+        ffn_out = shardops.psum_scatter("B/d L/s M -> B/d L/s M/t", ffn_out)
+        return jnp.bfloat16(x + ffn_out)
+
+
+Transformer = Array["layers/p", TransformerLayer]
+
+
+@pytree_dataclass
+class MoEStats:
+    """Routing statistics of a mixture-of-experts FFN, over one chip's tokens."""
+
+    # Switch Transformer load-balancing loss: `experts * sum_e(f_e * p_e)`, where `f_e` is
+    # the fraction of token-to-expert assignments that chose expert `e` and `p_e` is `e`'s
+    # mean router probability. 1 when perfectly balanced, up to `experts` when collapsed.
+    load_balance_loss: f32[b""]
+    # Fraction of token-to-expert assignments dropped because the expert was full.
+    dropped_tokens: f32[b""]
+
+    @staticmethod
+    def zeros() -> "MoEStats":
+        return MoEStats(
+            load_balance_loss=jnp.float32(0.0), dropped_tokens=jnp.float32(0.0)
+        )
+
+
+@shardtypes.scope
+@typechecked
+def route_tokens(
+    h: Hparams, router_logits: f32[b"T E"]
+) -> Tuple[i32[b"T k"], f32[b"T k"], MoEStats]:
+    """Top-`moe_top_k` routing of one chip's tokens to experts with `get_moe_capacity` slots.
+
+    Returns each token's `k` slots in the flattened `E C` dispatch buffer and the weights of
+    the corresponding expert outputs. Slots are filled in order of choice, then of token, so
+    any token's first choice takes precedence over all second choices. Assignments to a full
+    expert are dropped: their slot is `E * C`, out of bounds, and their weight is zero.
+    """
+    T, E = router_logits.shape
+    top_k = h.moe_top_k or 2
+    capacity = get_moe_capacity(h, T)
+    probs = jax.nn.softmax(router_logits, axis=-1)
+    weights, experts = lax.top_k(probs, top_k)
+    if top_k > 1:
+        # As in Mixtral. Not for top-1, where it would cut the router off from the loss.
+        weights /= jnp.sum(weights, axis=-1, keepdims=True)
+
+    assignments: i32[b"k T E"] = jax.nn.one_hot(experts.T, E, dtype=jnp.int32)
+    positions = jnp.cumsum(assignments.reshape(top_k * T, E), axis=0) - 1
+    positions = jnp.sum(positions.reshape(top_k, T, E) * assignments, axis=-1).T
+    kept = positions < capacity
+    slots = jnp.where(kept, experts * capacity + positions, E * capacity)
+
+    fraction_routed = jnp.mean(jnp.float32(assignments), axis=(0, 1))
+    stats = MoEStats(
+        load_balance_loss=E * jnp.sum(fraction_routed * jnp.mean(probs, axis=0)),
+        dropped_tokens=1.0 - jnp.mean(jnp.float32(kept)),
+    )
+    return slots, jnp.where(kept, weights, 0.0), stats
+
+
+@pytree_dataclass
+class MoETransformerLayer:
+    """A `TransformerLayer` whose FFN is a mixture of experts. Experts are sharded over `d`,
+    so within each `d` group, each chip holds `experts / d` of them."""
+
+    ln1: f32["d_model/t/d/s"]
+    ln2: f32["d_model/t/d/s"]
+    w_q: f32["d_model/d/s n_q_per_kv n_kv/t d_head"]
+    w_kv: f32["2 d_model/d/s n_kv/t d_head"]
+    w_o: f32["d_model/d/s n_q_per_kv n_kv/t d_head"]
+    w_router: f32["d_model/t/d/s experts"]
+    w_gate: f32["experts/d d_model/s d_expert/t"]
+    w_up: f32["experts/d d_model/s d_expert/t"]
+    w_down: f32["experts/d d_model/s d_expert/t"]
+
+    @typechecked
+    def gather(self) -> "MoEGatheredLayer":
+        """All-gathers this layer's weights over the FSDP axes, cast for compute. The expert
+        weights stay sharded over `d`."""
+        return MoEGatheredLayer(
+            ln1=shardops.all_gather("M/t/d/s -> M", jnp.float32(self.ln1)),
+            ln2=shardops.all_gather("M/t/d/s -> M", jnp.float32(self.ln2)),
+            w_q=shardops.all_gather(
+                "M/d/s Q K/t D -> M Q K/t D", jnp.bfloat16(self.w_q)
+            ),
+            w_kv=shardops.all_gather(
+                "2 M/d/s K/t D -> 2 M K/t D", jnp.bfloat16(self.w_kv)
+            ),
+            w_o=shardops.all_gather(
+                "M/d/s Q K/t D -> M Q K/t D", jnp.bfloat16(self.w_o)
+            ),
+            w_router=shardops.all_gather(
+                "M/t/d/s E -> M E", jnp.float32(self.w_router)
+            ),
+            w_gate=shardops.all_gather(
+                "E/d M/s F/t -> E/d M F/t", jnp.bfloat16(self.w_gate)
+            ),
+            w_up=shardops.all_gather(
+                "E/d M/s F/t -> E/d M F/t", jnp.bfloat16(self.w_up)
+            ),
+            w_down=shardops.all_gather(
+                "E/d M/s F/t -> E/d M F/t", jnp.bfloat16(self.w_down)
+            ),
+        )
+
+
+@pytree_dataclass
+class MoEGatheredLayer:
+    """A `MoETransformerLayer`'s weights after `MoETransformerLayer.gather`."""
+
+    ln1: f32["d_model"]
+    ln2: f32["d_model"]
+    w_q: bf16["d_model n_q_per_kv n_kv/t d_head"]
+    w_kv: bf16["2 d_model n_kv/t d_head"]
+    w_o: bf16["d_model n_q_per_kv n_kv/t d_head"]
+    w_router: f32["d_model experts"]
+    w_gate: bf16["experts/d d_model d_expert/t"]
+    w_up: bf16["experts/d d_model d_expert/t"]
+    w_down: bf16["experts/d d_model d_expert/t"]
+
+    attention_qkv = GatheredLayer.attention_qkv
+    attention_output = GatheredLayer.attention_output
+
+    @typechecked
+    def ffn(
+        self, h: Hparams, x: bf16[b"B/d L/s M/t"]
+    ) -> Tuple[bf16[b"B/d L/s M/t"], MoEStats]:
+        """The mixture-of-experts FFN, with a residual connection.
+
+        Each chip routes its own tokens into a `E C` buffer of expert inputs, then an
+        `all_to_all` over `d` sends each expert's slots to the chip holding that expert, and
+        a second `all_to_all` brings the outputs back to be combined."""
+        p = get_parameterization(h.parameterization)
+        hidden_mult = (h.d_model / h.base.d_model) ** -p.hidden_param_mult
+
+        # Pre-FFN RMSNorm
+        ln2 = save_for_backward(self.ln2)
+        gx = shardops.all_gather("B/d L/s M/t -> B/d L/s M", x)
+        nx = jnp.bfloat16(rms_norm(gx) * ln2)
+
+        # Routing, in f32.
+        router_logits = hidden_mult * shardops.einsum_unreduced(
+            "B/d L/s M, M E -> B/d L/s E", jnp.float32(nx), self.w_router
+        )
+        B, L, M = nx.shape
+        E = h.moe_experts
+        slots, weights, stats = route_tokens(h, router_logits.reshape(B * L, E))
+        tokens = jnp.broadcast_to(nx.reshape(B * L, 1, M), (*slots.shape, M))
+        capacity = get_moe_capacity(h, B * L)
+        dispatched: bf16[b"E C/d M"] = (
+            jnp.zeros((E * capacity, M), nx.dtype)
+            .at[slots]
+            .set(tokens, mode="drop")
+            .reshape(E, capacity, M)
+        )
+        expert_inputs = shardops.all_to_all("E C/d M -> E/d C M", dispatched)
+
+        # Experts, using SwiGLU
+        gate_proj = save_for_backward(
+            hidden_mult
+            * shardops.einsum_unreduced(
+                "E/d C M, E/d M F/t -> E/d C F/t", expert_inputs, self.w_gate
+            )
+        )
+        up_proj = save_for_backward(
+            hidden_mult
+            * shardops.einsum_unreduced(
+                "E/d C M, E/d M F/t -> E/d C F/t", expert_inputs, self.w_up
+            )
+        )
+        y = jax.nn.swish(gate_proj) * up_proj
+        # Expert width relative to its base is the same as `d_ff` relative to `base.d_ff`.
+        ffn_out_mult = (h.d_ff / h.base.d_ff) ** -p.hidden_param_mult
+        expert_outputs = ffn_out_mult * shardops.einsum_unreduced(
+            "E/d C F/t, E/d M F/t -> E/d C M", y, self.w_down
+        )
+
+        # Combine each token's expert outputs. Dropped assignments read zeros.
+        returned = shardops.all_to_all("E/d C M -> E C/d M", expert_outputs)
+        outputs = (
+            returned.reshape(E * capacity, M).at[slots].get(mode="fill", fill_value=0)
+        )
+        ffn_out = jnp.bfloat16(jnp.einsum("tkm,tk->tm", outputs, weights))
+        ffn_out = shardops.psum_scatter(
+            "B/d L/s M -> B/d L/s M/t", ffn_out.reshape(B, L, M)
+        )
+        return jnp.bfloat16(x + ffn_out), stats
+
+
+MoETransformer = Array["layers/p", MoETransformerLayer]
+
+
+@pytree_dataclass
+class KVCache:
+    """Preallocated per-layer keys (post-RoPE) and values for autoregressive decoding.
+
+    Positions `[0, length)` are filled; the rest is padding that attention masks out."""
+
+    k: bf16["layers batch/d max_len n_kv/t d_head"]
+    v: bf16["layers batch/d max_len n_kv/t d_head"]
+    length: i32[""]
+
+    def entries(self) -> Tuple:
+        """The per-position arrays, in constructor order."""
+        return self.k, self.v
+
+    @staticmethod
+    def encode(k, v) -> Tuple:
+        """Converts keys and values of shape `... L K/t D` to per-position entries."""
+        return jnp.bfloat16(k), jnp.bfloat16(v)
+
+    @staticmethod
+    def attend(q, entries, mask, logit_scale):
+        k, v = entries
+        return dense_attention(q, k, v, mask, logit_scale)
+
 
+@pytree_dataclass
+class QuantizedKVCache:
+    """`KVCache` stored as int8, with a bf16 scale per (position, kv head).
+
+    The scales are applied to the attention logits and probabilities, so the cache itself is
+    only ever converted to bf16 as an einsum operand, never dequantized into a full copy.
+    """
+
+    k: i8["layers batch/d max_len n_kv/t d_head"]
+    v: i8["layers batch/d max_len n_kv/t d_head"]
+    k_scale: bf16["layers batch/d max_len n_kv/t"]
+    v_scale: bf16["layers batch/d max_len n_kv/t"]
+    length: i32[""]
+
+    def entries(self) -> Tuple:
+        """The per-position arrays, in constructor order."""
+        return self.k, self.v, self.k_scale, self.v_scale
 
-Transformer = Array["layers", TransformerLayer]
+    @staticmethod
+    def encode(k, v) -> Tuple:
+        """Converts keys and values of shape `... L K/t D` to per-position entries."""
+        k, k_scale = quantize_int8(k)
+        v, v_scale = quantize_int8(v)
+        return k, v, k_scale, v_scale
+
+    @staticmethod
+    def attend(q, entries, mask, logit_scale):
+        k, v, k_scale, v_scale = entries
+        return dense_attention(
+            q, jnp.bfloat16(k), jnp.bfloat16(v), mask, logit_scale, k_scale, v_scale
+        )
+
+
+AnyKVCache = Union[KVCache, QuantizedKVCache]
+
+
+def get_kv_cache_type(h: Hparams) -> type:
+    kv_cache_dtype = h.kv_cache_dtype or "bfloat16"
+    if kv_cache_dtype == "bfloat16":
+        return KVCache
+    elif kv_cache_dtype == "int8":
+        return QuantizedKVCache
+    raise ValueError(f"Unknown kv_cache_dtype: {kv_cache_dtype}")
+
+
+def quantize_int8(x):
+    """Symmetric int8 quantization, with one bf16 scale per vector along the last axis."""
+    scale = jnp.bfloat16(jnp.max(jnp.abs(jnp.float32(x)), axis=-1) / 127.0)
+    inv_scale = jnp.where(scale == 0, 0.0, 1.0 / jnp.float32(scale))
+    q = jnp.round(jnp.float32(x) * inv_scale[..., jnp.newaxis])
+    return jnp.int8(jnp.clip(q, -127, 127)), scale
 
 
 @pytree_dataclass
 class Model:
-    embed: f32["vocab/t d_model/d"]
-    unembed: f32["vocab/t d_model/d"]
+    embed: f32["vocab/t d_model/d/s/p"]
+    unembed: f32["vocab/t d_model/d/s/p"]
     transformer: Transformer
-    final_layer_norm: f32["d_model/d/t"]
+    # Stored sharded d-major but gathered t-major in `final_norm`, as in checkpoints written
+    # before the `s` and `p` axes, which must keep loading as they were trained. So the stored
+    # order of its elements depends on the mesh's `d` and `t`.
+    final_layer_norm: f32["d_model/d/t/s/p"]
 
     @staticmethod
     @typechecked
-    def init(h: Hparams, rng: PRNGKey) -> "Model":
+    def init(h: Hparams, rng: PRNGKey) -> "AnyModel":
         # https://github.com/google/jax/issues/20390 for ones_like with sharding.
         ln1 = jnp.ones((h.layers, h.d_model), dtype=jnp.float32)
         ln2 = jnp.ones((h.layers, h.d_model), dtype=jnp.float32)
@@ -279,6 +831,22 @@ class Model:
         )
 
         ff_shape = (h.layers, h.d_model, h.d_ff)
+        if h.moe_experts:
+            # Each expert is initialized like a dense FFN of width `d_expert`, whose base
+            # width is `base.d_ff` scaled down by the same factor.
+            d_expert = get_moe_d_expert(h)
+            base_d_expert = base.d_ff * d_expert / h.d_ff
+            w_down_scale = (
+                math.sqrt(base_d_expert) / (d_expert * truncated_normal_stddev)
+            ) ** (p.hidden_init_var)
+            ff_shape = (h.layers, h.moe_experts, h.d_model, d_expert)
+            w_router = d_model_scale * jax.random.truncated_normal(
+                fold_in_str(rng, "w_router"),
+                -2,
+                2,
+                (h.layers, h.d_model, h.moe_experts),
+                dtype=jnp.float32,
+            )
         embed = embed_scale * jax.random.normal(
             jax_extra.fold_in_str(rng, "embed"), (h.vocab, h.d_model), dtype=jnp.float32
         )
@@ -319,169 +887,429 @@ class Model:
                 (h.vocab, h.d_model),
                 dtype=jnp.float32,
             )
-        arrays = Model(
+        layers = dict(
+            ln1=ln1,
+            ln2=ln2,
+            w_q=w_q,
+            w_kv=w_kv,
+            w_o=w_o,
+            w_gate=w_gate,
+            w_up=w_up,
+            w_down=w_down,
+        )
+        ModelType = get_model_type(h)
+        arrays = ModelType(
             embed=embed,
             unembed=unembed,
-            transformer=Transformer(
-                ln1=ln1,
-                ln2=ln2,
-                w_q=w_q,
-                w_kv=w_kv,
-                w_o=w_o,
-                w_gate=w_gate,
-                w_up=w_up,
-                w_down=w_down,
+            transformer=(
+                MoETransformer(**layers, w_router=w_router)
+                if h.moe_experts
+                else Transformer(**layers)
             ),
             final_layer_norm=final_layer_norm,
         )
-        shardings = make_shardings(Model)
+        shardings = make_shardings(ModelType)
         return jax.tree.map(lax.with_sharding_constraint, arrays, shardings)
 
     @typechecked
     def forward_pass(
-        self, h: Hparams, ids: u32[b"B/d L"], is_seq_start: bool_[b"B/d L"]
-    ) -> f32[b"B/d L V/t"]:
+        self, h: Hparams, ids: u32[b"B/d L/s"], is_seq_start: bool_[b"B/d L/s"]
+    ) -> Tuple[f32[b"B/d L/s V/t"], Any]:
+        x, moe_stats = self.final_hidden_states(h, ids, is_seq_start)
+        logits = shardops.einsum_unreduced(
+            "B/d L/s M, V/t M -> B/d L/s V/t",
+            x,
+            self.gathered_unembed(h),
+            preferred_element_type=jnp.float32,
+        )
+
+        return logits, moe_stats
+
+    @typechecked
+    def gathered_unembed(self, h: Hparams) -> bf16[b"V/t M"]:
         p = get_parameterization(h.parameterization)
-        embed_mult = (h.d_model / h.base.d_model) ** -p.embed_param_mult
-        hidden_mult = (h.d_model / h.base.d_model) ** -p.hidden_param_mult
         unembed_mult = (h.d_model / h.base.d_model) ** -p.unembed_param_mult
+        return unembed_mult * shardops.all_gather(
+            "V/t M/d/s/p -> V/t M", jnp.bfloat16(self.unembed)
+        )
 
-        # Initial embedding lookup.
+    @typechecked
+    def embed_tokens(self, h: Hparams, ids: u32[b"B/d L/s"]) -> bf16[b"B/d L/s M/t"]:
+        # Initial embedding lookup. This is a gather rather than a one-hot matmul, so we never
+        # materialize a `B/d L V/t` tensor. Its gradient is a scatter-add into the table, which
+        # we do in f32 so that frequent tokens don't lose precision accumulating in bf16.
+        p = get_parameterization(h.parameterization)
+        embed_mult = (h.d_model / h.base.d_model) ** -p.embed_param_mult
         embed = embed_mult * shardops.all_gather(
-            "V/t M/d -> V/t M", jnp.bfloat16(self.embed)
+            "V/t M/d/s/p -> V/t M", jnp.bfloat16(self.embed)
         )
-        one_hot_ids = jax.nn.one_hot(ids, self.embed.shape[0])
-        x = shardops.einsum_unreduced("B/d L V/t, V/t M -> B/d L M", one_hot_ids, embed)
+        x = shardops.index_unreduced(
+            "[V/t] M, B/d L/s -> B/d L/s M", jnp.float32(embed), ids
+        )
+        x = shardops.psum_scatter("B/d L/s M -> B/d L/s M/t", x)
+        return jnp.bfloat16(x)
 
-        x = shardops.psum_scatter("B/d L M -> B/d L M/t", x)
+    @typechecked
+    def final_norm(self, x: bf16[b"B/d L/s M/t"]) -> bf16[b"B/d L/s M"]:
+        gx = shardops.all_gather("B/d L/s M/t -> B/d L/s M", x)
+        ln = shardops.all_gather("M/t/d/s/p -> M", jnp.float32(self.final_layer_norm))
+        return jnp.bfloat16(rms_norm(gx) * ln)
 
-        L = ids.shape[1]
-        segment_ids = jnp.cumsum(is_seq_start, axis=1)
-        segment_mask: bool_[b"B/d L L"] = (
-            segment_ids[:, :, jnp.newaxis] == segment_ids[:, jnp.newaxis, :]
+    @typechecked
+    def final_hidden_states(
+        self, h: Hparams, ids: u32[b"B/d L/s"], is_seq_start: bool_[b"B/d L/s"]
+    ) -> Tuple[bf16[b"B/d L/s M"], Any]:
+        """Everything in the forward pass except the output projection. Also returns the
+        `MoEStats`, averaged over layers, of a mixture-of-experts model; `()` otherwise.
+        """
+        x, ((), moe_stats) = self._transformer_blocks(
+            h, ids, is_seq_start, return_kv=False
         )
-        segment_mask: bool_[b"B/d L L 1 1"] = segment_mask[
-            ..., jnp.newaxis, jnp.newaxis
-        ]  # add axes for q_per_k, num_kv_heads dimensions
-        causal_mask: bool_[b"1 L L 1 1"] = jnp.tril(
-            jnp.ones((L, L), dtype=jnp.bool_), 0
-        )[jnp.newaxis, ..., jnp.newaxis, jnp.newaxis]
-        causal_mask: bool_[b"B/d L L 1 1"] = jnp.logical_and(segment_mask, causal_mask)
+        return self.final_norm(x), jax.tree.map(jnp.mean, moe_stats)
 
-        rope_table = RopeTable.create(L, h)
+    @typechecked
+    def _transformer_blocks(
+        self,
+        h: Hparams,
+        ids: u32[b"B/d L/s"],
+        is_seq_start: bool_[b"B/d L/s"],
+        return_kv: bool,
+    ) -> Tuple[bf16[b"B/d L/s M/t"], Tuple[Any, Any]]:
+        """Embedding and transformer blocks. Also returns every layer's post-RoPE keys and
+        values, stacked as `layers B/d L K/t D`, if `return_kv`, and its `MoEStats` if it is
+        a mixture of experts, each `()` otherwise."""
+        assert (
+            not return_kv or shardops.axis_size("s") == 1
+        ), "Sequence parallelism (mesh.s > 1) only supports training."
+        x = self.embed_tokens(h, ids)
+        if get_pipeline_stages(h, self.transformer) == 1:
+            return self._run_layers(h, x, is_seq_start, 0, return_kv)
+        assert (
+            not return_kv
+        ), "Pipeline parallelism (mesh.p > 1) only supports training."
+        assert (
+            not h.moe_experts
+        ), "Pipeline parallelism (mesh.p > 1) doesn't support mixture-of-experts FFNs."
+        return self._pipeline(h, x, is_seq_start), ((), ())
 
-        ##### Transformer blocks.
-        @explicit_activation_checkpointing
-        @typechecked
-        def loop_body(
-            x: bf16[b"B/d L M/t"], layer_weights: TransformerLayer
-        ) -> Tuple[bf16[b"B/d L M/t"], Tuple[()]]:
-            # Pre-attention RMSNorm
-            ln1 = shardops.all_gather("M/t/d -> M", jnp.float32(layer_weights.ln1))
-            gx = shardops.all_gather("B/d L M/t -> B/d L M", x)
-            nx = jnp.bfloat16(rms_norm(gx) * ln1)
-
-            # Attention, using Grouped Query Attention and RoPE position embeddings.
-            w_q = shardops.all_gather(
-                "M/d Q K/t D -> M Q K/t D", jnp.bfloat16(layer_weights.w_q)
-            )
-            q = save_for_backward(
-                hidden_mult
-                * shardops.einsum_unreduced(
-                    "B/d L M, M Q K/t D -> B/d L Q K/t D", nx, w_q
-                )
-            )
-            q = rope_table.apply("L D -> 1 L 1 1 D", q)
-            w_kv = shardops.all_gather(
-                "2 M/d K/t D -> 2 M K/t D", jnp.bfloat16(layer_weights.w_kv)
-            )
-            k, v = hidden_mult * shardops.einsum_unreduced(
-                "B/d L M, k_v M K/t D -> k_v B/d L K/t D", nx, w_kv
-            )
-            k = save_for_backward(k)
-            v = save_for_backward(v)
-            k = rope_table.apply("L d -> 1 L 1 d", k)
-
-            logit_scale = jax.lax.select(
-                h.parameterization.lower() == "mup",
-                h.a_attn * math.sqrt(h.base.d_head) / h.d_head,
-                1.0 / math.sqrt(h.d_head),
-            )
-            logits = logit_scale * shardops.einsum_unreduced(
-                "B/d Qlen Q K/t D, B/d Klen K/t D -> B/d Qlen Klen Q K/t",
-                q,
-                k,
-                preferred_element_type=jnp.float32,
+    @typechecked
+    def _pipeline(
+        self, h: Hparams, x: bf16[b"B/d L/s M/t"], is_seq_start: bool_[b"B/d L/s"]
+    ) -> bf16[b"B/d L/s M/t"]:
+        """Runs the transformer blocks as a GPipe pipeline over the `p` mesh axis.
+
+        Each stage holds `layers / p` consecutive layers. The batch is split into
+        `pipeline_microbatches`; at tick `i`, stage `j` runs its layers on microbatch `i - j`
+        and sends the result to stage `j + 1`. Only the last stage's result is the model's
+        output: on other stages, the result is not meaningful, and `loss` ignores it. The
+        backward pass runs the same schedule in reverse, by differentiating through it.
+        """
+        n_stages = get_pipeline_stages(h, self.transformer)
+        stage_layers = h.layers // n_stages
+        microbatches = h.pipeline_microbatches or n_stages
+        B, L = is_seq_start.shape
+        assert (
+            B % microbatches == 0
+        ), f"Per-chip batch {B} must be a multiple of pipeline_microbatches {microbatches}."
+        xs = x.reshape(microbatches, B // microbatches, *x.shape[1:])
+        starts = is_seq_start.reshape(microbatches, B // microbatches, L)
+        stage = lax.axis_index("p")
+
+        def tick(inbox, i):
+            # Stage 0 reads its microbatch from the embeddings; the others receive theirs
+            # from the previous stage. Outside `0 <= i - stage < microbatches`, this is
+            # bubble: the stage computes on a clamped index, and the result is unused.
+            x = jnp.where(stage == 0, xs[jnp.minimum(i, microbatches - 1)], inbox)
+            microbatch = jnp.clip(i - stage, 0, microbatches - 1)
+            x, ((), ()) = self._run_layers(
+                h, x, starts[microbatch], stage * stage_layers, False
             )
-            logits = jnp.where(causal_mask, logits, -1e10)
-            probs = jnp.bfloat16(jax.nn.softmax(logits, axis=2))
-            attn_out = shardops.einsum_unreduced(
-                "B/d Qlen Klen Q K/t, B/d Klen K/t D -> B/d Qlen Q K/t D", probs, v
+            return shardops.shift("p", x), x
+
+        _, outputs = lax.scan(
+            tick, jnp.zeros_like(xs[0]), jnp.arange(microbatches + n_stages - 1)
+        )
+        # The last stage finishes microbatch `j` at tick `j + n_stages - 1`.
+        return outputs[n_stages - 1 :].reshape(x.shape)
+
+    @shardtypes.scope
+    @typechecked
+    def _run_layers(
+        self,
+        h: Hparams,
+        x: bf16[b"B/d L/s M/t"],
+        is_seq_start: bool_[b"B/d L/s"],
+        first_layer: Any,
+        return_kv: bool,
+    ) -> Tuple[bf16[b"B/d L/s M/t"], Tuple[Any, Any]]:
+        """This chip's transformer blocks, whose first is layer `first_layer` of the model."""
+        L = x.shape[1]
+        segment_ids, positions = sequence_positions(is_seq_start)
+        sequence_sharded = shardops.axis_size("s") > 1
+        attention = h.attention or "dense"
+        if sequence_sharded and attention == "dense":
+            raise ValueError(
+                "Sequence parallelism (mesh.s > 1) needs blockwise or block_sparse attention."
             )
-            w_o = shardops.all_gather(
-                "M/d Q K/t D -> M Q K/t D", jnp.bfloat16(layer_weights.w_o)
+        if attention == "dense":
+            segment_mask: bool_[b"B/d L L"] = (
+                segment_ids[:, :, jnp.newaxis] == segment_ids[:, jnp.newaxis, :]
             )
-            attn_out = hidden_mult * shardops.einsum_unreduced(
-                "B/d Qlen Q K/t D, M Q K/t D -> B/d Qlen M", attn_out, w_o
+            segment_mask: bool_[b"B/d L L 1 1"] = segment_mask[
+                ..., jnp.newaxis, jnp.newaxis
+            ]  # add axes for q_per_k, num_kv_heads dimensions
+            causal_mask: bool_[b"1 L L 1 1"] = jnp.tril(
+                jnp.ones((L, L), dtype=jnp.bool_), 0
+            )[jnp.newaxis, ..., jnp.newaxis, jnp.newaxis]
+            causal_mask: bool_[b"B/d L L 1 1"] = jnp.logical_and(
+                segment_mask, causal_mask
             )
-            attn_out = shardops.psum_scatter("B/d Qlen M -> B/d Qlen M/t", attn_out)
-            x = save_for_backward(x + attn_out)
+            if h.attention_window is not None:
+                in_window: bool_[b"1 L L 1 1"] = jnp.triu(
+                    jnp.ones((L, L), dtype=jnp.bool_), 1 - h.attention_window
+                )[jnp.newaxis, ..., jnp.newaxis, jnp.newaxis]
+                local_mask = jnp.logical_and(causal_mask, in_window)
+        elif attention in ("blockwise", "block_sparse"):
+            # The mask is rebuilt per (query block, key block) tile from `segment_ids` and
+            # `positions`.
+            block_size = get_attention_block_size(h, L)
+        else:
+            raise ValueError(f"Unknown attention implementation: {attention}")
 
-            # Pre-FFN RMSNorm
-            ln2 = save_for_backward(
-                shardops.all_gather("M/t/d -> M", jnp.float32(layer_weights.ln2))
-            )
-            gx = shardops.all_gather("B/d L M/t -> B/d L M", x)
-            nx = jnp.bfloat16(rms_norm(gx) * ln2)
+        rope_table = RopeTable.create(L, h, start=lax.axis_index("s") * L)
+        logit_scale = get_attention_logit_scale(h)
 
-            # FFN, using SwiGLU
-            w_gate = shardops.all_gather(
-                "M/d F/t -> M F/t", jnp.bfloat16(layer_weights.w_gate)
-            )
-            gate_proj = save_for_backward(
-                hidden_mult
-                * shardops.einsum_unreduced("B/d L M, M F/t -> B/d L F/t", nx, w_gate)
-            )
-            w_up = shardops.all_gather(
-                "M/d F/t -> M F/t", jnp.bfloat16(layer_weights.w_up)
+        def attend(q, k, v, window):
+            if attention in ("blockwise", "block_sparse"):
+                tiled_attention = (
+                    ring_attention if sequence_sharded else blockwise_attention
+                )
+                return tiled_attention(
+                    q,
+                    k,
+                    v,
+                    segment_ids,
+                    positions,
+                    logit_scale,
+                    block_size,
+                    attention == "block_sparse",
+                    window,
+                )
+            mask = causal_mask if window is None else local_mask
+            return dense_attention(q, k, v, mask, logit_scale)
+
+        ##### Transformer blocks.
+        @typechecked
+        def block(
+            x: bf16[b"B/d L/s M/t"],
+            layer_weights: Union[GatheredLayer, MoEGatheredLayer],
+            layer_index: i32[b""],
+        ) -> Tuple[bf16[b"B/d L/s M/t"], Tuple[Any, Any]]:
+            q, k, v = layer_weights.attention_qkv(h, x, rope_table)
+            if h.attention_window is None:
+                attn_out = attend(q, k, v, None)
+            elif h.global_attention_every is None:
+                attn_out = attend(q, k, v, h.attention_window)
+            else:
+                attn_out = lax.cond(
+                    is_global_attention_layer(h, layer_index),
+                    partial(attend, window=None),
+                    partial(attend, window=h.attention_window),
+                    q,
+                    k,
+                    v,
+                )
+            x = layer_weights.attention_output(h, x, attn_out)
+            if h.moe_experts:
+                x, moe_stats = layer_weights.ffn(h, x)
+            else:
+                x, moe_stats = layer_weights.ffn(h, x), ()
+            return x, ((k, v) if return_kv else (), moe_stats)
+
+        remat_policy = get_remat_policy(h)
+        n_layers = self.transformer.ln1.shape[0]
+        layer_indices = first_layer + jnp.arange(n_layers, dtype=jnp.int32)
+        if not h.prefetch_weights:
+
+            @partial(explicit_activation_checkpointing, policy=remat_policy)
+            def loop_body(x, layer):
+                layer_weights, layer_index = layer
+                return block(x, layer_weights.gather(), layer_index)
+
+            return jax.lax.scan(loop_body, x, (self.transformer, layer_indices))
+
+        # Layer i's gathered weights arrive in the carry; layer i+1's all_gathers don't
+        # depend on layer i's compute, so XLA is free to overlap the two. The last
+        # iteration redundantly gathers the first layer rather than branching. The
+        # prefetched weights carry no gradient: `prefetched_block` re-gathers layer i's
+        # weights in the backward pass and differentiates through that instead, so only
+        # the sharded weights are kept for the backward pass.
+        @partial(jax.custom_vjp, nondiff_argnums=(0,))
+        def prefetched_block(
+            block_fn, x, layer_weights, gathered, layer_index, *consts
+        ):
+            return block_fn(x, gathered, layer_index, *consts)
+
+        def prefetched_block_fwd(
+            block_fn, x, layer_weights, gathered, layer_index, *consts
+        ):
+            outputs = block_fn(x, gathered, layer_index, *consts)
+            return outputs, (x, layer_weights, layer_index, consts)
+
+        def prefetched_block_bwd(block_fn, residuals, d_outputs):
+            x, layer_weights, layer_index, consts = residuals
+            _, block_vjp = jax.vjp(
+                lambda x, w: block_fn(x, w.gather(), layer_index, *consts),
+                x,
+                layer_weights,
             )
-            up_proj = save_for_backward(
-                hidden_mult
-                * shardops.einsum_unreduced("B/d L M, M F/t -> B/d L F/t", nx, w_up)
+            d_x, d_layer_weights = block_vjp(d_outputs)
+            # `consts` are the rope table and attention masks, which don't depend on the
+            # weights.
+            return (d_x, d_layer_weights, None, None) + (None,) * len(consts)
+
+        prefetched_block.defvjp(prefetched_block_fwd, prefetched_block_bwd)
+
+        def prefetch_loop_body(carry, layer):
+            x, gathered = carry
+            layer_weights, layer_index = layer
+            next_layer_weights = jax.tree.map(
+                lambda w: lax.dynamic_index_in_dim(
+                    w, (layer_index - first_layer + 1) % n_layers, keepdims=False
+                ),
+                lax.stop_gradient(self.transformer),
             )
-            y = jax.nn.swish(gate_proj) * up_proj
-            w_down = shardops.all_gather(
-                "M/d F/t -> M F/t", jnp.bfloat16(layer_weights.w_down)
+            next_gathered = next_layer_weights.gather()
+            # custom_vjp functions can't close over traced values, so they're passed in.
+            block_fn, consts = hoist_closure(block, x, gathered, layer_index)
+            x, outputs = prefetched_block(
+                block_fn, x, layer_weights, gathered, layer_index, *consts
             )
+            return (x, next_gathered), outputs
 
-            ffn_out_mult = (h.d_ff / h.base.d_ff) ** -p.hidden_param_mult
-            ffn_out = ffn_out_mult * shardops.einsum_unreduced(
-                "B/d L F/t, M F/t -> B/d L M", y, w_down
-            )
-            ffn_out = shardops.psum_scatter("B/d L M -> B/d L M/t", ffn_out)
+        first_gathered = jax.tree.map(lambda w: w[0], self.transformer).gather()
+        (x, _), outputs = jax.lax.scan(
+            prefetch_loop_body,
+            (x, lax.stop_gradient(first_gathered)),
+            (self.transformer, layer_indices),
+        )
+        return x, outputs
 
-            return jnp.bfloat16(x + ffn_out), ()
+    @typechecked
+    def prefill(
+        self, h: Hparams, ids: u32[b"B/d L/s"], max_len: int
+    ) -> Tuple[f32[b"B/d V/t"], AnyKVCache]:
+        """Runs the prompts `ids` through the model, returning the logits for the token after
+        the prompt and a KV cache with room for `max_len` positions in total.
 
-        x, () = jax.lax.scan(loop_body, jnp.bfloat16(x), self.transformer)
+        Each row of `ids` is a single sequence; all rows have the same length."""
+        L = ids.shape[1]
+        assert L <= max_len, f"Prompt length {L} exceeds KV cache length {max_len}."
+        is_seq_start = jnp.zeros(ids.shape, dtype=jnp.bool_).at[:, 0].set(True)
+        assert not h.moe_experts, "Mixture-of-experts FFNs only support training."
+        x, ((k, v), ()) = self._transformer_blocks(h, ids, is_seq_start, return_kv=True)
+        cache_type = get_kv_cache_type(h)
+        cache_len = get_kv_cache_len(h, max_len)
+        entries = []
+        for e in cache_type.encode(k, v):
+            if L <= cache_len:
+                e = jnp.pad(
+                    e, [(0, 0), (0, 0), (0, cache_len - L)] + [(0, 0)] * (e.ndim - 3)
+                )
+            else:
+                # Ring buffer: keep the last `cache_len` positions, position p in slot
+                # p % cache_len.
+                e = jnp.roll(e[:, :, L - cache_len :], L % cache_len, axis=2)
+            entries.append(e)
+        cache = cache_type(*entries, length=jnp.int32(L))
+        return self.next_token_logits(h, x[:, -1:]), cache
 
-        ##### Final layernorm and output projection.
-        x = shardops.all_gather("B/d L M/t -> B/d L M", x)
-        ln = shardops.all_gather("M/t/d -> M", jnp.float32(self.final_layer_norm))
-        x = jnp.bfloat16(rms_norm(x) * ln)
-        unembed = unembed_mult * shardops.all_gather(
-            "V/t M/d -> V/t M", jnp.bfloat16(self.unembed)
+    @typechecked
+    def decode_step(
+        self, h: Hparams, cache: AnyKVCache, ids: u32[b"B/d"]
+    ) -> Tuple[f32[b"B/d V/t"], AnyKVCache]:
+        """Runs one new token per sequence through the model, attending to every position
+        already in `cache`, and returns the next-token logits and the extended cache."""
+        assert (
+            get_pipeline_stages(h, self.transformer) == 1
+        ), "Pipeline parallelism (mesh.p > 1) only supports training."
+        assert (
+            shardops.axis_size("s") == 1
+        ), "Sequence parallelism (mesh.s > 1) only supports training."
+        assert not h.moe_experts, "Mixture-of-experts FFNs only support training."
+        x = self.embed_tokens(h, ids[:, jnp.newaxis])
+        cache_len = cache.k.shape[2]
+        position = cache.length
+        slot = position % cache_len
+        rope_table = RopeTable.create(1, h, start=position)
+        logit_scale = get_attention_logit_scale(h)
+        # The new token sees itself and everything before it. Slot s holds the most recent
+        # position congruent to s mod `cache_len`, which is negative if not yet written.
+        slots = jnp.arange(cache_len, dtype=jnp.int32)
+        distance = (position - slots) % cache_len
+        mask: bool_[b"1 1 Klen 1 1"] = (distance <= position)[
+            jnp.newaxis, jnp.newaxis, :, jnp.newaxis, jnp.newaxis
+        ]
+        if h.attention_window is not None:
+            local_mask = jnp.logical_and(
+                mask,
+                (distance < h.attention_window)[
+                    jnp.newaxis, jnp.newaxis, :, jnp.newaxis, jnp.newaxis
+                ],
+            )
+
+        @typechecked
+        def loop_body(
+            x: bf16[b"B/d 1 M/t"], layer: Tuple[TransformerLayer, i32[b""], Tuple]
+        ) -> Tuple[bf16[b"B/d 1 M/t"], Tuple]:
+            layer_weights, layer_index, layer_entries = layer
+            layer_weights = layer_weights.gather()
+            q, k, v = layer_weights.attention_qkv(h, x, rope_table)
+            new_entries = cache.encode(k, v)
+            layer_entries = tuple(
+                lax.dynamic_update_slice_in_dim(e, new, slot, axis=1)
+                for e, new in zip(layer_entries, new_entries)
+            )
+            if h.attention_window is None:
+                layer_mask = mask
+            else:
+                layer_mask = jnp.where(
+                    is_global_attention_layer(h, layer_index), mask, local_mask
+                )
+            attn_out = cache.attend(q, layer_entries, layer_mask, logit_scale)
+            return layer_weights.attention_output_and_ffn(h, x, attn_out), new_entries
+
+        layer_indices = jnp.arange(h.layers, dtype=jnp.int32)
+        x, new_entries = jax.lax.scan(
+            loop_body, x, (self.transformer, layer_indices, cache.entries())
         )
-        logits = shardops.einsum_unreduced(
-            "B/d L M, V/t M -> B/d L V/t",
-            x,
-            unembed,
+        # Only the new position is written back, so with the cache donated this is in place.
+        entries = [
+            lax.dynamic_update_slice_in_dim(e, new, slot, axis=2)
+            for e, new in zip(cache.entries(), new_entries)
+        ]
+        cache = type(cache)(*entries, length=position + 1)
+        return self.next_token_logits(h, x), cache
+
+    @shardtypes.scope
+    @typechecked
+    def next_token_logits(self, h: Hparams, x: bf16[b"B/d 1 M/t"]) -> f32[b"B/d V/t"]:
+        return shardops.einsum_unreduced(
+            "B/d M, V/t M -> B/d V/t",
+            self.final_norm(x)[:, 0],
+            self.gathered_unembed(h),
             preferred_element_type=jnp.float32,
         )
 
-        return logits
-
     @typechecked
     def loss(self, h: Hparams, batch: TokenBatch) -> f32[b""]:
+        loss, _ = self.loss_and_moe_stats(h, batch)
+        return loss
+
+    @typechecked
+    def loss_and_moe_stats(self, h: Hparams, batch: TokenBatch) -> Tuple[f32[b""], Any]:
+        """This chip's share of the loss, including any mixture-of-experts load-balancing
+        loss, and the `MoEStats` of this chip's tokens (`()` for a dense model)."""
         # Given sequence-packed targets:
         #   [[1, 2], [3, 4, 5], [6, 7, 8, 9]]
         # we want inputs:
@@ -489,25 +1317,121 @@ class Model:
         # which we get by shifting the targets right by 1 and
         # masking sequence-start tokens to 0.
         inputs = jnp.pad(batch.targets[:, :-1], pad_width=((0, 0), (1, 0)))
-        is_seq_start: bool_[b"batch/d len"] = batch.is_seq_start
-        inputs: u32[b"batch/d len"] = jnp.where(is_seq_start, 0, inputs)
+        if shardops.axis_size("s") > 1:
+            # With sequences sharded over `s`, each shard's first input is the previous
+            # shard's last target.
+            inputs = inputs.at[:, 0].set(shardops.shift("s", batch.targets[:, -1]))
+        is_seq_start: bool_[b"batch/d len/s"] = batch.is_seq_start
+        inputs: u32[b"batch/d len/s"] = jnp.where(is_seq_start, 0, inputs)
+
+        x, moe_stats = self.final_hidden_states(h, inputs, is_seq_start)
+        unembed = self.gathered_unembed(h)
+        if h.loss_chunk_size is None:
+
+            def output_sum_logprobs(x, targets):
+                logits = shardops.einsum_unreduced(
+                    "B/d L/s M, V/t M -> B/d L/s V/t",
+                    x,
+                    unembed,
+                    preferred_element_type=jnp.float32,
+                )
+                return jnp.sum(target_logprobs(logits, targets))
 
-        logits: f32[b"batch/d len V/t"] = self.forward_pass(h, inputs, is_seq_start)
-        max_logits: f32[b"batch/d len 1"] = lax.pmax(
-            jnp.max(lax.stop_gradient(logits), axis=-1, keepdims=True), "t"
-        )
-        logits = logits - max_logits
-        sum_logits = lax.psum(jnp.sum(jnp.exp(logits), axis=-1, keepdims=True), "t")
-        logsumexp = jnp.log(sum_logits)
-        logprobs: f32[b"batch/d len V/t"] = logits - logsumexp
-        logprobs_at_targets = shardops.index_unreduced(
-            "batch/d len [V/t], batch/d len -> batch/d len", logprobs, batch.targets
-        )
-        logprobs_at_targets = shardops.psum_scatter(
-            "batch/d len -> batch/d len/t", logprobs_at_targets
-        )
-        tokens_in_global_batch = logprobs_at_targets.size * jax.lax.psum(1, ("d", "t"))
-        return -jnp.sum(logprobs_at_targets) / jnp.float32(tokens_in_global_batch)
+        else:
+            # Fused output projection and cross-entropy, one sequence chunk at a time. Each
+            # chunk is rematerialized in the backward pass, so only one chunk's worth of
+            # `batch/d chunk V/t` logits is ever live.
+            chunk = h.loss_chunk_size
+            assert (
+                batch.targets.shape[1] % chunk == 0
+            ), f"Sequence length must be a multiple of loss_chunk_size {chunk}."
+
+            @jax.checkpoint
+            def chunk_sum_logprobs(x, targets):
+                logits = shardops.einsum_unreduced(
+                    "B/d C M, V/t M -> B/d C V/t",
+                    x,
+                    unembed,
+                    preferred_element_type=jnp.float32,
+                )
+                return jnp.sum(target_logprobs(logits, targets))
+
+            def loop_body(total, chunk_inputs):
+                return total + chunk_sum_logprobs(*chunk_inputs), ()
+
+            def output_sum_logprobs(x, targets):
+                sum_logprobs, () = lax.scan(
+                    loop_body,
+                    jnp.float32(0.0),
+                    (_to_blocks(x, chunk), _to_blocks(targets, chunk)),
+                )
+                return sum_logprobs
+
+        if get_pipeline_stages(h, self.transformer) > 1:
+            # Only the last pipeline stage holds the transformer's real output, so only it
+            # runs the output projection and cross-entropy. The weight all_gathers above
+            # span stages, so every stage runs them; the branch's collectives are over `t`
+            # only, whose chips are all on the same stage.
+            is_last_stage = lax.axis_index("p") == shardops.axis_size("p") - 1
+            sum_logprobs = lax.cond(
+                is_last_stage,
+                output_sum_logprobs,
+                lambda x, targets: jnp.float32(0.0),
+                x,
+                batch.targets,
+            )
+        else:
+            sum_logprobs = output_sum_logprobs(x, batch.targets)
+        tokens_in_global_batch = batch.targets.size * jax.lax.psum(1, ("d", "s"))
+        loss = -sum_logprobs / jnp.float32(tokens_in_global_batch)
+        if h.moe_experts:
+            # Each `d`/`s` shard's tokens have their own statistics, which its `t` chips all
+            # compute, so this sums to the mean over shards when reduced across chips.
+            aux_loss_weight = h.moe_aux_loss_weight
+            if aux_loss_weight is None:
+                aux_loss_weight = 0.01
+            loss += (
+                aux_loss_weight
+                * moe_stats.load_balance_loss
+                / jax.lax.psum(1, ("d", "s", "t"))
+            )
+        return loss, moe_stats
+
+
+@pytree_dataclass
+class MoEModel(Model):
+    """A `Model` whose FFNs are mixtures of experts: see `Hparams.moe_experts`."""
+
+    transformer: MoETransformer
+
+
+AnyModel = Union[Model, MoEModel]
+
+
+def get_model_type(h: Hparams) -> type:
+    return MoEModel if h.moe_experts else Model
+
+
+@shardtypes.scope
+@typechecked
+def target_logprobs(
+    logits: f32[b"B/d L/s V/t"], targets: u32[b"B/d L/s"]
+) -> f32[b"B/d L/s/t"]:
+    """Log-softmax of vocab-sharded logits, evaluated at the targets.
+
+    The result is reduce-scattered over `t`, so each chip holds a disjoint share.
+    """
+    max_logits: f32[b"B/d L/s 1"] = lax.pmax(
+        jnp.max(lax.stop_gradient(logits), axis=-1, keepdims=True), "t"
+    )
+    logits = logits - max_logits
+    sum_logits = lax.psum(jnp.sum(jnp.exp(logits), axis=-1, keepdims=True), "t")
+    logsumexp = jnp.log(sum_logits)
+    logprobs: f32[b"B/d L/s V/t"] = logits - logsumexp
+    logprobs_at_targets = shardops.index_unreduced(
+        "B/d L/s [V/t], B/d L/s -> B/d L/s", logprobs, targets
+    )
+    return shardops.psum_scatter("B/d L/s -> B/d L/s/t", logprobs_at_targets)
 
 
 @pytree_dataclass
@@ -516,7 +1440,8 @@ class RopeTable:
     cos: f32["len d_head2"]
 
     @staticmethod
-    def create(max_len: int, hparams: Hparams) -> "RopeTable":
+    def create(max_len: int, hparams: Hparams, start=0) -> "RopeTable":
+        """Table for positions `[start, start + max_len)`. `start` may be traced."""
         rope_max_timescale = hparams.rope_max_timescale
         d_head = hparams.d_head
         d = d_head // 2
@@ -524,7 +1449,7 @@ class RopeTable:
         timescale = jnp.logspace(
             0, jnp.log10(jnp.float32(rope_max_timescale)), d, endpoint=False
         )
-        position = jnp.arange(max_len, dtype=jnp.int32)
+        position = start + jnp.arange(max_len, dtype=jnp.int32)
         sinusoid_inp = jnp.float32(position[:, jnp.newaxis]) / timescale[jnp.newaxis, :]
         sin = jnp.sin(sinusoid_inp)
         cos = jnp.cos(sinusoid_inp)
@@ -539,20 +1464,739 @@ class RopeTable:
         return jnp.append(r1, r2, axis=-1)
 
 
+@shardtypes.scope
 @typechecked
-def rms_norm(x: bf16[b"batch/d len M"]) -> bf16[b"batch/d len M"]:
+def rms_norm(x: bf16[b"batch/d len/s M"]) -> bf16[b"batch/d len/s M"]:
     mean2 = save_for_backward(
         jnp.mean(jax.lax.square(jnp.float32(x)), axis=-1, keepdims=True)
     )
     return jnp.bfloat16(x * jax.lax.rsqrt(mean2 + 1e-6))
 
 
+def dense_attention(q, k, v, mask, logit_scale, k_scale=None, v_scale=None):
+    """Attention over the full `Qlen x Klen` logits, for q `B/d Qlen Q K/t D` and k, v
+    `B/d Klen K/t D`. `mask` must broadcast to `B/d Qlen Klen Q K/t`.
+
+    If given, `k_scale` and `v_scale` (`B/d Klen K/t`) are per-key dequantization scales for
+    `k` and `v`."""
+    logits = logit_scale * shardops.einsum_unreduced(
+        "B/d Qlen Q K/t D, B/d Klen K/t D -> B/d Qlen Klen Q K/t",
+        q,
+        k,
+        preferred_element_type=jnp.float32,
+    )
+    if k_scale is not None:
+        logits = logits * k_scale[:, jnp.newaxis, :, jnp.newaxis, :]
+    logits = jnp.where(mask, logits, -1e10)
+    probs = jax.nn.softmax(logits, axis=2)
+    if v_scale is not None:
+        probs = probs * v_scale[:, jnp.newaxis, :, jnp.newaxis, :]
+    probs = jnp.bfloat16(probs)
+    return shardops.einsum_unreduced(
+        "B/d Qlen Klen Q K/t, B/d Klen K/t D -> B/d Qlen Q K/t D", probs, v
+    )
+
+
+##### Blockwise attention.
+#
+# Computes the same result as the dense attention in `Model.forward_pass`, but tiles over
+# query blocks and key blocks and uses an online softmax (https://arxiv.org/abs/2205.14135),
+# so the full `B Qlen Klen Q K` logits tensor is never materialized. The backward pass is
+# written by hand so that it also recomputes logits tile by tile, rather than having autodiff
+# save every tile of probabilities.
+#
+# With `skip_masked_tiles`, tiles whose mask is entirely false (above the causal diagonal,
+# or pairing query and key blocks from disjoint packed documents) are skipped with a
+# `lax.cond`. Skipping is decided per sequence: packed sequences rarely share their document
+# boundaries, so a tile is seldom fully masked for every sequence at once. The local batch is
+# then attended one sequence at a time, giving up per-tile matmuls over the whole local batch
+# for the tiles each sequence skips.
+#
+# Everything here is chip-local: it runs inside `shard_map` on `B/d` and `K/t` shards, so
+# no communication is needed.
+
+
+def _to_blocks(x, block_size: int):
+    """[B, L, ...] -> [L // block_size, B, block_size, ...]"""
+    B, L = x.shape[:2]
+    x = x.reshape(B, L // block_size, block_size, *x.shape[2:])
+    return jnp.moveaxis(x, 1, 0)
+
+
+def _from_blocks(x):
+    """[n, B, block_size, ...] -> [B, n * block_size, ...]"""
+    x = jnp.moveaxis(x, 0, 1)
+    return x.reshape(x.shape[0], x.shape[1] * x.shape[2], *x.shape[3:])
+
+
+@typechecked
+def _tile_mask(
+    q_segment_ids: i32[b"B/d Qb"],
+    k_segment_ids: i32[b"B/d Kb"],
+    q_positions: i32[b"B/d Qb"],
+    k_positions: i32[b"B/d Kb"],
+    window: Optional[int] = None,
+) -> bool_[b"B/d Qb Kb 1 1"]:
+    """Causal and same-document mask for one (query block, key block) tile. With a
+    `window`, queries also only see the `window` most recent positions, including their own.
+    """
+    distance = q_positions[:, :, jnp.newaxis] - k_positions[:, jnp.newaxis, :]
+    mask = jnp.logical_and(
+        q_segment_ids[:, :, jnp.newaxis] == k_segment_ids[:, jnp.newaxis, :],
+        distance >= 0,
+    )
+    if window is not None:
+        mask = jnp.logical_and(mask, distance < window)
+    return mask[..., jnp.newaxis, jnp.newaxis]
+
+
+@typechecked
+def _rows_tile_is_live(
+    q_segment_ids: i32[b"B/d Qb"],
+    k_segment_ids: i32[b"B/d Kb"],
+    q_positions: i32[b"B/d Qb"],
+    k_positions: i32[b"B/d Kb"],
+    window: Optional[int] = None,
+) -> bool_[b"B/d"]:
+    """For each sequence, false iff its `_tile_mask` is all false, computed from per-block
+    ranges only.
+
+    Segment ids are non-decreasing along the sequence, so two blocks share a document
+    exactly when their segment id ranges overlap.
+    """
+    segments_overlap = jnp.logical_and(
+        jnp.min(q_segment_ids, axis=1) <= jnp.max(k_segment_ids, axis=1),
+        jnp.min(k_segment_ids, axis=1) <= jnp.max(q_segment_ids, axis=1),
+    )
+    causally_visible = jnp.min(k_positions, axis=1) <= jnp.max(q_positions, axis=1)
+    if window is not None:
+        causally_visible = jnp.logical_and(
+            causally_visible,
+            jnp.max(k_positions, axis=1) > jnp.min(q_positions, axis=1) - window,
+        )
+    return jnp.logical_and(segments_overlap, causally_visible)
+
+
+def _tile_is_live(*tile_ids) -> bool_[b""]:
+    """False iff `_tile_mask` is all false for every sequence: see `_rows_tile_is_live`."""
+    return jnp.any(_rows_tile_is_live(*tile_ids))
+
+
+@typechecked
+def attention_tile_skip_fraction(
+    segment_ids: i32[b"B/d L/s"],
+    positions: i32[b"B/d L/s"],
+    block_size: int,
+    window: Optional[int] = None,
+) -> f32[b""]:
+    """Fraction of (query block, key block, sequence) tiles that `skip_masked_tiles` skips.
+    With a `window`, tiles outside the band that is visited at all also count as skipped.
+
+    Tiles are skipped per sequence, so this is also the fraction that each microbatch of the
+    batch skips, however the batch is split."""
+    seg_blocks, pos_blocks = (
+        _to_blocks(x, block_size) for x in (segment_ids, positions)
+    )
+    is_live = partial(_rows_tile_is_live, window=window)
+    per_k_block = jax.vmap(is_live, in_axes=(None, 0, None, 0))
+    per_tile = jax.vmap(per_k_block, in_axes=(0, None, 0, None))
+    live = per_tile(seg_blocks, seg_blocks, pos_blocks, pos_blocks)
+    return 1.0 - jnp.mean(jnp.float32(live))
+
+
+def _tile_logits(q, k, mask, logit_scale):
+    logits = logit_scale * shardops.einsum_unreduced(
+        "B/d Qb Q K/t D, B/d Kb K/t D -> B/d Qb Kb Q K/t",
+        q,
+        k,
+        preferred_element_type=jnp.float32,
+    )
+    return jnp.where(mask, logits, -1e10)
+
+
+def _map_rows(f, *xs):
+    """Stacks `f` of each sequence of the chip-local batch `xs`, each as a batch of one,
+    computed one at a time. `xs` may include None."""
+
+    def row(xs):
+        out = f(*jax.tree.map(lambda x: x[jnp.newaxis], xs))
+        return jax.tree.map(lambda x: x[0], out)
+
+    return lax.map(row, xs)
+
+
+def _for_live_tiles(skip_masked_tiles, tile_ids, valid, update, skipped, carry):
+    """Returns `update(carry)`, or `skipped(carry)` if the tile is fully masked.
+
+    `tile_ids` are the arguments to `_tile_mask`; `valid` is false for band slots that
+    fall off either end of the sequence."""
+    if not skip_masked_tiles:
+        return update(carry)
+    is_live = jnp.logical_and(_tile_is_live(*tile_ids), valid)
+    return lax.cond(is_live, update, skipped, carry)
+
+
+def _band_size(n_blocks: int, block_size: int, window: Optional[int]) -> int:
+    """Number of key blocks that can be visible from one query block."""
+    if window is None:
+        return n_blocks
+    return min(n_blocks, -(-(window - 1) // block_size) + 1)
+
+
+def _band(n_blocks: int, band_size: int, window: Optional[int], reverse: bool = False):
+    """For each block, the indices of the `band_size` blocks it interacts with, clamped to
+    `[0, n_blocks)`, and whether each index was in range.
+
+    Forward (query block -> key blocks): the key blocks ending at the diagonal. Reverse (key
+    block -> query blocks): the query blocks starting at the diagonal. With no window, every
+    block interacts with every block, in order."""
+    if window is None:
+        ids = jnp.broadcast_to(jnp.arange(n_blocks), (n_blocks, n_blocks))
+        return ids, jnp.ones((n_blocks, n_blocks), dtype=jnp.bool_)
+    offsets = jnp.arange(band_size)[jnp.newaxis, :]
+    diagonal = jnp.arange(n_blocks)[:, jnp.newaxis]
+    ids = diagonal + offsets if reverse else diagonal - (band_size - 1) + offsets
+    valid = jnp.logical_and(ids >= 0, ids < n_blocks)
+    return jnp.clip(ids, 0, n_blocks - 1), valid
+
+
+@shardtypes.scope
+def _blockwise_attention_fwd_impl(
+    q,
+    k,
+    v,
+    segment_ids,
+    positions,
+    logit_scale,
+    block_size,
+    skip_masked_tiles,
+    window,
+    k_segment_ids=None,
+    k_positions=None,
+):
+    """Returns the f32 output and its logsumexp. The keys' `k_segment_ids` and
+    `k_positions` default to the queries'. If given, the keys may be any other part of the
+    sequence, so every key block is visited rather than just the window's band."""
+    if skip_masked_tiles and q.shape[0] > 1:
+
+        def row(q, k, v, segment_ids, positions, k_segment_ids, k_positions):
+            return _blockwise_attention_fwd_impl(
+                q,
+                k,
+                v,
+                segment_ids,
+                positions,
+                logit_scale,
+                block_size,
+                skip_masked_tiles,
+                window,
+                k_segment_ids,
+                k_positions,
+            )
+
+        return _map_rows(
+            row,
+            q,
+            k,
+            v,
+            segment_ids,
+            positions,
+            k_segment_ids,
+            k_positions,
+        )
+    band_window = window if k_segment_ids is None else None
+    if k_segment_ids is None:
+        k_segment_ids, k_positions = segment_ids, positions
+    q_blocks, seg_blocks, pos_blocks = (
+        _to_blocks(x, block_size) for x in (q, segment_ids, positions)
+    )
+    k_blocks, v_blocks, k_seg_blocks, k_pos_blocks = (
+        _to_blocks(x, block_size) for x in (k, v, k_segment_ids, k_positions)
+    )
+    B, _, Q, K, D = q.shape
+    n_blocks = q_blocks.shape[0]
+    k_ids, k_valid = _band(
+        n_blocks, _band_size(n_blocks, block_size, band_window), band_window
+    )
+
+    def q_block(args):
+        q_i, seg_i, pos_i, k_ids_i, k_valid_i = args
+
+        def k_step(carry, args):
+            j, valid = args
+            k_j, v_j, seg_j, pos_j = (
+                x[j] for x in (k_blocks, v_blocks, k_seg_blocks, k_pos_blocks)
+            )
+            tile_ids = (seg_i, seg_j, pos_i, pos_j, window)
+
+            # Out-of-range band slots come before the diagonal block, so although they're
+            # fully masked, any contribution they make is erased by the online softmax's
+            # rescaling once the first real logit is seen.
+            def update(carry):
+                max_logits, sum_probs, acc = carry
+                mask = jnp.logical_and(_tile_mask(*tile_ids), valid)
+                logits = _tile_logits(q_i, k_j, mask, logit_scale)
+                new_max_logits = jnp.maximum(max_logits, jnp.max(logits, axis=2))
+                probs = jnp.exp(logits - new_max_logits[:, :, jnp.newaxis])
+                correction = jnp.exp(max_logits - new_max_logits)
+                sum_probs = correction * sum_probs + jnp.sum(probs, axis=2)
+                acc = correction[..., jnp.newaxis] * acc + shardops.einsum_unreduced(
+                    "B/d Qb Kb Q K/t, B/d Kb K/t D -> B/d Qb Q K/t D",
+                    jnp.bfloat16(probs),
+                    v_j,
+                    preferred_element_type=jnp.float32,
+                )
+                return new_max_logits, sum_probs, acc
+
+            carry = _for_live_tiles(
+                skip_masked_tiles,
+                tile_ids,
+                valid,
+                update,
+                lambda carry: carry,
+                carry,
+            )
+            return carry, ()
+
+        init = (
+            jnp.full((B, block_size, Q, K), -jnp.inf, dtype=jnp.float32),
+            jnp.zeros((B, block_size, Q, K), dtype=jnp.float32),
+            jnp.zeros((B, block_size, Q, K, D), dtype=jnp.float32),
+        )
+        (max_logits, sum_probs, acc), () = lax.scan(k_step, init, (k_ids_i, k_valid_i))
+        out = acc / sum_probs[..., jnp.newaxis]
+        logsumexp = max_logits + jnp.log(sum_probs)
+        return out, logsumexp
+
+    out, logsumexp = lax.map(
+        q_block, (q_blocks, seg_blocks, pos_blocks, k_ids, k_valid)
+    )
+    return _from_blocks(out), _from_blocks(logsumexp)
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(5, 6, 7, 8))
+def blockwise_attention(
+    q,
+    k,
+    v,
+    segment_ids,
+    positions,
+    logit_scale,
+    block_size,
+    skip_masked_tiles=False,
+    window=None,
+):
+    """Causal, document-masked attention computed in `block_size` tiles.
+
+    Shapes (chip-local): q is `B Qlen Q K D`, k and v are `B Klen K D`, segment_ids and
+    positions are `B L`. Returns `B Qlen Q K D` in bf16, matching the dense path.
+
+    With a `window`, each query attends only to the `window` most recent positions, and only
+    the band of tiles that can be visible is visited, so cost is O(L * window).
+    """
+    out, _ = _blockwise_attention_fwd_impl(
+        q,
+        k,
+        v,
+        segment_ids,
+        positions,
+        logit_scale,
+        block_size,
+        skip_masked_tiles,
+        window,
+    )
+    return jnp.bfloat16(out)
+
+
+def _blockwise_attention_fwd(
+    q, k, v, segment_ids, positions, logit_scale, block_size, skip_masked_tiles, window
+):
+    out, logsumexp = _blockwise_attention_fwd_impl(
+        q,
+        k,
+        v,
+        segment_ids,
+        positions,
+        logit_scale,
+        block_size,
+        skip_masked_tiles,
+        window,
+    )
+    out = jnp.bfloat16(out)
+    return out, (q, k, v, segment_ids, positions, out, logsumexp)
+
+
+def _blockwise_attention_bwd(
+    logit_scale, block_size, skip_masked_tiles, window, residuals, d_out
+):
+    q, k, v, segment_ids, positions, out, logsumexp = residuals
+    # Row-wise sum(d_out * out), which is the softmax-backward correction term.
+    delta = jnp.sum(jnp.float32(d_out) * jnp.float32(out), axis=-1)
+    d_q, d_k, d_v = _blockwise_attention_bwd_impl(
+        q,
+        k,
+        v,
+        segment_ids,
+        positions,
+        logsumexp,
+        delta,
+        d_out,
+        logit_scale,
+        block_size,
+        skip_masked_tiles,
+        window,
+    )
+    return (
+        d_q.astype(q.dtype),
+        d_k.astype(k.dtype),
+        d_v.astype(v.dtype),
+        None,
+        None,
+    )
+
+
+@shardtypes.scope
+def _blockwise_attention_bwd_impl(
+    q,
+    k,
+    v,
+    segment_ids,
+    positions,
+    logsumexp,
+    delta,
+    d_out,
+    logit_scale,
+    block_size,
+    skip_masked_tiles,
+    window,
+    k_segment_ids=None,
+    k_positions=None,
+):
+    """f32 gradients with respect to q, k and v, given the forward pass's `logsumexp` and
+    the softmax-backward term `delta`. Keys are as in `_blockwise_attention_fwd_impl`.
+    """
+    if skip_masked_tiles and q.shape[0] > 1:
+
+        def row(q, k, v, segment_ids, positions, logsumexp, delta, d_out, *k_ids):
+            return _blockwise_attention_bwd_impl(
+                q,
+                k,
+                v,
+                segment_ids,
+                positions,
+                logsumexp,
+                delta,
+                d_out,
+                logit_scale,
+                block_size,
+                skip_masked_tiles,
+                window,
+                *k_ids,
+            )
+
+        return _map_rows(
+            row,
+            q,
+            k,
+            v,
+            segment_ids,
+            positions,
+            logsumexp,
+            delta,
+            d_out,
+            k_segment_ids,
+            k_positions,
+        )
+    band_window = window if k_segment_ids is None else None
+    if k_segment_ids is None:
+        k_segment_ids, k_positions = segment_ids, positions
+    q_blocks, seg_blocks, pos_blocks, d_out_blocks = (
+        _to_blocks(x, block_size) for x in (q, segment_ids, positions, d_out)
+    )
+    k_blocks, v_blocks, k_seg_blocks, k_pos_blocks = (
+        _to_blocks(x, block_size) for x in (k, v, k_segment_ids, k_positions)
+    )
+    lse_blocks, delta_blocks = (_to_blocks(x, block_size) for x in (logsumexp, delta))
+    n_blocks = q_blocks.shape[0]
+    q_ids, q_valid = _band(
+        n_blocks,
+        _band_size(n_blocks, block_size, band_window),
+        band_window,
+        reverse=True,
+    )
+
+    def k_block(d_q, args):
+        k_j, v_j, seg_j, pos_j, q_ids_j, q_valid_j = args
+
+        def q_step(carry, args):
+            i, valid = args
+            q_i, d_out_i, lse_i, delta_i, seg_i, pos_i = (
+                x[i]
+                for x in (
+                    q_blocks,
+                    d_out_blocks,
+                    lse_blocks,
+                    delta_blocks,
+                    seg_blocks,
+                    pos_blocks,
+                )
+            )
+            tile_ids = (seg_i, seg_j, pos_i, pos_j, window)
+
+            # Out-of-range band slots are fully masked, so they contribute exactly zero.
+            def update(carry):
+                d_k_j, d_v_j, _ = carry
+                mask = jnp.logical_and(_tile_mask(*tile_ids), valid)
+                logits = _tile_logits(q_i, k_j, mask, logit_scale)
+                probs = jnp.exp(logits - lse_i[:, :, jnp.newaxis])
+                d_v_j += shardops.einsum_unreduced(
+                    "B/d Qb Kb Q K/t, B/d Qb Q K/t D -> B/d Kb K/t D",
+                    jnp.bfloat16(probs),
+                    d_out_i,
+                    preferred_element_type=jnp.float32,
+                )
+                d_probs = shardops.einsum_unreduced(
+                    "B/d Qb Q K/t D, B/d Kb K/t D -> B/d Qb Kb Q K/t",
+                    d_out_i,
+                    v_j,
+                    preferred_element_type=jnp.float32,
+                )
+                d_logits = logit_scale * probs * (d_probs - delta_i[:, :, jnp.newaxis])
+                d_q_i = shardops.einsum_unreduced(
+                    "B/d Qb Kb Q K/t, B/d Kb K/t D -> B/d Qb Q K/t D",
+                    d_logits,
+                    jnp.float32(k_j),
+                )
+                d_k_j += shardops.einsum_unreduced(
+                    "B/d Qb Kb Q K/t, B/d Qb Q K/t D -> B/d Kb K/t D",
+                    d_logits,
+                    jnp.float32(q_i),
+                )
+                return d_k_j, d_v_j, d_q_i
+
+            def skipped(carry):
+                d_k_j, d_v_j, _ = carry
+                return d_k_j, d_v_j, jnp.zeros(q_i.shape, dtype=jnp.float32)
+
+            d_k_j, d_v_j, d_q_i = _for_live_tiles(
+                skip_masked_tiles,
+                tile_ids,
+                valid,
+                update,
+                skipped,
+                (*carry, jnp.zeros(q_i.shape, dtype=jnp.float32)),
+            )
+            return (d_k_j, d_v_j), d_q_i
+
+        init = (
+            jnp.zeros(k_j.shape, dtype=jnp.float32),
+            jnp.zeros(v_j.shape, dtype=jnp.float32),
+        )
+        (d_k_j, d_v_j), d_q_blocks = lax.scan(q_step, init, (q_ids_j, q_valid_j))
+        return d_q.at[q_ids_j].add(d_q_blocks), (d_k_j, d_v_j)
+
+    d_q, (d_k, d_v) = lax.scan(
+        k_block,
+        jnp.zeros(q_blocks.shape, dtype=jnp.float32),
+        (k_blocks, v_blocks, k_seg_blocks, k_pos_blocks, q_ids, q_valid),
+    )
+    return _from_blocks(d_q), _from_blocks(d_k), _from_blocks(d_v)
+
+
+blockwise_attention.defvjp(_blockwise_attention_fwd, _blockwise_attention_bwd)
+
+
+@partial(jax.custom_vjp, nondiff_argnums=(5, 6, 7, 8))
+def ring_attention(
+    q,
+    k,
+    v,
+    segment_ids,
+    positions,
+    logit_scale,
+    block_size,
+    skip_masked_tiles=False,
+    window=None,
+):
+    """`blockwise_attention` over sequences sharded along the `s` mesh axis.
+
+    Shapes are as in `blockwise_attention`, for this chip's shard of the sequence; the
+    `segment_ids` and `positions` are sequence-global, from `sequence_positions`. Keys and
+    values travel around the ring of `s` shards one hop per step, and each chip merges its
+    queries' attention to every shard it receives into a running softmax. Shards that no
+    query can see, such as those entirely in the queries' future, are skipped. The backward
+    pass runs the ring again, and key and value gradients travel along with their shard.
+    """
+    out, _ = _ring_attention_fwd_impl(
+        q,
+        k,
+        v,
+        segment_ids,
+        positions,
+        logit_scale,
+        block_size,
+        skip_masked_tiles,
+        window,
+    )
+    return out
+
+
+def _ring_attention_fwd(
+    q, k, v, segment_ids, positions, logit_scale, block_size, skip_masked_tiles, window
+):
+    out, logsumexp = _ring_attention_fwd_impl(
+        q,
+        k,
+        v,
+        segment_ids,
+        positions,
+        logit_scale,
+        block_size,
+        skip_masked_tiles,
+        window,
+    )
+    return out, (q, k, v, segment_ids, positions, out, logsumexp)
+
+
+def _ring_shift(xs):
+    return tuple(shardops.shift("s", x, wrap=True) for x in xs)
+
+
+@shardtypes.scope
+def _ring_attention_fwd_impl(
+    q, k, v, segment_ids, positions, logit_scale, block_size, skip_masked_tiles, window
+):
+    B, L, Q, K, D = q.shape
+
+    def attend(shard, out, logsumexp):
+        k_r, v_r, seg_r, pos_r = shard
+
+        def live(_):
+            return _blockwise_attention_fwd_impl(
+                q,
+                k_r,
+                v_r,
+                segment_ids,
+                positions,
+                logit_scale,
+                block_size,
+                skip_masked_tiles,
+                window,
+                seg_r,
+                pos_r,
+            )
+
+        def skipped(_):
+            return (
+                jnp.zeros(q.shape, dtype=jnp.float32),
+                jnp.full((B, L, Q, K), -jnp.inf, dtype=jnp.float32),
+            )
+
+        is_live = _tile_is_live(segment_ids, seg_r, positions, pos_r, window)
+        out_r, logsumexp_r = lax.cond(is_live, live, skipped, None)
+        # Queries that see none of this shard's keys have an undefined output here, and
+        # contribute nothing.
+        out_r = jnp.where(jnp.isneginf(logsumexp_r)[..., jnp.newaxis], 0.0, out_r)
+        new_logsumexp = jnp.logaddexp(logsumexp, logsumexp_r)
+        out = (
+            jnp.exp(logsumexp - new_logsumexp)[..., jnp.newaxis] * out
+            + jnp.exp(logsumexp_r - new_logsumexp)[..., jnp.newaxis] * out_r
+        )
+        return out, new_logsumexp
+
+    # This chip's own shard comes first: every query sees at least itself there, so the
+    # running logsumexp is finite from then on.
+    shard = (k, v, segment_ids, positions)
+    out, logsumexp = attend(
+        shard,
+        jnp.zeros(q.shape, dtype=jnp.float32),
+        jnp.full((B, L, Q, K), -jnp.inf, dtype=jnp.float32),
+    )
+
+    def step(carry, _):
+        shard, out, logsumexp = carry
+        shard = _ring_shift(shard)
+        out, logsumexp = attend(shard, out, logsumexp)
+        return (shard, out, logsumexp), ()
+
+    (_, out, logsumexp), () = lax.scan(
+        step, (shard, out, logsumexp), None, length=shardops.axis_size("s") - 1
+    )
+    return jnp.bfloat16(out), logsumexp
+
+
+@shardtypes.scope
+def _ring_attention_bwd(
+    logit_scale, block_size, skip_masked_tiles, window, residuals, d_out
+):
+    q, k, v, segment_ids, positions, out, logsumexp = residuals
+    delta = jnp.sum(jnp.float32(d_out) * jnp.float32(out), axis=-1)
+
+    def grads(shard):
+        k_r, v_r, seg_r, pos_r = shard
+
+        def live(_):
+            return _blockwise_attention_bwd_impl(
+                q,
+                k_r,
+                v_r,
+                segment_ids,
+                positions,
+                logsumexp,
+                delta,
+                d_out,
+                logit_scale,
+                block_size,
+                skip_masked_tiles,
+                window,
+                seg_r,
+                pos_r,
+            )
+
+        def skipped(_):
+            return tuple(jnp.zeros(x.shape, dtype=jnp.float32) for x in (q, k_r, v_r))
+
+        is_live = _tile_is_live(segment_ids, seg_r, positions, pos_r, window)
+        return lax.cond(is_live, live, skipped, None)
+
+    shard = (k, v, segment_ids, positions)
+    d_q, d_k, d_v = grads(shard)
+
+    def step(carry, _):
+        shard, d_q, d_k, d_v = carry
+        shard, d_k, d_v = _ring_shift(shard), *_ring_shift((d_k, d_v))
+        d_q_r, d_k_r, d_v_r = grads(shard)
+        return (shard, d_q + d_q_r, d_k + d_k_r, d_v + d_v_r), ()
+
+    (_, d_q, d_k, d_v), () = lax.scan(
+        step, (shard, d_q, d_k, d_v), None, length=shardops.axis_size("s") - 1
+    )
+    # Each shard's key and value gradients are one hop short of home.
+    d_k, d_v = _ring_shift((d_k, d_v))
+    return (
+        d_q.astype(q.dtype),
+        d_k.astype(k.dtype),
+        d_v.astype(v.dtype),
+        None,
+        None,
+    )
+
+
+ring_attention.defvjp(_ring_attention_fwd, _ring_attention_bwd)
+
+
 @pytree_dataclass
 class Metrics:
     loss: f32[b""]
     learning_rate: f32[b""]
     grad_norm: f32[b""]
     raw_grad_norm: f32[b""]
+    # Fraction of attention tiles skipped by `attention: block_sparse`; zero otherwise.
+    attention_tiles_skipped: f32[b""]
+    # `MoEStats`, averaged over layers and chips, of a mixture-of-experts model; zero
+    # otherwise. `loss` includes `moe_aux_loss_weight * moe_load_balance_loss`.
+    moe_load_balance_loss: f32[b""]
+    moe_dropped_tokens: f32[b""]
 
 
 @dataclass(frozen=True)
@@ -575,6 +2219,170 @@ class TrainingHparams:
     use_gpu: Optional[bool] = False
     use_single_worker: Optional[bool] = False
     use_multistage_training: Optional[bool] = False
+    # Gradient accumulation: each training step scans over this many equal slices of the
+    # batch, accumulating f32 gradients, and applies one optimizer update. The batch size,
+    # and so the LR schedule, is unchanged; only peak activation memory shrinks.
+    microbatches: Optional[int] = None
+    # Storage for the Adam moments in `State`: one of `OPTIMIZER_STATE_DTYPES`, defaulting to
+    # "float32". "bfloat16" halves their memory and checkpoint size. "int8" stores the first
+    # moment with blockwise absmax quantization and the second moment in bf16, for about 3
+    # bytes per weight instead of 8. The update itself is always computed in f32.
+    optimizer_state_dtype: Optional[str] = None
+    # With "int8", the last axis of each weight is quantized in blocks of this many elements
+    # (fewer if the whole axis isn't a multiple), each with a bf16 scale. Defaults to 256.
+    # Blocks are chosen from the global axis, so checkpoints restore on any mesh, and must
+    # divide each chip's shard of it. Weights whose last axis is split over `d`, `s` or `p`
+    # aren't quantized (see `is_quantized_moment`), so only `t` splits quantized axes.
+    optimizer_state_block_size: Optional[int] = None
+    # One of `OPTIMIZERS`: how the second moment of the gradient is estimated and stored.
+    # Defaults to "adam".
+    optimizer: Optional[str] = None
+    # Number of training batches loaded ahead on a background thread, so that data loading
+    # overlaps with training steps. Defaults to 0: each batch is loaded when it's needed.
+    prefetch_batches: Optional[int] = None
+
+
+OPTIMIZER_STATE_DTYPES = ("float32", "bfloat16", "int8")
+
+
+def is_quantized_moment(shape: shardtypes.ShapeSpec) -> bool:
+    """Whether "int8" quantizes the first moment of a weight of `shape`. Weights whose last
+    axis is split over the data-parallel axes (the layer norms and the embeddings) have shards
+    of that axis too small to block on every mesh, so they keep a bf16 first moment, as 8-bit
+    Adam keeps small tensors in higher precision. Depends only on `shape`, not the mesh.
+    """
+    return not set(shape.dims[-1].sharding) & {"d", "s", "p"}
+
+
+def _block_scales_type(name: str, number_type, shape: shardtypes.ShapeSpec):
+    """One scale per block of the last axis, sharded like the last axis. Unquantized weights
+    have an unused scalar scale, so that every weight has one."""
+    if not is_quantized_moment(shape):
+        return bf16[""]
+    *leading, last = shape.dims
+    blocks = shardtypes.DimSpec(f"{name}_blocks", last.sharding)
+    return bf16[str(shardtypes.ShapeSpec([*leading, blocks]))]
+
+
+def _bf16_type(name: str, number_type, shape: shardtypes.ShapeSpec):
+    return bf16[str(shape)]
+
+
+def _int8_type(name: str, number_type, shape: shardtypes.ShapeSpec):
+    return i8[str(shape)] if is_quantized_moment(shape) else bf16[str(shape)]
+
+
+@cache
+def map_model_type(f, model_type: type) -> type:
+    """`shardtypes.map_array_types(f, model_type)`, built once per `f` and model type."""
+    return shardtypes.map_array_types(f, model_type)
+
+
+@pytree_dataclass
+class QuantizedMoment:
+    """An Adam first moment stored as int8 blocks along the last axis of each weight, with one
+    bf16 absmax scale per block, or in bf16 for weights that `is_quantized_moment` excludes.
+
+    The second moment isn't quantized like this, even as its square root: entries below 1/254
+    of their block's absmax would round to 0, giving those weights a full `arctan2` step of
+    pi/2, and its small per-step EMA updates would round away. It is kept in bf16 instead.
+
+    The fields' types depend on the model type: see `get_quantized_moment_type`."""
+
+    values: Any
+    scales: Any
+
+
+@cache
+def get_quantized_moment_type(model_type: type) -> type:
+    fields = [
+        ("values", map_model_type(_int8_type, model_type)),
+        ("scales", map_model_type(_block_scales_type, model_type)),
+    ]
+    return pytree_dataclass(
+        make_dataclass("QuantizedMoment", fields, bases=(QuantizedMoment,))
+    )
+
+
+def moment_block_size(
+    hparams: TrainingHparams, shape: shardtypes.ShapeSpec, shard_len: int
+) -> int:
+    """The int8 block size along the last axis of a weight of `shape`, of which this chip holds
+    `shard_len` elements. It depends only on the global axis, so that the number of scales, and
+    so the checkpoint's layout, doesn't depend on the mesh."""
+    last = shape.dims[-1]
+    global_len = shard_len * math.prod(shardops.axis_size(a) for a in last.sharding)
+    block_size = math.gcd(global_len, hparams.optimizer_state_block_size or 256)
+    if shard_len % block_size != 0:
+        raise ValueError(
+            f"int8 optimizer state blocks of {block_size} elements don't divide this mesh's "
+            f"{shard_len}-element shards of `{last}` (in a `{shape}` weight). Set "
+            f"training.optimizer_state_block_size to a divisor of {shard_len}."
+        )
+    return block_size
+
+
+def encode_moment(
+    hparams: TrainingHparams,
+    x: jax.Array,
+    shape: Optional[shardtypes.ShapeSpec] = None,
+    second_moment: bool = False,
+):
+    """Converts one weight's f32 Adam moment (a per-chip shard of a weight of `shape`, which
+    int8 first moments need) to its storage format."""
+    optimizer_state_dtype = hparams.optimizer_state_dtype or "float32"
+    if optimizer_state_dtype == "float32":
+        return x
+    elif optimizer_state_dtype == "bfloat16" or second_moment:
+        return jnp.bfloat16(x)
+    if not is_quantized_moment(shape):
+        return jnp.bfloat16(x), jnp.zeros((), jnp.bfloat16)
+    *leading, n = x.shape
+    block_size = moment_block_size(hparams, shape, n)
+    values, scales = quantize_int8(x.reshape(*leading, n // block_size, block_size))
+    return values.reshape(x.shape), scales
+
+
+def decode_moment(hparams: TrainingHparams, stored, second_moment: bool = False):
+    """Inverse of `encode_moment`, back to f32."""
+    optimizer_state_dtype = hparams.optimizer_state_dtype or "float32"
+    if optimizer_state_dtype != "int8" or second_moment:
+        return jnp.float32(stored)
+    values, scales = stored
+    if values.dtype == jnp.bfloat16:
+        return jnp.float32(values)
+    *leading, n_blocks = scales.shape
+    x = jnp.float32(values).reshape(*leading, n_blocks, -1) * jnp.float32(
+        scales[..., jnp.newaxis]
+    )
+    return x.reshape(values.shape)
+
+
+def factored_axes(shape: shardtypes.ShapeSpec) -> Optional[Tuple[int, int]]:
+    """The (row, column) axes of a weight that "adafactor" keeps second-moment statistics
+    for: `d_model`, and the last other axis that isn't `layers`. None for vectors (per
+    layer), which keep a full second moment."""
+    names = [dim.shape for dim in shape.dims]
+    if "d_model" not in names:
+        return None
+    row = names.index("d_model")
+    cols = [i for i, name in enumerate(names) if i != row and name != "layers"]
+    if not cols:
+        return None
+    return row, cols[-1]
+
+
+def _factored_nu_type(name: str, number_type, shape: shardtypes.ShapeSpec):
+    """Row statistics (`shape` without the column axis) and column statistics (without the
+    row axis), or the full second moment for vectors."""
+    axes = factored_axes(shape)
+    if axes is None:
+        return f32[str(shape)]
+    row, col = axes
+    without = lambda axis: shardtypes.ShapeSpec(
+        [dim for i, dim in enumerate(shape.dims) if i != axis]
+    )
+    return Tuple[f32[str(without(col))], f32[str(without(row))]]
 
 
 @pytree_dataclass
@@ -583,53 +2391,302 @@ class State:
     adam_mu: Model
     adam_nu: Model
 
-    @staticmethod
-    def init(hparams: Hparams, rng: PRNGKey) -> "State":
-        weights = Model.init(hparams, rng)
-        adam_mu = jax.tree.map(lambda p: p * 0.0, weights)
-        adam_nu = jax.tree.map(lambda p: p * 0.0, weights)
-        return State(weights=weights, adam_mu=adam_mu, adam_nu=adam_nu)
+
+@dataclass(frozen=True)
+class Optimizer:
+    """A way of estimating and storing the second moment `nu` of each weight's gradient.
+
+    Every optimizer keeps an EMA of the gradient in `State.adam_mu` (stored per
+    `optimizer_state_dtype`) and updates weights by `arctan2(mu_hat, sqrt(nu_hat))`, followed
+    by weight decay and the per-weight `lr_scales`. The second-moment statistics live in the
+    `State` field `nu_field`. All functions act on one weight's per-chip shard; `shape` is
+    that weight's `ShapeSpec`.
+    """
+
+    nu_field: str
+    # Type of each weight's statistics in the `nu_field` tree, as a function for
+    # `map_model_type`, or None to store them like Adam's `adam_nu`, per
+    # `optimizer_state_dtype`.
+    nu_type: Any
+    # (hparams, zeros, shape) -> initial statistics.
+    init_nu: Any
+    # (hparams, g, nu, shape, completed_steps) -> (bias-corrected nu_hat, new statistics).
+    update_nu: Any
+
+
+def _adam_init_nu(hparams: TrainingHparams, zeros: jax.Array, shape):
+    return encode_moment(hparams, zeros, second_moment=True)
+
+
+def _adam_update_nu(
+    hparams: TrainingHparams, g: jax.Array, nu, shape, completed_steps: jax.Array
+):
+    nu = decode_moment(hparams, nu, second_moment=True)
+    nu = (1 - hparams.adam_b2) * jax.lax.square(g) + hparams.adam_b2 * nu
+    nu_hat = nu / (1 - jnp.float32(hparams.adam_b2) ** completed_steps)
+    return nu_hat, encode_moment(hparams, nu, second_moment=True)
+
+
+def _factored_init_nu(hparams: TrainingHparams, zeros: jax.Array, shape):
+    axes = factored_axes(shape)
+    if axes is None:
+        return zeros
+    row, col = axes
+    return jnp.mean(zeros, axis=col), jnp.mean(zeros, axis=row)
+
+
+def _factored_update_nu(
+    hparams: TrainingHparams, g: jax.Array, nu, shape, completed_steps: jax.Array
+):
+    b2 = hparams.adam_b2
+    g2 = (
+        jax.lax.square(g) + 1e-30
+    )  # As in Adafactor, so that all-zero rows don't give 0/0.
+    axes = factored_axes(shape)
+    if axes is None:
+        nu = (1 - b2) * g2 + b2 * nu
+        return nu / (1 - jnp.float32(b2) ** completed_steps), nu
+
+    row, col = axes
+
+    def mean(x, axis):
+        # Mean over the whole (unsharded) axis.
+        x = jnp.mean(x, axis=axis, keepdims=True)
+        mesh_axes = shape.dims[axis].sharding
+        return jax.lax.pmean(x, mesh_axes) if mesh_axes else x
+
+    row_nu, col_nu = nu
+    row_nu = (1 - b2) * mean(g2, col) + b2 * jnp.expand_dims(row_nu, col)
+    col_nu = (1 - b2) * mean(g2, row) + b2 * jnp.expand_dims(col_nu, row)
+    # Rank-1 reconstruction nu[i, j] = row_nu[i] * col_nu[j] / mean(row_nu), per slice of
+    # the other axes. Both statistics carry the same bias, so this carries it once.
+    nu_hat = row_nu * col_nu / mean(row_nu, row)
+    nu_hat = nu_hat / (1 - jnp.float32(b2) ** completed_steps)
+    return nu_hat, (jnp.squeeze(row_nu, col), jnp.squeeze(col_nu, row))
+
+
+OPTIMIZERS = {
+    # Full per-element second moment.
+    "adam": Optimizer("adam_nu", None, _adam_init_nu, _adam_update_nu),
+    # Adafactor-style factored second moment: row and column statistics for matrices, so
+    # `nu` costs O(rows + columns) rather than O(rows * columns). Kept in f32; they're small.
+    "adafactor": Optimizer(
+        "factored_nu", _factored_nu_type, _factored_init_nu, _factored_update_nu
+    ),
+}
+
+
+def get_optimizer(hparams: TrainingHparams) -> Optimizer:
+    optimizer = hparams.optimizer or "adam"
+    if optimizer not in OPTIMIZERS:
+        raise ValueError(f"Unknown optimizer: {optimizer}")
+    return OPTIMIZERS[optimizer]
+
+
+def get_moment_type(
+    hparams: TrainingHparams, model_type: type, second_moment: bool = False
+) -> type:
+    """Type of `State.adam_mu`, or with `second_moment` of `State.adam_nu`, which depend on
+    `optimizer_state_dtype` as in `encode_moment`."""
+    return _moment_type(
+        hparams.optimizer_state_dtype or "float32", model_type, second_moment
+    )
+
+
+def _moment_type(
+    optimizer_state_dtype: str, model_type: type, second_moment: bool
+) -> type:
+    if optimizer_state_dtype == "float32":
+        return model_type
+    elif optimizer_state_dtype == "bfloat16" or (
+        optimizer_state_dtype == "int8" and second_moment
+    ):
+        return map_model_type(_bf16_type, model_type)
+    elif optimizer_state_dtype == "int8":
+        return get_quantized_moment_type(model_type)
+    raise ValueError(f"Unknown optimizer_state_dtype: {optimizer_state_dtype}")
+
+
+def get_state_type(h: Hparams, hparams: TrainingHparams) -> type:
+    model_type = get_model_type(h)
+    return _make_state_type(
+        hparams.optimizer or "adam",
+        model_type,
+        get_moment_type(hparams, model_type),
+        get_moment_type(hparams, model_type, second_moment=True),
+    )
+
+
+@cache
+def _make_state_type(
+    optimizer: str, model_type: type, moment_type: type, second_moment_type: type
+) -> type:
+    nu_field, nu_type = OPTIMIZERS[optimizer].nu_field, OPTIMIZERS[optimizer].nu_type
+    if (nu_field, nu_type, moment_type) == ("adam_nu", None, Model):
+        return State
+    fields = [("weights", model_type), ("adam_mu", moment_type)]
+    if nu_type is not None:
+        fields.append((nu_field, map_model_type(nu_type, model_type)))
+    else:
+        fields.append((nu_field, second_moment_type))
+    return pytree_dataclass(make_dataclass("State", fields))
+
+
+# `State`, or one of its variants for other optimizers, models and `optimizer_state_dtype`s: the
+# types `get_state_type` returns, which `_make_state_type` builds once each.
+AnyState = Union[
+    tuple(
+        _make_state_type(
+            optimizer,
+            model_type,
+            _moment_type(optimizer_state_dtype, model_type, False),
+            _moment_type(optimizer_state_dtype, model_type, True),
+        )
+        for optimizer in OPTIMIZERS
+        for model_type in (Model, MoEModel)
+        for optimizer_state_dtype in OPTIMIZER_STATE_DTYPES
+    )
+]
+
+
+def moment_leaves(moment) -> list:
+    """One entry per weight of an optimizer state tree: an array, or a tuple of arrays if
+    quantized or factored."""
+    if isinstance(moment, QuantizedMoment):
+        return list(zip(tree_leaves(moment.values), tree_leaves(moment.scales)))
+    return tree_leaves(moment, is_leaf=lambda x: isinstance(x, tuple))
+
+
+def moment_from_leaves(moment_type: type, leaves: list):
+    """Inverse of `moment_leaves`, for a tree of type `moment_type`."""
+
+    def unflatten(cls, leaves):
+        treedef = jax.tree.structure(
+            shardtypes.make_partition_specs(cls),
+            is_leaf=lambda x: isinstance(x, tuple),
+        )
+        return jax.tree.unflatten(treedef, leaves)
+
+    if issubclass(moment_type, QuantizedMoment):
+        fields = moment_type.__annotations__
+        values, scales = zip(*leaves)
+        return moment_type(
+            values=unflatten(fields["values"], values),
+            scales=unflatten(fields["scales"], scales),
+        )
+    return unflatten(moment_type, leaves)
 
 
-@partial(jax.jit, static_argnums=(1))
 @shardtypes.scope
-def eval_model(state: State, h: Hparams, batch: TokenBatch) -> f32[b""]:
+def init_state(h: Hparams, hparams: TrainingHparams, rng: PRNGKey) -> AnyState:
+    weights = Model.init(h, rng)
+    ModelType = get_model_type(h)
+    StateType = get_state_type(h, hparams)
+    optimizer = get_optimizer(hparams)
+
+    # Built per chip, so quantization blocks match those of `training_step`.
     @partial(shardtypes.typed_shard_map, check_rep=False)
-    def eval_model_shard(state: State, batch: TokenBatch) -> f32[b""]:
-        loss, _ = jax.value_and_grad(lambda weights: weights.loss(h, batch))(
-            state.weights
+    def init_optimizer_state(weights: ModelType) -> StateType:
+        zeros = [p * 0.0 for p in tree_leaves(weights)]
+        shapes = tree_leaves(shardtypes.make_shape_specs(ModelType))
+        adam_mu = [encode_moment(hparams, z, s) for z, s in zip(zeros, shapes)]
+        nu = [optimizer.init_nu(hparams, z, s) for z, s in zip(zeros, shapes)]
+        fields = StateType.__annotations__
+        return StateType(
+            weights=weights,
+            adam_mu=moment_from_leaves(fields["adam_mu"], adam_mu),
+            **{optimizer.nu_field: moment_from_leaves(fields[optimizer.nu_field], nu)},
         )
-        loss = jax.lax.psum(loss, ("d", "t"))
+
+    return init_optimizer_state(weights)
+
+
+def abstract_state(h: Hparams, hparams: TrainingHparams) -> AnyState:
+    """The shapes, dtypes and shardings of `init_state`, without running it."""
+    shapes = jax.eval_shape(partial(init_state, h, hparams), jax.random.PRNGKey(0))
+    return jax.tree.map(
+        lambda s, sharding: jax.ShapeDtypeStruct(s.shape, s.dtype, sharding=sharding),
+        shapes,
+        make_shardings(get_state_type(h, hparams)),
+    )
+
+
+@partial(jax.jit, static_argnums=(1))
+@shardtypes.scope
+def eval_model(weights: AnyModel, h: Hparams, batch: TokenBatch) -> f32[b""]:
+    ModelType = get_model_type(h)
+
+    @partial(shardtypes.typed_shard_map, check_rep=False)
+    def eval_model_shard(weights: ModelType, batch: TokenBatch) -> f32[b""]:
+        loss, _ = jax.value_and_grad(lambda weights: weights.loss(h, batch))(weights)
+        loss = jax.lax.psum(loss, ("p", "d", "s", "t"))
         return loss
 
-    return eval_model_shard(state, batch)
+    return eval_model_shard(weights, batch)
 
 
 @partial(jax.jit, static_argnums=(2, 3), donate_argnums=(0,))
 @shardtypes.scope
 def training_step(
-    state: State,
+    state: AnyState,
     step: u32[b""],
     h: Hparams,
     hparams: TrainingHparams,
     batch: TokenBatch,
-) -> Tuple[Any, Metrics]:
+) -> Tuple[AnyState, Metrics]:
+    ModelType = get_model_type(h)
+    StateType = get_state_type(h, hparams)
+
     @partial(
         shardtypes.typed_shard_map, check_rep=False
     )  # check_rep=False for https://github.com/google/jax/issues/20335
     def sharded_step(
-        state: State, step: u32[b""], batch: TokenBatch
-    ) -> Tuple[State, Metrics]:
-        loss, grad = jax.value_and_grad(lambda weights: weights.loss(h, batch))(
-            state.weights
-        )
+        state: StateType, step: u32[b""], batch: TokenBatch
+    ) -> Tuple[StateType, Metrics]:
+        microbatches = hparams.microbatches or 1
+        if microbatches == 1:
+            (loss, moe_stats), grad = jax.value_and_grad(
+                lambda weights: weights.loss_and_moe_stats(h, batch), has_aux=True
+            )(state.weights)
+        else:
+            # Gradient accumulation: split each chip's batch shard into microbatches and scan
+            # over them. Every microbatch has the same number of tokens, so the mean of the
+            # per-microbatch (loss, grad) is the (loss, grad) of the whole batch.
+            local_batch = batch.targets.shape[0]
+            assert (
+                local_batch % microbatches == 0
+            ), f"Per-chip batch {local_batch} must be a multiple of microbatches {microbatches}."
+            split_batch = jax.tree.map(
+                lambda x: x.reshape(
+                    microbatches, local_batch // microbatches, *x.shape[1:]
+                ),
+                batch,
+            )
+
+            # Fresh shape-checking scope, since the microbatch has a smaller `batch` dimension.
+            @shardtypes.scope
+            def accumulate(acc, microbatch):
+                loss_and_grad = jax.value_and_grad(
+                    lambda weights: weights.loss_and_moe_stats(h, microbatch),
+                    has_aux=True,
+                )(state.weights)
+                return jax.tree.map(jnp.add, acc, loss_and_grad), ()
+
+            init = (
+                (jnp.float32(0.0), MoEStats.zeros() if h.moe_experts else ()),
+                jax.tree.map(lambda w: jnp.zeros(w.shape, jnp.float32), state.weights),
+            )
+            ((loss, moe_stats), grad), () = lax.scan(accumulate, init, split_batch)
+            loss, moe_stats, grad = jax.tree.map(
+                lambda x: x / microbatches, (loss, moe_stats, grad)
+            )
         # Gradients have already been reduced across chips because the gradient of the weight `all_gather`
         # is weight-gradient `psum_scatter`. Loss, on the other hand, hasn't been reduced across chips: if we
         # did that inside the autodiff, we'd be double-reducing the loss, effectively multiplying it by the
         # amount of data parallelism.
         #
         # So we reduce the loss across chips _outside_ the autodiff.
-        loss = jax.lax.psum(loss, ("d", "t"))
+        loss = jax.lax.psum(loss, ("p", "d", "s", "t"))
 
         # Other than global-norm of gradients, no other communication is needed during the weight update,
         # because weights and grads are already fully sharded, as checked below.
@@ -658,7 +2715,7 @@ def training_step(
         for g in grad_leaves:
             assert g.dtype == jnp.float32
             global_norm_square += jnp.sum(jax.lax.square(g))
-        global_norm_square = jax.lax.psum(global_norm_square, ("d", "t"))
+        global_norm_square = jax.lax.psum(global_norm_square, ("p", "d", "s", "t"))
         global_norm = jnp.sqrt(global_norm_square)
 
         base = h.base
@@ -670,19 +2727,28 @@ def training_step(
         embed_lr_scale = h.gamma_embed * (h.d_model / base.d_model) ** -p.embed_lr
         unembed_lr_scale = h.gamma_unembed * (h.d_model / base.d_model) ** -p.unembed_lr
 
-        lr_scales = Model(
+        layer_lr_scales = dict(
+            ln1=1.0,
+            ln2=1.0,
+            w_q=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
+            w_kv=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
+            w_o=h.gamma_hidden * (target_head_dim / base_head_dim) ** -p.hidden_lr,
+            w_gate=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
+            w_up=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
+            # For experts, `d_expert` relative to its base is `d_ff` relative to `base.d_ff`.
+            w_down=h.gamma_hidden * (h.d_ff / base.d_ff) ** -p.hidden_lr,
+        )
+        if h.moe_experts:
+            transformer_lr_scales = MoETransformer(
+                **layer_lr_scales,
+                w_router=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
+            )
+        else:
+            transformer_lr_scales = Transformer(**layer_lr_scales)
+        lr_scales = ModelType(
             embed=embed_lr_scale,
             unembed=unembed_lr_scale,
-            transformer=Transformer(
-                ln1=1.0,
-                ln2=1.0,
-                w_q=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
-                w_kv=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
-                w_o=h.gamma_hidden * (target_head_dim / base_head_dim) ** -p.hidden_lr,
-                w_gate=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
-                w_up=h.gamma_hidden * (h.d_model / base.d_model) ** -p.hidden_lr,
-                w_down=h.gamma_hidden * (h.d_ff / base.d_ff) ** -p.hidden_lr,
-            ),
+            transformer=transformer_lr_scales,
             final_layer_norm=1.0,
         )
 
@@ -692,15 +2758,17 @@ def training_step(
         else:
             rescale = 1.0
 
+        optimizer = get_optimizer(hparams)
         new_ps = []
         new_mus = []
         new_nus = []
-        for p, g, mu, nu, spec, lr_scale in zip(
+        for p, g, mu, nu, spec, shape, lr_scale in zip(
             tree_leaves(state.weights),
             grad_leaves,
-            tree_leaves(state.adam_mu),
-            tree_leaves(state.adam_nu),
-            tree_leaves(shardtypes.make_partition_specs(State)),
+            moment_leaves(state.adam_mu),
+            moment_leaves(getattr(state, optimizer.nu_field)),
+            tree_leaves(shardtypes.make_partition_specs(ModelType)),
+            tree_leaves(shardtypes.make_shape_specs(ModelType)),
             tree_leaves(lr_scales),
         ):
             assert shardtypes.is_fully_sharded(
@@ -708,13 +2776,13 @@ def training_step(
             ), "Weight update is only correctly scaled for fully sharded weights."
             # Gradient clipping
             g = g * rescale
+            mu = decode_moment(hparams, mu)
             # Adam scaling
             mu = (1 - hparams.adam_b1) * g + hparams.adam_b1 * mu
-            nu = (1 - hparams.adam_b2) * jax.lax.square(g) + hparams.adam_b2 * nu
             # We need step numbers to start at 1, not 0. Otherwise the bias correction produces NaN.
             completed_steps = step + 1
             mu_hat = mu / (1 - jnp.float32(hparams.adam_b1) ** completed_steps)
-            nu_hat = nu / (1 - jnp.float32(hparams.adam_b2) ** completed_steps)
+            nu_hat, nu = optimizer.update_nu(hparams, g, nu, shape, completed_steps)
             # as per C.5. in https://arxiv.org/pdf2407.05872
             # they mention introducing hp a, b to below function,
             # TODO: test and see if a = b = something besides 1
@@ -727,19 +2795,52 @@ def training_step(
 
             # Apply update
             new_ps.append(p - g)
-            new_mus.append(mu)
+            new_mus.append(encode_moment(hparams, mu, shape))
             new_nus.append(nu)
 
-        new_state = State(
+        fields = StateType.__annotations__
+        new_state = StateType(
             weights=jax.tree_util.tree_unflatten(grad_treedef, new_ps),
-            adam_mu=jax.tree_util.tree_unflatten(grad_treedef, new_mus),
-            adam_nu=jax.tree_util.tree_unflatten(grad_treedef, new_nus),
+            adam_mu=moment_from_leaves(fields["adam_mu"], new_mus),
+            **{
+                optimizer.nu_field: moment_from_leaves(
+                    fields[optimizer.nu_field], new_nus
+                )
+            },
         )
+        if (h.attention or "dense") == "block_sparse":
+            # With sequence parallelism, this counts the tiles within each chip's shard of
+            # the sequence, not those between shards.
+            L = batch.targets.shape[1]
+            segment_ids, positions = sequence_positions(batch.is_seq_start)
+            block_size = get_attention_block_size(h, L)
+            n_global = sum(
+                bool(is_global_attention_layer(h, i)) for i in range(h.layers)
+            )
+            skipped = n_global * attention_tile_skip_fraction(
+                segment_ids, positions, block_size
+            )
+            if n_global < h.layers:
+                skipped += (h.layers - n_global) * attention_tile_skip_fraction(
+                    segment_ids, positions, block_size, h.attention_window
+                )
+            attention_tiles_skipped = jax.lax.pmean(skipped / h.layers, ("d", "s"))
+        else:
+            attention_tiles_skipped = jnp.float32(0.0)
+
+        if h.moe_experts:
+            moe_stats = jax.lax.pmean(moe_stats, ("d", "s"))
+        else:
+            moe_stats = MoEStats.zeros()
+
         metrics = Metrics(
             loss=loss,
             learning_rate=lr,
             grad_norm=global_norm * rescale,
             raw_grad_norm=global_norm,
+            attention_tiles_skipped=attention_tiles_skipped,
+            moe_load_balance_loss=moe_stats.load_balance_loss,
+            moe_dropped_tokens=moe_stats.dropped_tokens,
         )
         return new_state, metrics
 
@@ -756,6 +2857,20 @@ class Paths:
 class MeshConfig:
     d: int
     t: int
+    # Pipeline-parallel stages, each holding `layers / p` consecutive layers. Training only.
+    p: Optional[int] = None
+    # Sequence-parallel shards: each chip holds `len / s` consecutive positions of its
+    # sequences, and attention passes keys and values around a ring. Training only.
+    s: Optional[int] = None
+
+
+def make_mesh(mesh: MeshConfig) -> Mesh:
+    return Mesh(
+        mesh_utils.create_device_mesh(
+            [mesh.p or 1, mesh.d, mesh.s or 1, mesh.t], jax.devices()
+        ),
+        ("p", "d", "s", "t"),
+    )
 
 
 @dataclass(frozen=True)
@@ -803,13 +2918,18 @@ def main_contained(config, logger):
         os.environ["TPU_CHIPS_PER_HOST_BOUNDS"] = "1,1,1"
         os.environ["TPU_HOST_BOUNDS"] = "1,1,1"
     jax.config.update("jax_threefry_partitionable", True)
-    with Mesh(
-        mesh_utils.create_device_mesh([config.mesh.d, config.mesh.t], jax.devices()),
-        ("d", "t"),
-    ):
+    with make_mesh(config.mesh):
         root_rng = jax.random.PRNGKey(config.training.seed)
 
-        loader = get_loader("train", config.training_data, config.training.tokens)
+        loader = PrefetchingLoader(
+            get_loader(
+                "train",
+                config.training_data,
+                config.training.tokens,
+                config.io.max_io_threads,
+            ),
+            config.training.prefetch_batches or 0,
+        )
         assert (
             config.model.vocab > loader.max_token_id
         ), f"{config.model.vocab} vs {loader.max_token_id}"
@@ -822,19 +2942,46 @@ def main_contained(config, logger):
         model_dir = os.path.join(config.paths.root_working_dir, model_name)
         print(model_name)
         training_io.mkdir(model_dir)
-        state = jax.jit(partial(State.init, config.model))(
-            fold_in_str(root_rng, "init")
-        )
-
         state, start_step = training_io.load_checkpoint_if_it_exists(
-            model_dir, state, config.io
+            model_dir, abstract_state(config.model, config.training), config.io
         )
+        if start_step == 0:
+            state = jax.jit(partial(init_state, config.model, config.training))(
+                fold_in_str(root_rng, "init")
+            )
 
         # Explicitly compile training step, to record XLA HLO graph.
         # See https://bnikolic.co.uk/blog/python/jax/2022/02/22/jax-outputgraph-rev
+        batch = loader.load(start_step)
         c_training_step = training_step.lower(
-            state, jnp.uint32(0), config.model, config.training, loader.load(0)
+            state, jnp.uint32(0), config.model, config.training, batch
         ).compile()
+        remat_policy = get_remat_policy(config.model)
+        print(f"Remat policy: {remat_policy}")
+        print(f"Prefetch weights: {bool(config.model.prefetch_weights)}")
+        n_stages = config.mesh.p or 1
+        if n_stages > 1:
+            bubble = pipeline_bubble_fraction(
+                n_stages, config.model.pipeline_microbatches or n_stages
+            )
+            print(f"Pipeline: {n_stages} stages, bubble fraction {bubble:.3f}")
+            if logger:
+                logger.report_single_value("pipeline_bubble_fraction", bubble)
+        optimizer_state_bytes = sum(x.nbytes for x in tree_leaves(state)) - sum(
+            x.nbytes for x in tree_leaves(state.weights)
+        )
+        print(
+            f"Optimizer: {config.training.optimizer or 'adam'}, state "
+            f"{config.training.optimizer_state_dtype or 'float32'}, "
+            f"{optimizer_state_bytes:_} bytes"
+        )
+        # Step time is reported per variant, so runs with and without weight prefetching
+        # (whose profiles are saved alongside) can be compared directly: "nothing+prefetch"
+        # against "nothing", the policy prefetching runs with.
+        step_time_series = remat_policy + (
+            "+prefetch" if config.model.prefetch_weights else ""
+        )
+        training_io.log_memory_analysis(c_training_step, logger)
         date = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
         # training_io.save_hlo_svg(os.path.join(model_dir, f'training_step_optimized_hlo_{date}.svg'), c_training_step)
         n_log_iterations = config.training.n_log_iterations or 5000
@@ -845,10 +2992,7 @@ def main_contained(config, logger):
 
         def update_metrics(metrics: Metrics):
             nonlocal cum_metrics
-            cum_metrics.loss += metrics.loss
-            cum_metrics.grad_norm += metrics.grad_norm
-            cum_metrics.raw_grad_norm += metrics.raw_grad_norm
-            cum_metrics.learning_rate += metrics.learning_rate
+            cum_metrics = jax.tree.map(operator.add, cum_metrics, metrics)
 
         start_time = time.time()
 
@@ -863,7 +3007,11 @@ def main_contained(config, logger):
                 training_io.start_profile()
                 profile_start = time.time()
 
-            state, output = c_training_step(state, jnp.uint32(step), loader.load(step))
+            # Each step's batch is loaded once: loaders such as `HuggingFaceDataLoader`
+            # return a new batch on every call.
+            if step > start_step:
+                batch = loader.load(step)
+            state, output = c_training_step(state, jnp.uint32(step), batch)
 
             # if half way point and multistage training is enabled, double seq length and halve batch size
             if (
@@ -879,18 +3027,21 @@ def main_contained(config, logger):
                 config = replace(
                     config, training=replace(config.training, tokens=tokens)
                 )
-                loader = get_loader(
-                    "train", config.training_data, config.training.tokens
+                loader.close()
+                loader = PrefetchingLoader(
+                    get_loader(
+                        "train",
+                        config.training_data,
+                        config.training.tokens,
+                        config.io.max_io_threads,
+                    ),
+                    config.training.prefetch_batches or 0,
                 )
+                batch = loader.load(step)
                 c_training_step = training_step.lower(
-                    state,
-                    jnp.uint32(0),
-                    config.model,
-                    config.training,
-                    loader.load(step),
+                    state, jnp.uint32(0), config.model, config.training, batch
                 ).compile()
 
-            batch = loader.load(step)
             state, output = c_training_step(state, jnp.uint32(step), batch)
 
             # Run profile for two steps, to include data loading time in between them.
@@ -899,48 +3050,88 @@ def main_contained(config, logger):
                 profile_duration = time.time() - profile_start
                 training_io.stop_profile(model_dir)
 
-                # Print MFU, including (one step of) data loading time.
-                print(f"Profile time: {profile_duration}s for 2 steps.")
+                # Print MFU, including (one step of) data loading time. Each of the two
+                # iterations profiled calls `c_training_step` twice.
+                profiled_steps = 4
+                step_seconds = profile_duration / profiled_steps
+                print(
+                    f"Profile time: {profile_duration}s for {profiled_steps} training steps."
+                )
+                print(f"Step time ({step_time_series}): {step_seconds:.3f}s")
+                if logger:
+                    logger.report_scalar(
+                        title="step_time",
+                        series=step_time_series,
+                        value=step_seconds,
+                        iteration=step,
+                    )
                 model_params = jax.tree.reduce(
                     operator.add, jax.tree.map(lambda w: w.size, state.weights)
                 )
                 tokens = batch.targets.size
                 print(f"Model params: {model_params:_}")
+                active_params = model_params
+                if config.model.moe_experts:
+                    # Each token only passes through `moe_top_k` of the experts.
+                    layers = state.weights.transformer
+                    expert_params = layers.w_gate.size + layers.w_up.size
+                    expert_params += layers.w_down.size
+                    top_k = config.model.moe_top_k or 2
+                    active_params -= int(
+                        expert_params * (1 - top_k / config.model.moe_experts)
+                    )
+                    print(f"Active params per token: {active_params:_}")
                 print(f"Tokens: {tokens:_}")
                 device_flops = training_io.get_flops_per_device()
                 num_devices = jax.device_count()
                 print(
-                    f"MFU (projections only): {100 * (2 * 6 * model_params * tokens / (num_devices * profile_duration)) / device_flops:.2f}% MFU"
+                    f"MFU (projections only): {100 * (6 * active_params * tokens / (num_devices * step_seconds)) / device_flops:.2f}% MFU"
                 )
 
             if step % log_interval == 0:
                 if cum_metrics:
-                    cum_metrics = Metrics(
-                        loss=cum_metrics.loss / log_interval,
-                        learning_rate=cum_metrics.learning_rate / log_interval,
-                        grad_norm=cum_metrics.grad_norm / log_interval,
-                        raw_grad_norm=cum_metrics.raw_grad_norm / log_interval,
-                    )
+                    cum_metrics = jax.tree.map(lambda m: m / log_interval, cum_metrics)
                 else:
                     cum_metrics = output
                 training_io.log(step, logger, cum_metrics)
+                # Time per step that the training loop spent waiting for batches.
+                data_wait = loader.pop_blocked_seconds() / log_interval
+                if logger:
+                    logger.report_scalar(
+                        title="data_wait_time",
+                        series="train",
+                        value=data_wait,
+                        iteration=step,
+                    )
+                elif training_io.is_device_0():
+                    print(f"Step {step} data wait time: {data_wait:.4f}s")
                 cum_metrics = output
             else:
                 update_metrics(output)
 
         end_time = time.time()
         print(f"Total time: {end_time - start_time:.2f} seconds")
+        loader.close()
         training_io.save_checkpoint(model_dir, config.training.steps, state, config.io)
         print("Evaluating final model...")
-        loader = get_loader("validation", config.training_data, config.training.tokens)
+        loader = PrefetchingLoader(
+            get_loader(
+                "validation",
+                config.training_data,
+                config.training.tokens,
+                config.io.max_io_threads,
+            ),
+            config.training.prefetch_batches or 0,
+        )
 
         total_loss = 0.0
         num_batches = config.training.steps // 10
 
         for step in range(num_batches):
             batch = loader.load(step)
-            loss = eval_model(state, config.model, batch)
+            loss = eval_model(state.weights, config.model, batch)
             total_loss += loss
+        loader.close()
 
         avg_loss = total_loss / num_batches
         perplexity = jnp.exp(avg_loss)
@@ -963,6 +3154,9 @@ def main_contained(config, logger):
                     iteration=config.training.steps,
                 )
 
+        # The final checkpoint may still be writing in the background, overlapped with evaluation.
+        training_io.wait_for_checkpoints()
+
 
 def clear_tpu_locks():
     try:
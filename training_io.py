@@ -8,7 +8,7 @@
 import jax
 import jax.numpy as jnp
 from jax.experimental import multihost_utils
-from typing import Tuple, Any
+from typing import Tuple, Any, Optional
 from dataclasses import dataclass
 import os
 import fsspec
@@ -18,6 +18,7 @@ from clearml import Logger
 import numpy as np
 import datetime
 import concurrent
+import hashlib
 import jax.profiler
 import tempfile
 import shutil
@@ -44,6 +45,20 @@ class IOConfig:
     # Since this work is IO-bound rather than CPU-bound, it is fine to have many more threads than
     # CPU cores.
     max_io_threads: int
+    # If true, `save_checkpoint` only copies the state to host memory before returning, and the
+    # zarr write and its two-phase commit finish in a background thread. Call
+    # `wait_for_checkpoints` before exiting.
+    async_checkpoints: Optional[bool] = None
+    # Max number of checkpoints being written in the background. Saving another first waits for
+    # the oldest to finish, which bounds the host memory holding their copies of the state.
+    # Defaults to 1.
+    max_pending_checkpoints: Optional[int] = None
+    # If set, each process writes and commits its shards of a checkpoint to this local directory,
+    # e.g. on SSD, and then uploads them to the checkpoint directory in the background. On restart,
+    # a local copy at least as new as the checkpoint directory's latest committed checkpoint is
+    # loaded instead, if it has one. Copies are kept in a subdirectory named after the full
+    # checkpoint directory, which each copy also records.
+    local_checkpoint_dir: Optional[str] = None
 
 
 def log(step: int, logger: Logger, output: PyTree):
@@ -88,12 +103,36 @@ def log(step: int, logger: Logger, output: PyTree):
             print(f"[{now}] Step {step}: {metrics_dict}")
 
 
+def log_memory_analysis(compiled: jax.stages.Compiled, logger: Logger):
+    """Logs the per-device memory XLA plans for a compiled computation.
+
+    Temporaries are mostly activations saved for the backward pass, so this is where remat
+    policies show up. Not every backend provides an analysis.
+    """
+    analysis = compiled.memory_analysis()
+    if analysis is None or not is_device_0():
+        return
+    sizes = {
+        "argument": analysis.argument_size_in_bytes,
+        "output": analysis.output_size_in_bytes,
+        "temp": analysis.temp_size_in_bytes,
+        "generated_code": analysis.generated_code_size_in_bytes,
+        "host_temp": getattr(analysis, "host_temp_size_in_bytes", 0),
+    }
+    for series, size in sizes.items():
+        print(f"Compiled memory, {series}: {size:_} bytes")
+        if logger:
+            logger.report_single_value(f"memory_{series}_bytes", size)
+
+
 def load_checkpoint_if_it_exists(
     checkpoint_dir: str, state: PyTree, config: IOConfig
 ) -> Tuple[PyTree, int]:
     """Loads the latest checkpoint if it exists, otherwise return the initial state.
 
     In either case, uses the sharding and PyTree structure of `state` to produce the output.
+    `state` may be abstract, e.g. `jax.ShapeDtypeStruct`s with shardings, so that the initial
+    state is only materialized if there's no checkpoint: it is returned as is, at step 0.
 
     Since the state may occupy a large amount of memory, this function makes sure to delete `state`
     before loading the checkpoint. To facilitate this, callers should ensure not to hold on to any
@@ -132,6 +171,27 @@ def load_checkpoint_if_it_exists(
         jnp.int32(selected_checkpoint)
     )
 
+    if config.local_checkpoint_dir:
+        # Every process needs a local copy of the same step, holding the shards it loads.
+        local_checkpoints = multihost_utils.process_allgather(
+            jnp.int32(_latest_local_checkpoint(checkpoint_dir, state, config))
+        )
+        local_checkpoint = int(np.min(local_checkpoints))
+        # Local copies are only trusted if the checkpoint directory has a committed
+        # checkpoint: otherwise it was deleted, to start afresh, or the first upload didn't
+        # finish, and starting from the initial state is safe either way.
+        if local_checkpoint == np.max(local_checkpoints) and (
+            selected_checkpoint != -1 and local_checkpoint >= selected_checkpoint
+        ):
+            local_file = os.path.join(
+                _local_checkpoint_dir(checkpoint_dir, config),
+                step_to_str(local_checkpoint),
+            )
+            print(
+                f"Found checkpoint {local_checkpoint} in {local_file}, starting from there."
+            )
+            return load_zarr(local_file, state, config), local_checkpoint
+
     if selected_checkpoint == -1:
         print(
             f"No checkpoints found in {checkpoint_dir_path}, starting from initial state."
@@ -154,17 +214,31 @@ def load_checkpoint_if_it_exists(
 def save_checkpoint(checkpoint_dir: str, step: int, state: PyTree, config: IOConfig):
     """Saves a checkpoint for the specified step number.
 
+    With `config.async_checkpoints`, returns once `state` is copied to host memory, and the
+    checkpoint is written in the background: see `wait_for_checkpoints`.
+
     See docs/pytree-zarr-checkpoint.md for the checkpoint format.
     """
     blosc.use_threads = False
+    # Raise any error from a finished upload.
+    while _PENDING_UPLOADS and _PENDING_UPLOADS[0].done():
+        _PENDING_UPLOADS.pop(0).result()
+    if config.async_checkpoints:
+        _save_checkpoint_async(checkpoint_dir, step, state, config)
+        return
+    if config.local_checkpoint_dir:
+        state, _treedef = jax.tree_util.tree_flatten_with_path(state)
+        _write_local_checkpoint(
+            checkpoint_dir,
+            step,
+            _array_specs(state),
+            _shards_to_write(state, every_replica=True),
+            config,
+        )
+        return
     checkpoint_file = os.path.join(checkpoint_dir, step_to_str(step))
     if jax.process_index() == 0:
-        # If there's already a checkpoint at this step, delete it. It might have been a partially
-        # written checkpoint from a previous run.
-        f = fsspec.open(checkpoint_dir)
-        checkpoint_path = os.path.join(f.path, step_to_str(step))
-        if f.fs.exists(checkpoint_path):
-            f.fs.rm(checkpoint_path, recursive=True)
+        _delete_checkpoint_if_exists(checkpoint_dir, step)
 
     print(f"[{datetime.datetime.now()}] Saving checkpoint {step} to {checkpoint_file}.")
     save_zarr(checkpoint_file, state, config)
@@ -173,6 +247,244 @@ def save_checkpoint(checkpoint_dir: str, step: int, state: PyTree, config: IOCon
     )
 
 
+def _delete_checkpoint_if_exists(checkpoint_dir: str, step: int):
+    """Deletes the checkpoint at `step`, which might be partially written by a previous run."""
+    f = fsspec.open(checkpoint_dir)
+    checkpoint_path = os.path.join(f.path, step_to_str(step))
+    if f.fs.exists(checkpoint_path):
+        f.fs.rm(checkpoint_path, recursive=True)
+
+
+# Checkpoints being written in the background by `save_checkpoint`, oldest first, and the
+# single thread writing them, so that they're committed in order. Likewise for uploads of local
+# checkpoints.
+_PENDING_CHECKPOINTS = []
+_CHECKPOINT_WRITER = None
+_PENDING_UPLOADS = []
+_CHECKPOINT_UPLOADER = None
+
+# Barriers between processes writing a checkpoint in the background wait this long.
+_CHECKPOINT_BARRIER_TIMEOUT_MS = 60 * 60 * 1000
+
+
+def _save_checkpoint_async(
+    checkpoint_dir: str, step: int, state: PyTree, config: IOConfig
+):
+    global _CHECKPOINT_WRITER
+    max_pending = config.max_pending_checkpoints or 1
+    # Raise any error from a finished checkpoint, and wait for a free slot.
+    while _PENDING_CHECKPOINTS and (
+        _PENDING_CHECKPOINTS[0].done() or len(_PENDING_CHECKPOINTS) >= max_pending
+    ):
+        _PENDING_CHECKPOINTS.pop(0).result()
+
+    state, _treedef = jax.tree_util.tree_flatten_with_path(state)
+    shards = _shards_to_write(state, every_replica=bool(config.local_checkpoint_dir))
+    for _path, _index, data in shards:
+        data.copy_to_host_async()
+    # A copy, not `np.asarray`, which on CPU can alias device buffers that the training step
+    # is about to donate.
+    shards = [(path, index, np.array(data)) for path, index, data in shards]
+    print(
+        f"[{datetime.datetime.now()}] Copied checkpoint {step} to host, writing it in the background."
+    )
+    if _CHECKPOINT_WRITER is None:
+        _CHECKPOINT_WRITER = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    _PENDING_CHECKPOINTS.append(
+        _CHECKPOINT_WRITER.submit(
+            _write_checkpoint,
+            checkpoint_dir,
+            step,
+            _array_specs(state),
+            shards,
+            config,
+        )
+    )
+
+
+def _write_checkpoint(
+    checkpoint_dir: str, step: int, specs: list, shards: list, config: IOConfig
+):
+    """`save_zarr` of a host copy of the state, for a background thread. Synchronizes with other
+    processes without the devices, which the training loop is using."""
+    if config.local_checkpoint_dir:
+        _write_local_checkpoint(checkpoint_dir, step, specs, shards, config)
+        return
+    checkpoint_file = os.path.join(checkpoint_dir, step_to_str(step))
+    if jax.process_index() == 0:
+        _delete_checkpoint_if_exists(checkpoint_dir, step)
+        _create_arrays(checkpoint_file, specs)
+    _process_barrier(f"save_checkpoint_{step}_begin")
+    root = _write_shards(checkpoint_file, shards, config)
+    _process_barrier(f"save_checkpoint_{step}_end")
+    if jax.process_index() == 0:
+        root.attrs["write_completed"] = True
+    print(
+        f"[{datetime.datetime.now()}] Finished saving checkpoint {step} to {checkpoint_file}."
+    )
+
+
+def _local_checkpoint_dir(checkpoint_dir: str, config: IOConfig) -> str:
+    # Runs of the same model under different working directories share `local_checkpoint_dir`.
+    digest = hashlib.sha256(checkpoint_dir.encode()).hexdigest()[:16]
+    return os.path.join(
+        config.local_checkpoint_dir,
+        f"{os.path.basename(checkpoint_dir.rstrip('/'))}-{digest}",
+    )
+
+
+def _write_local_checkpoint(
+    checkpoint_dir: str, step: int, specs: list, shards: list, config: IOConfig
+):
+    """Writes this process's `shards` to a local checkpoint and commits it, then uploads it to
+    `checkpoint_dir` in the background.
+
+    Unlike `save_zarr`, there's no synchronization: each process has its own local copy, holding
+    every shard it needs to load the state. Its `shards` attribute records which ones, and its
+    `checkpoint_dir` attribute the checkpoint directory it belongs to.
+    """
+    global _CHECKPOINT_UPLOADER
+    local_file = os.path.join(
+        _local_checkpoint_dir(checkpoint_dir, config), step_to_str(step)
+    )
+    print(f"[{datetime.datetime.now()}] Saving checkpoint {step} to {local_file}.")
+    if os.path.exists(local_file):
+        shutil.rmtree(local_file)
+    _create_arrays(local_file, specs)
+    root = _write_shards(local_file, shards, config)
+    root.attrs["shards"] = _shards_fingerprint(
+        [(path, index, data.shape) for path, index, data in shards]
+    )
+    root.attrs["checkpoint_dir"] = checkpoint_dir
+    root.attrs["write_completed"] = True
+    print(
+        f"[{datetime.datetime.now()}] Finished saving checkpoint {step} to {local_file}."
+    )
+    if _CHECKPOINT_UPLOADER is None:
+        _CHECKPOINT_UPLOADER = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    _PENDING_UPLOADS.append(
+        _CHECKPOINT_UPLOADER.submit(_upload_checkpoint, checkpoint_dir, step, config)
+    )
+
+
+def _upload_checkpoint(checkpoint_dir: str, step: int, config: IOConfig):
+    """Uploads every process's local copy of a checkpoint to `checkpoint_dir`, with the same
+    two-phase commit as `save_zarr`. Then deletes older local copies."""
+    local_dir = _local_checkpoint_dir(checkpoint_dir, config)
+    local_file = os.path.join(local_dir, step_to_str(step))
+    f = fsspec.open(checkpoint_dir)
+    fs = f.fs
+    checkpoint_path = os.path.join(f.path, step_to_str(step))
+    del f
+    if jax.process_index() == 0:
+        _delete_checkpoint_if_exists(checkpoint_dir, step)
+    _process_barrier(f"upload_checkpoint_{step}_begin")
+
+    local_paths, remote_paths = [], []
+    for dirpath, _dirnames, filenames in os.walk(local_file):
+        for filename in filenames:
+            local_path = os.path.join(dirpath, filename)
+            relative_path = os.path.relpath(local_path, local_file)
+            # The root attributes hold the local commit marker. The remote one is set below,
+            # once every process has uploaded its shards.
+            if relative_path == ".zattrs":
+                continue
+            local_paths.append(local_path)
+            remote_paths.append(os.path.join(checkpoint_path, relative_path))
+    for remote_dir in set(os.path.dirname(path) for path in remote_paths):
+        fs.makedirs(remote_dir, exist_ok=True)
+    print(
+        f"[{datetime.datetime.now()}] Uploading checkpoint {step} to {checkpoint_path}."
+    )
+    fs.put(local_paths, remote_paths)
+
+    _process_barrier(f"upload_checkpoint_{step}_end")
+    if jax.process_index() == 0:
+        root = zarr.open_group(zarr.storage.FSStore(checkpoint_path, fs=fs), mode="r+")
+        root.attrs["write_completed"] = True
+    print(
+        f"[{datetime.datetime.now()}] Finished uploading checkpoint {step} to {checkpoint_path}."
+    )
+    for name in os.listdir(local_dir):
+        if name.isdigit() and int(name) < step:
+            shutil.rmtree(os.path.join(local_dir, name))
+
+
+def _latest_local_checkpoint(
+    checkpoint_dir: str, state: PyTree, config: IOConfig
+) -> int:
+    """The latest committed local checkpoint of `checkpoint_dir` holding the shards this process
+    loads for `state`, or -1."""
+    local_dir = _local_checkpoint_dir(checkpoint_dir, config)
+    if not os.path.exists(local_dir):
+        return -1
+    state, _treedef = jax.tree_util.tree_flatten_with_path(state)
+    fingerprint = _shards_fingerprint(
+        [
+            (jax.tree_util.keystr(path), index, arr.sharding.shard_shape(arr.shape))
+            for path, arr in state
+            for index in arr.sharding.addressable_devices_indices_map(
+                arr.shape
+            ).values()
+        ]
+    )
+    for name in reversed(sorted(os.listdir(local_dir))):
+        if not name.isdigit():
+            continue
+        attrs = zarr.open_group(os.path.join(local_dir, name), mode="r").attrs
+        if (
+            "write_completed" in attrs
+            and attrs.get("checkpoint_dir") == checkpoint_dir
+            and attrs.get("shards") == fingerprint
+        ):
+            return int(name)
+    return -1
+
+
+def _shards_fingerprint(shards: list) -> str:
+    """Identifies a set of `(path, index, shape)` chunks. Works from shardings alone, so that
+    it can be checked against an abstract state."""
+    keys = sorted(
+        set((path, _index_key(index), tuple(shape)) for path, index, shape in shards)
+    )
+    return hashlib.sha256(repr(keys).encode()).hexdigest()
+
+
+def _index_key(index: Tuple[slice, ...]) -> Tuple:
+    return tuple((s.start, s.stop) for s in index)
+
+
+def _process_barrier(name: str):
+    """Waits for all processes to reach the barrier `name`. Unlike
+    `multihost_utils.sync_global_devices`, this doesn't run a computation on the devices, so
+    it's safe to call from a background thread."""
+    client = jax._src.distributed.global_state.client
+    if client is not None:
+        client.wait_at_barrier(name, _CHECKPOINT_BARRIER_TIMEOUT_MS)
+
+
+def wait_for_checkpoints():
+    """Waits until every checkpoint being written in the background is committed, raising the
+    first error any of them hit."""
+    while _PENDING_CHECKPOINTS:
+        _PENDING_CHECKPOINTS.pop(0).result()
+    while _PENDING_UPLOADS:
+        _PENDING_UPLOADS.pop(0).result()
+
+
+# zarr has no bfloat16 dtype, so bfloat16 arrays are stored as their bits, in uint16 arrays
+# carrying this `dtype` attribute.
+_STORED_AS_BITS = {"bfloat16": (jnp.bfloat16, np.uint16)}
+
+
+def _stored_dtype(dtype) -> Tuple[Any, Any]:
+    """The dtype zarr stores `dtype` as, and the `dtype` attribute to record (or None)."""
+    for name, (actual, bits) in _STORED_AS_BITS.items():
+        if dtype == actual:
+            return bits, name
+    return dtype, None
+
+
 def load_zarr(filename: str, state: PyTree, config: IOConfig) -> PyTree:
     """Loads a zarr checkpoint from disk.
 
@@ -192,12 +504,14 @@ def load_zarr(filename: str, state: PyTree, config: IOConfig) -> PyTree:
         assert (
             arr.shape == shape
         ), f"Expected shape {shape} but got {arr.shape} for {path} in {filename}"
+        dtype_name = arr.attrs.get("dtype")
+        dtype = _STORED_AS_BITS[dtype_name][0] if dtype_name else arr.dtype
         assert (
-            arr.dtype == prev.dtype
-        ), f"Expected dtype {prev.dtype} but got {arr.dtype} for {path} in {filename}"
+            dtype == prev.dtype
+        ), f"Expected dtype {prev.dtype} but got {dtype} for {path} in {filename}"
         del prev  # Deallocate memory before loading its replacement!
         return jax.make_array_from_callback(
-            shape, sharding, lambda shard_index: arr[shard_index]
+            shape, sharding, lambda shard_index: arr[shard_index].view(dtype)
         )
 
     state, treedef = jax.tree_util.tree_flatten_with_path(state)
@@ -219,37 +533,78 @@ def save_zarr(filename: str, state: PyTree, config: IOConfig):
     state, _treedef = jax.tree_util.tree_flatten_with_path(state)
 
     if jax.process_index() == 0:
-        # Create the zarr file and all the arrays.
-        try:
-            root = zarr.open_group(filename, mode="w-")
-        except zarr.errors.ContainsGroupError:
-            raise ValueError(f"Checkpoint {filename} already exists.")
-        for path, arr in state:
-            path = jax.tree_util.keystr(path)
-            chunk_shape = arr.sharding.shard_shape(arr.shape)
-            root.empty(path, shape=arr.shape, chunks=chunk_shape, dtype=arr.dtype)
+        _create_arrays(filename, _array_specs(state))
     multihost_utils.sync_global_devices("save_zarr_begin")
 
+    root = _write_shards(filename, _shards_to_write(state), config)
+
+    multihost_utils.sync_global_devices("save_zarr_end")
+    if jax.process_index() == 0:
+        root.attrs["write_completed"] = True
+    multihost_utils.sync_global_devices("save_zarr_committed")
+
+
+def _array_specs(state: list) -> list:
+    """`(path, shape, dtype, chunk shape)` of each array of a flattened PyTree, chunked by
+    shard."""
+    return [
+        (
+            jax.tree_util.keystr(path),
+            arr.shape,
+            arr.dtype,
+            arr.sharding.shard_shape(arr.shape),
+        )
+        for path, arr in state
+    ]
+
+
+def _shards_to_write(state: list, every_replica: bool = False) -> list:
+    """`(path, index, data)` of each shard of a flattened PyTree that this process writes:
+    those on its devices, one replica each. With `every_replica`, also those whose replica 0 is
+    on another process, so that this process can load the state from its own copy."""
+    shards = []
+    seen = set()
+    for path, arr in state:
+        path = jax.tree_util.keystr(path)
+        for shard in arr.addressable_shards:
+            key = (path, _index_key(shard.index))
+            if (shard.replica_id == 0 or every_replica) and key not in seen:
+                seen.add(key)
+                shards.append((path, shard.index, shard.data))
+    return shards
+
+
+def _create_arrays(filename: str, specs: list):
+    """Creates the zarr group, with an empty array for each of `_array_specs`."""
+    try:
+        root = zarr.open_group(filename, mode="w-")
+    except zarr.errors.ContainsGroupError:
+        raise ValueError(f"Checkpoint {filename} already exists.")
+    for path, shape, dtype, chunk_shape in specs:
+        stored_dtype, dtype_name = _stored_dtype(dtype)
+        dst = root.empty(path, shape=shape, chunks=chunk_shape, dtype=stored_dtype)
+        if dtype_name:
+            dst.attrs["dtype"] = dtype_name
+
+
+def _write_shards(filename: str, shards: list, config: IOConfig) -> zarr.Group:
+    """Writes each of `_shards_to_write` (as device or host arrays) to its chunk."""
     root = zarr.open_group(filename, mode="r+")
 
-    def save_shard(dst: zarr.Array, shard: jax.Array, index: Tuple[int, ...]):
-        dst[index] = np.asarray(shard)
+    def save_shard(dst: zarr.Array, shard, index: Tuple[int, ...]):
+        dst[index] = np.asarray(shard).view(dst.dtype)
 
     with concurrent.futures.ThreadPoolExecutor(
         max_workers=config.max_io_threads
     ) as executor:
-        for path, arr in state:
-            path = jax.tree_util.keystr(path)
+        futures = []
+        for path, index, data in shards:
             dst = root[path]
-            assert dst.chunks == arr.sharding.shard_shape(arr.shape)
-            for shard in arr.addressable_shards:
-                if shard.replica_id == 0:
-                    executor.submit(save_shard, dst, shard.data, shard.index)
-
-    multihost_utils.sync_global_devices("save_zarr_end")
-    if jax.process_index() == 0:
-        root.attrs["write_completed"] = True
-    multihost_utils.sync_global_devices("save_zarr_committed")
+            assert dst.chunks == data.shape
+            futures.append(executor.submit(save_shard, dst, data, index))
+        for future in futures:
+            future.result()
+    return root
 
 
 def step_to_str(step: int) -> str: